@@ -1,24 +1,35 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file, session
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_file, session, has_request_context
 import os
-import pandas as pd
+import atexit
 import numpy as np
-import pickle
 import logging
 import json
-from datetime import datetime
-import base64
+import mimetypes
 from io import BytesIO
-from PIL import Image
 import shutil
 import time
+import threading
 from pathlib import Path
 
-# Try to import face_recognition, but provide a fallback
-try:
-    import face_recognition
-    FACE_RECOGNITION_AVAILABLE = True
-except ImportError:
-    FACE_RECOGNITION_AVAILABLE = False
+from label_store import LabelStore
+from state import WatchedFile, FileLock, file_stamp
+from image_queue import ImageQueue
+from face_cache import FaceCache
+from face_match import FaceMatcher, ENCODING_DIM
+from face_store import FaceStore
+from face_analysis import detect_and_encode, detection_tag, load_image_file, FACE_RECOGNITION_AVAILABLE
+from face_pipeline import FacePrecomputer
+from image_cache import ImageCache
+from derivatives import DerivativeCache
+from face_crops import FaceSpriteCache
+from ocr_index import OcrIndex
+from queue_filters import PeopleIndex, QueueFilters, parse_filter, filter_args
+from metrics import Registry, server_timing
+from warm_state import WarmState
+from labeled_tree import LabeledTree, LabeledTreeSync
+
+# face_recognition itself is imported by face_analysis on the first detection
+if not FACE_RECOGNITION_AVAILABLE:
     print("WARNING: face_recognition module not found. Face detection features will be disabled.")
     print("Please install with: pip install face-recognition")
 
@@ -36,78 +47,156 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'
 
+# Stage timings, latencies and cache counters, served at /metrics
+metrics = Registry()
+request_seconds = metrics.histogram('app_request_seconds', "Request latency per endpoint", ['endpoint'])
+requests_total = metrics.counter('app_requests_total', "Requests per endpoint and status", ['endpoint', 'status'])
+face_analysis_total = metrics.counter('app_face_analysis_total', "Face analyses needed by requests, per source",
+                                      ['source'])
+face_detection_seconds = metrics.histogram('app_face_detection_seconds',
+                                           "Face detection run in the request path, per image")
+label_write_seconds = metrics.histogram('app_label_write_seconds', "Label journal write latency", ['op'])
+
+# Per-stage durations of each response in a Server-Timing header (browser network panel)
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') != '0'
+
 # Paths
 CACHE_DIR = os.path.join(os.getcwd(), 'cache')
 IMAGES_DIR = os.path.join(CACHE_DIR, 'images')
 OCR_DIR = os.path.join(CACHE_DIR, 'ocr')
+OCR_INDEX_DB = os.path.join(CACHE_DIR, 'ocr_index.sqlite')
 LABELS_CSV = os.path.join(CACHE_DIR, 'labels.csv')
+LABELS_JOURNAL = os.path.join(CACHE_DIR, 'labels.journal')
+LABELS_SYNC_ACK = os.path.join(CACHE_DIR, 'sync', 'labels_ack.json')
 FACES_PKL = os.path.join(CACHE_DIR, 'faces.pkl')
+FACES_DIR = os.path.join(CACHE_DIR, 'faces')
+FACE_CACHE_BIN = os.path.join(CACHE_DIR, 'face_cache.bin')
+DERIVATIVES_DIR = os.path.join(CACHE_DIR, 'derivatives')
+FACE_CROPS_DIR = os.path.join(CACHE_DIR, 'face_crops')
+SYNC_STATUS_JSON = os.path.join(CACHE_DIR, 'sync_status.json')
+SYNC_METRICS_JSON = os.path.join(CACHE_DIR, 'sync_metrics.json')
+WARM_STATE_DIR = os.path.join(CACHE_DIR, 'warm_state')
+CATEGORIES_JSON = 'categories.json'
+LABELED_DIR = os.path.join(os.getcwd(), 'labeled')
 
 # Ensure directories exist
 os.makedirs(IMAGES_DIR, exist_ok=True)
 os.makedirs(OCR_DIR, exist_ok=True)
 
-# Image cache for performance
-image_cache = {}
-CACHE_SIZE = 10
+# Maximum encoding distance for two faces to be the same person
+FACE_MATCH_TOLERANCE = 0.6
+
+# Number of upcoming images to run face analysis for in the background
+FACE_PRECOMPUTE_AHEAD = 5
+
+# Processes analysing faces in the background (0: one per core but one); serve.py
+# divides the cores between its server processes through this variable
+FACE_WORKERS = int(os.environ.get('FACE_WORKERS', '0'))
+
+# Most results returned by /api/search
+SEARCH_MAX_RESULTS = 200
+
+# The sync daemon rewrites its status at least every 30s; older means it is not running
+SYNC_STATUS_STALE_AFTER = 90
+
+# In-memory image cache, bounded by bytes per tier (decoded arrays are large)
+IMAGE_CACHE_DECODED_BYTES = 512 * 1024 * 1024
+IMAGE_CACHE_ENCODED_BYTES = 128 * 1024 * 1024
+image_cache = ImageCache(IMAGE_CACHE_DECODED_BYTES, IMAGE_CACHE_ENCODED_BYTES)
+
+# Resized copies served to the browser instead of the multi-megapixel originals
+IMAGE_DISPLAY_SIZE = 1600
+DERIVATIVE_FORMAT = 'webp'
+DERIVATIVE_QUALITY = 80
+
+# Side of each face tile in the per-image face sprite
+FACE_TILE_SIZE = 150
+
+# Seconds between warm-state snapshots (also written on shutdown); 0 disables the periodic save
+WARM_STATE_INTERVAL = int(os.environ.get('WARM_STATE_INTERVAL', '300'))
 
 logger.info("Application starting up...")
 logger.info(f"Cache directory: {CACHE_DIR}")
 logger.info(f"Images directory: {IMAGES_DIR}")
 logger.info(f"OCR directory: {OCR_DIR}")
 logger.info(f"Labels CSV: {LABELS_CSV}")
-logger.info(f"Faces PKL: {FACES_PKL}")
+logger.info(f"Faces store: {FACES_DIR}")
 
-def load_labels():
-    """Load the labels from CSV or create empty DataFrame"""
-    if os.path.exists(LABELS_CSV):
-        try:
-            df = pd.read_csv(LABELS_CSV)
-            logger.info(f"Loaded {len(df)} labeled images from CSV")
-            return df
-        except Exception as e:
-            logger.error(f"Error loading labels CSV: {e}")
-            
-    # Create a new DataFrame if file doesn't exist or there's an error
-    df = pd.DataFrame(columns=['filename', 'keep'])
-    logger.info("Created new labels DataFrame")
-    return df
-
-def save_labels(labels_df):
-    """Save the labels to CSV"""
-    try:
-        labels_df.to_csv(LABELS_CSV, index=False)
-        logger.info(f"Saved {len(labels_df)} labels to {LABELS_CSV}")
-    except Exception as e:
-        logger.error(f"Error saving labels to CSV: {e}")
+# Snapshot of the label index, queue listing and face cache index from the
+# last run; each part is only used if the files it was built from are unchanged
+warm_state = WarmState(WARM_STATE_DIR)
+_warm_snapshot = warm_state.load()
 
-def load_faces():
-    """Load known face encodings and names"""
-    if os.path.exists(FACES_PKL):
-        try:
-            with open(FACES_PKL, 'rb') as f:
-                known_faces = pickle.load(f)
-                logger.info(f"Loaded {len(known_faces['encodings'])} known faces")
-                return known_faces
-        except Exception as e:
-            logger.error(f"Error loading faces PKL: {e}")
-    
-    # Create empty faces dict if file doesn't exist or there's an error
-    known_faces = {
-        'encodings': [],
-        'names': []
-    }
-    logger.info("Created new faces dictionary")
-    return known_faces
+# Append-only label store; labels.csv is rewritten only on compaction
+# Records not yet pushed to the NAS by worker.py survive compaction until acknowledged
+label_store = LabelStore(LABELS_CSV, LABELS_JOURNAL, ack_path=LABELS_SYNC_ACK,
+                         snapshot=_warm_snapshot.get('labels'))
+atexit.register(label_store.close)
+
+# Unlabelled images, maintained incrementally as labels change
+image_queue = ImageQueue(IMAGES_DIR, is_labeled=label_store.__contains__,
+                         snapshot=_warm_snapshot.get('queue'))
+
+# Full-text index of the OCR text; worker.py adds the files it pulls,
+# the app picks up anything else when cache/ocr/ changes
+ocr_index = OcrIndex(OCR_INDEX_DB, OCR_DIR)
+ocr_index.refresh()
+atexit.register(ocr_index.close)
+
+# Known faces: memory-mapped matrix plus append log, migrated once from faces.pkl
+face_store = FaceStore(FACES_DIR)
+face_store.migrate_from_pickle(FACES_PKL)
+
+# Face locations/encodings per image, persisted so each image is analysed once
+face_cache = FaceCache(FACE_CACHE_BIN, tag=detection_tag(), snapshot=_warm_snapshot.get('face_cache'))
+atexit.register(face_cache.close)
+del _warm_snapshot
 
-def save_faces(known_faces):
-    """Save face encodings and names"""
+# Known people per analysed image, for review sessions filtered by person or
+# by absence of faces; updated from new face cache records only when such a filter is used
+people_index = PeopleIndex(face_cache, FACE_MATCH_TOLERANCE)
+
+# Filtered/reordered views of the queue (?person=, ?ocr=, ?faces=none, ?order=mtime|newest)
+queue_filters = QueueFilters(image_queue, ocr_index, people_index, IMAGES_DIR)
+
+# On-disk cache of resized images, generated on first view or ahead of time
+derivative_cache = DerivativeCache(IMAGES_DIR, DERIVATIVES_DIR, DERIVATIVE_FORMAT, DERIVATIVE_QUALITY)
+atexit.register(derivative_cache.shutdown)
+
+# One sprite sheet of face crops per image, cut once from the cached face locations
+face_sprites = FaceSpriteCache(IMAGES_DIR, FACE_CROPS_DIR, tile=FACE_TILE_SIZE)
+atexit.register(face_sprites.shutdown)
+
+# Process pool that analyses the next images in the queue ahead of time;
+# face sprites are built as soon as each result lands
+face_precomputer = FacePrecomputer(IMAGES_DIR, face_cache, lookahead=FACE_PRECOMPUTE_AHEAD + 1,
+                                   workers=FACE_WORKERS or None,
+                                   on_result=lambda f, locations: face_sprites.prefetch([(f, locations)]))
+atexit.register(face_precomputer.shutdown)
+
+def save_warm_state():
+    """Snapshot the in-memory indexes if they changed since the last save"""
     try:
-        with open(FACES_PKL, 'wb') as f:
-            pickle.dump(known_faces, f)
-        logger.info(f"Saved {len(known_faces['encodings'])} faces to {FACES_PKL}")
+        warm_state.save({
+            'labels': label_store.snapshot(),
+            'queue': image_queue.snapshot(),
+            'face_cache': face_cache.snapshot(),
+        })
     except Exception as e:
-        logger.error(f"Error saving faces to PKL: {e}")
+        logger.error(f"Error saving warm-state snapshot: {e}")
+
+def _save_warm_state_periodically():
+    while True:
+        time.sleep(WARM_STATE_INTERVAL)
+        save_warm_state()
+
+def _save_warm_state_on_exit():
+    # Compact the labels first so the snapshot matches the labels.csv the next run reads
+    label_store.close()
+    save_warm_state()
+
+if WARM_STATE_INTERVAL > 0:
+    threading.Thread(target=_save_warm_state_periodically, name='warm-state', daemon=True).start()
 
 # Default categories with keyboard shortcuts
 DEFAULT_CATEGORIES = {
@@ -117,46 +206,121 @@ DEFAULT_CATEGORIES = {
     'archive': {'name': 'Archive', 'key': '4'}
 }
 
-def get_unlabeled_images(labels_df):
-    """Get list of unlabeled images"""
-    labeled_files = set(labels_df['filename'])
-    all_image_files = []
-    
+def _read_categories():
+    """Load categories from JSON, falling back to the defaults"""
     try:
-        all_image_files = [f for f in os.listdir(IMAGES_DIR) 
-                         if f.lower().endswith(('jpg', 'jpeg', 'png', 'webp', 'bmp'))]
+        if os.path.exists(CATEGORIES_JSON):
+            with open(CATEGORIES_JSON, 'r') as f:
+                categories = json.load(f)
+                logger.info(f"Loaded {len(categories)} categories from JSON")
+                return categories
     except Exception as e:
-        logger.error(f"Error listing images directory: {e}")
-    
-    unlabeled = [f for f in all_image_files if f not in labeled_files]
-    logger.info(f"Found {len(unlabeled)}/{len(all_image_files)} unlabeled images")
-    return unlabeled
+        logger.error(f"Error loading categories: {e}")
+    return {k: dict(v) for k, v in DEFAULT_CATEGORIES.items()}
+
+def _write_categories(categories):
+    """Save categories to JSON"""
+    try:
+        # Replaced atomically so other server processes never read a partial file
+        tmp_path = CATEGORIES_JSON + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(categories, f, indent=2)
+        os.replace(tmp_path, CATEGORIES_JSON)
+        logger.info(f"Saved {len(categories)} categories to {CATEGORIES_JSON}")
+    except Exception as e:
+        logger.error(f"Error saving categories: {e}")
+
+def _read_sync_status():
+    """Last status written by the worker.py sync daemon, or None"""
+    try:
+        with open(SYNC_STATUS_JSON, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error loading sync status: {e}")
+        return None
+
+# Files read on every request are kept in memory and reloaded only when
+# they change on disk (e.g. worker.py pulled a newer copy)
+categories_state = WatchedFile(CATEGORIES_JSON, _read_categories, _write_categories)
+# Held across read-modify-write of the categories by any server process
+categories_lock = FileLock(CATEGORIES_JSON + '.lock')
+sync_status_state = WatchedFile(SYNC_STATUS_JSON, _read_sync_status, None)
+
+def _read_sync_metrics():
+    """Per-channel stats of worker.py runs (last run and totals)"""
+    try:
+        with open(SYNC_METRICS_JSON, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Error loading sync metrics: {e}")
+        return {}
+
+sync_metrics_state = WatchedFile(SYNC_METRICS_JSON, _read_sync_metrics, None)
+
+_face_matcher = None
+_face_matcher_version = None
+
+def get_face_matcher():
+    """Matcher over the known faces, rebuilt only when they change"""
+    global _face_matcher, _face_matcher_version
+    if _face_matcher is None or _face_matcher_version != face_store.version:
+        _face_matcher = FaceMatcher(face_store.encodings(), face_store.names())
+        _face_matcher_version = face_store.version
+        logger.info(f"Built face matcher over {len(_face_matcher)} known faces")
+    return _face_matcher
+
+def load_categories():
+    """Get categories from the in-memory state"""
+    return categories_state.get()
+
+def save_categories(categories):
+    """Write categories through to disk"""
+    categories_state.save(categories)
+
+def desired_label_links(filenames=None):
+    """{image: category} the labeled/ tree should hold, for the given images or all labelled ones
+
+    Images whose label is not a current category, or which are no longer in
+    the cache, map to None (or are left out of the full mapping).
+    """
+    categories = load_categories()
+    if filenames is None:
+        return {f: label for f, label in label_store.items()
+                if label in categories and image_queue.has_image(f)}
+    desired = {}
+    for f in filenames:
+        label = label_store.get(f)
+        desired[f] = label if label in categories and image_queue.has_image(f) else None
+    return desired
 
-def get_next_image(labels_df):
-    """Get next unlabeled image"""
-    unlabeled = get_unlabeled_images(labels_df)
-    return unlabeled[0] if unlabeled else None
+# labeled/<category>/<image> symlinks, kept in line with the labels by a
+# background thread: the whole tree at startup and after category or label
+# file changes, otherwise just the images labelled or undone here
+labeled_tree = LabeledTree(LABELED_DIR, IMAGES_DIR)
+labeled_tree_sync = LabeledTreeSync(labeled_tree, desired_label_links, lambda: list(load_categories()))
+labeled_tree_sync.reconcile()
+atexit.register(labeled_tree_sync.shutdown)
 
+# Registered after every other exit handler so it runs first, before they close
+# the stores; the tree's last flush then only reads the labels held in memory
+atexit.register(_save_warm_state_on_exit)
+
+@metrics.timed('load_image')
 def load_image(filename):
-    """Load an image from cache or file system"""
-    if filename in image_cache:
+    """Load a decoded image from cache or file system"""
+    image = image_cache.get_decoded(filename)
+    if image is not None:
         logger.debug(f"Loading {filename} from cache")
-        return image_cache[filename]['image']
+        return image
     
     try:
         filepath = os.path.join(IMAGES_DIR, filename)
-        image = face_recognition.load_image_file(filepath)
-        
-        # Store in cache
-        if len(image_cache) >= CACHE_SIZE:
-            # Remove oldest item
-            oldest = min(image_cache.items(), key=lambda x: x[1]['timestamp'])
-            del image_cache[oldest[0]]
-        
-        image_cache[filename] = {
-            'image': image,
-            'timestamp': datetime.now().timestamp()
-        }
+        image = load_image_file(filepath)
+        image_cache.put_decoded(filename, image)
         logger.info(f"Loaded {filename} from file system and added to cache")
         return image
     except Exception as e:
@@ -170,43 +334,83 @@ def detect_faces(image, filename):
         return [], []
     
     try:
-        face_locations = face_recognition.face_locations(image)
-        face_encodings = face_recognition.face_encodings(image, face_locations)
-        
+        face_locations, face_encodings = detect_and_encode(image)
         logger.info(f"Detected {len(face_locations)} faces in {filename}")
         return face_locations, face_encodings
     except Exception as e:
         logger.error(f"Error detecting faces in {filename}: {e}")
         return [], []
 
-def identify_faces(face_encodings, known_faces):
-    """Match face encodings with known faces"""
+def get_cached_analysis(filename):
+    """Cached face locations and encodings for an image without running the detector, or None"""
+    stamp = file_stamp(os.path.join(IMAGES_DIR, filename))
+    if stamp is None:
+        return None
+    cached = face_cache.lookup(filename, stamp)
+    if cached is None:
+        return None
+    locations, encodings = cached
+    return [tuple(int(v) for v in loc) for loc in locations], list(encodings)
+
+@metrics.timed('face_analysis')
+def get_face_analysis(filename, image=None):
+    """Face locations and encodings for an image, served from the face cache when possible"""
+    stamp = file_stamp(os.path.join(IMAGES_DIR, filename))
+    if stamp is None:
+        logger.error(f"Image not found for face analysis: {filename}")
+        return [], []
+    
+    cached = face_cache.lookup(filename, stamp)
+    if cached is not None:
+        locations, encodings = cached
+        logger.debug(f"Face cache hit for {filename} ({len(locations)} faces)")
+        face_analysis_total.inc('cache')
+        return [tuple(int(v) for v in loc) for loc in locations], list(encodings)
+    
     if not FACE_RECOGNITION_AVAILABLE:
-        return ["Face recognition not available"] * len(face_encodings) if face_encodings else []
-    
-    names = []
-    
-    for face_encoding in face_encodings:
-        name = "Unknown"
-        # If we have known faces, compare
-        if known_faces['encodings']:
-            # Compare with all known face encodings
-            matches = face_recognition.compare_faces(
-                known_faces['encodings'], face_encoding, tolerance=0.6
-            )
-            
-            # Find the best match
-            if True in matches:
-                match_index = matches.index(True)
-                name = known_faces['names'][match_index]
-                
-        names.append(name)
+        logger.warning(f"Face recognition not available, skipping face detection for {filename}")
+        return [], []
+    
+    # Already running in the background pool? Wait for it rather than duplicate the work
+    result = face_precomputer.wait_for(filename)
+    if result is not None:
+        _, locations, encodings = result
+        logger.debug(f"Used background face analysis for {filename}")
+        face_analysis_total.inc('background')
+        return [tuple(int(v) for v in loc) for loc in locations], list(encodings)
     
+    if image is None:
+        image = load_image(filename)
+        if image is None:
+            return [], []
+    
+    face_analysis_total.inc('detector')
+    try:
+        with face_detection_seconds.time():
+            face_locations, face_encodings = detect_and_encode(image)
+    except Exception as e:
+        logger.error(f"Error detecting faces in {filename}: {e}")
+        return [], []
+    
+    logger.info(f"Detected {len(face_locations)} faces in {filename}")
+    face_cache.put(filename, stamp, face_locations, face_encodings)
+    return face_locations, face_encodings
+
+@metrics.timed('identify_faces')
+def identify_faces(face_encodings, matcher):
+    """Name each face after its nearest known face within tolerance"""
+    names = [name or "Unknown"
+             for name, _ in matcher.identify(face_encodings, FACE_MATCH_TOLERANCE)]
     logger.debug(f"Identified faces: {names}")
     return names
 
+@metrics.timed('ocr')
 def get_ocr_text(filename):
     """Get OCR text for an image if available"""
+    indexed = ocr_index.text(filename)
+    if indexed is not None:
+        return indexed
+
     base_name = os.path.splitext(filename)[0]
     ocr_path = os.path.join(OCR_DIR, f"{base_name}.txt")
     
@@ -222,166 +426,238 @@ def get_ocr_text(filename):
     logger.debug(f"No OCR text found for {filename}")
     return ""
 
-def get_next_image(labeled):
-    logger.debug("Finding next image to label...")
-    labeled_images = {row[0] for row in labeled}
+def load_image_bytes(filename):
+    """Load the encoded image file from cache or file system"""
+    data = image_cache.get_encoded(filename)
+    if data is not None:
+        logger.debug(f"Serving {filename} bytes from cache")
+        return data
+    
+    file_path = os.path.join(IMAGES_DIR, filename)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    image_cache.put_encoded(filename, data)
+    logger.debug(f"Cached image bytes: {filename} ({len(data)} bytes)")
+    return data
+
+def current_queue():
+    """The queue this request labels from: the filtered view its arguments ask for, or the plain queue
+
+    Raises ValueError for invalid filter arguments.
+    """
+    queue_filter = parse_filter(request.args) if has_request_context() else None
+    if queue_filter is None:
+        return image_queue
+    return queue_filters.view(queue_filter, get_face_matcher())
+
+def preload_upcoming():
+    """Keep face analysis and display-size images prepared ahead of the labelling queue"""
     try:
-        unlabeled_files = [f for f in os.listdir(UNLABELLED_FOLDER) 
-                          if f.lower().endswith(('jpg', 'jpeg', 'png', 'webp', 'bmp', 'gif')) 
-                          and f not in labeled_images]
-        
-        if unlabeled_files:
-            next_image = unlabeled_files[0]
-            logger.info(f"Next image to label: {next_image} ({len(unlabeled_files)} remaining)")
-            return next_image
-        else:
-            logger.info("No more images to label")
-            return None
-    except FileNotFoundError:
-        logger.error(f"Unlabelled folder not found: {UNLABELLED_FOLDER}")
-        return None
-    except Exception as e:
-        logger.error(f"Error finding next image: {e}")
+        queue = current_queue()
+    except ValueError:
+        queue = image_queue
+    upcoming = queue.peek(FACE_PRECOMPUTE_AHEAD + 1)
+    face_precomputer.schedule(upcoming)
+    derivative_cache.prefetch(upcoming, IMAGE_DISPLAY_SIZE)
+    cached = [(f, get_cached_analysis(f)) for f in upcoming]
+    face_sprites.prefetch((f, analysis[0]) for f, analysis in cached if analysis and analysis[0])
+
+def describe_faces(filename, face_locations, face_encodings, matcher):
+    """Face boxes, names and sprite tile offsets of an image"""
+    face_names = identify_faces(face_encodings, matcher)
+    faces = []
+    for tile, location, name in zip(face_sprites.layout(face_locations), face_locations, face_names):
+        tile.update({'box': list(location), 'name': name})
+        faces.append(tile)
+    return {
+        'sprite': url_for('serve_face_sprite', filename=filename) if faces else None,
+        'tile': FACE_TILE_SIZE,
+        'faces': faces
+    }
+
+def describe_image(filename, matcher, analyse=True):
+    """Everything the labelling page needs to show an image, as JSON-ready data
+
+    With analyse=False faces are only taken from the face cache; an image that is
+    still being analysed comes back with faces_pending set and the page asks for
+    it again through /api/image/<filename> when it gets to it.
+    """
+    analysis = get_face_analysis(filename) if analyse else get_cached_analysis(filename)
+    pending = analysis is None and FACE_RECOGNITION_AVAILABLE
+    face_locations, face_encodings = analysis or ([], [])
+
+    descriptor = {
+        'filename': filename,
+        'url': url_for('serve_image', filename=filename, size=IMAGE_DISPLAY_SIZE),
+        'ocr_text': get_ocr_text(filename),
+        'faces_pending': pending
+    }
+    descriptor.update(describe_faces(filename, face_locations, face_encodings, matcher))
+    return descriptor
+
+def queue_status():
+    """Labelling progress counters shared by the page and the JSON API"""
+    return {
+        'progress': len(label_store),
+        'total': image_queue.total,
+        'remaining': image_queue.remaining
+    }
+
+def record_labels(decisions):
+    """Store (filename, label) decisions as one journal record and move the queue on"""
+    # Append the decisions to the label journal
+    with metrics.stage('label_write'), label_write_seconds.time('batch' if len(decisions) > 1 else 'add'):
+        label_store.add_many(decisions)
+
+    for image, label in decisions:
+        image_queue.mark_labeled(image)
+        logger.info(f"Saved label: {image} -> {label}")
+
+        # Remove from cache to ensure it's reloaded next time
+        image_cache.discard(image)
+        logger.debug(f"Removed {image} from cache")
+
+    labeled_tree_sync.mark(image for image, _ in decisions)
+
+    # Move the background face analysis window along with the queue
+    preload_upcoming()
+
+def record_label(image, label):
+    """Store a labelling decision and move the queue on"""
+    record_labels([(image, label)])
+
+def assign_face_name(filename, face_id, name):
+    """Name a detected face; returns an error message or None"""
+    face_locations, face_encodings = get_face_analysis(filename)
+
+    if face_id >= len(face_locations) or face_id >= len(face_encodings):
+        logger.error(f"Face index out of range: {face_id}")
+        return "Face not found"
+
+    face_encoding = face_encodings[face_id]
+
+    # If the nearest known face is the same face, move it to this person instead of adding
+    indices, distances = get_face_matcher().nearest([face_encoding])
+    if indices[0] >= 0 and distances[0] <= FACE_MATCH_TOLERANCE:
+        face_store.assign_row(int(indices[0]), name)
+        logger.info(f"Updated existing face: {name} (distance {distances[0]:.3f})")
+    else:
+        # Add as new face
+        face_store.add_face(face_encoding, name)
+        logger.info(f"Added new face: {name}")
+    return None
+
+def revert_last_label():
+    """Undo the most recent label; returns (filename, label) or None"""
+    # Record the undo as a tombstone in the label journal
+    with metrics.stage('label_write'), label_write_seconds.time('undo'):
+        last = label_store.undo()
+    if last is None:
+        logger.info("No labeled images to undo")
         return None
 
-def get_next_images(labeled, count=5):
-    """Get next several images for preloading"""
-    logger.debug(f"Getting next {count} images for preloading...")
-    labeled_images = {row[0] for row in labeled}
-    try:
-        unlabeled_files = [f for f in os.listdir(UNLABELLED_FOLDER) 
-                          if f.lower().endswith(('jpg', 'jpeg', 'png', 'webp', 'bmp', 'gif')) 
-                          and f not in labeled_images]
-        next_images = unlabeled_files[:count]
-        logger.info(f"Found {len(next_images)} images for preloading: {next_images}")
-        return next_images
-    except FileNotFoundError:
-        logger.error(f"Unlabelled folder not found: {UNLABELLED_FOLDER}")
-        return []
-    except Exception as e:
-        logger.error(f"Error getting next images: {e}")
-        return []
+    last_image, last_label = last
+    image_queue.mark_unlabeled(last_image)
+    queue_filters.promote(last_image)
+    logger.info(f"Undid last label: {last_image} ({last_label})")
 
-def load_image_to_cache(filename):
-    """Load image to cache in background"""
-    if filename in image_cache:
-        logger.debug(f"Image {filename} already in cache, skipping")
-        return
-    
-    logger.debug(f"Loading image to cache: {filename}")
-    try:
-        file_path = os.path.join(UNLABELLED_FOLDER, filename)
-        with open(file_path, 'rb') as f:
-            image_data = f.read()
-            # Store as base64 for easy serving
-            image_cache[filename] = {
-                'data': base64.b64encode(image_data).decode('utf-8'),
-                'timestamp': time.time(),
-                'size': len(image_data)
-            }
-        
-        logger.info(f"Cached image: {filename} ({len(image_data)} bytes)")
-        
-        # Manage cache size
-        if len(image_cache) > CACHE_SIZE:
-            logger.debug(f"Cache size ({len(image_cache)}) exceeds limit ({CACHE_SIZE}), cleaning up...")
-            # Remove oldest entries
-            sorted_cache = sorted(image_cache.items(), key=lambda x: x[1]['timestamp'])
-            removed_count = 0
-            for filename_to_remove, _ in sorted_cache[:-CACHE_SIZE]:
-                del image_cache[filename_to_remove]
-                removed_count += 1
-            logger.info(f"Removed {removed_count} old images from cache")
-                
-    except Exception as e:
-        logger.error(f"Error caching image {filename}: {e}")
-
-def preload_images(filenames):
-    """Preload multiple images asynchronously"""
-    if not filenames:
-        logger.debug("No images to preload")
-        return
-    
-    logger.info(f"Starting preload for {len(filenames)} images: {filenames}")
-    submitted_count = 0
-    for filename in filenames:
-        if filename not in image_cache:
-            preload_executor.submit(load_image_to_cache, filename)
-            submitted_count += 1
+    labeled_tree_sync.mark([last_image])
+
+    # Remove from cache to ensure fresh load
+    image_cache.discard(last_image)
+    logger.debug(f"Removed {last_image} from cache")
+
+    # The undone image is next again; reprioritise background face analysis
+    preload_upcoming()
+    return last
+
+@app.before_request
+def start_request_timing():
+    metrics.start_request()
+
+@app.before_request
+def refresh_state():
+    """Pick up labels, faces and images changed by another process (cheap stat checks)"""
+    with metrics.stage('labels_reload'):
+        if label_store.reload_if_changed():
+            image_queue.rebuild()
+            labeled_tree_sync.reconcile()
         else:
-            logger.debug(f"Image {filename} already cached, skipping preload")
-    
-    if submitted_count > 0:
-        logger.info(f"Submitted {submitted_count} images for background loading")
+            # Labels and undos made through other server processes
+            for filename in label_store.follow():
+                if filename in label_store:
+                    image_queue.mark_labeled(filename)
+                else:
+                    image_queue.mark_unlabeled(filename)
+                    queue_filters.promote(filename)
+    with metrics.stage('queue_refresh'):
+        image_queue.refresh()
+    with metrics.stage('ocr_refresh'):
+        ocr_index.refresh()
+    with metrics.stage('faces_reload'):
+        face_store.reload_if_changed()
+    with metrics.stage('faces_cache_refresh'):
+        # Analyses appended by other server processes and index_faces.py
+        face_cache.refresh()
 
-def get_total_images():
-    logger.debug("Counting total images in unlabelled folder...")
-    try:
-        total = len([f for f in os.listdir(UNLABELLED_FOLDER) 
-                   if f.lower().endswith(('jpg', 'jpeg', 'png', 'webp', 'bmp', 'gif'))])
-        logger.info(f"Total images in folder: {total}")
-        return total
-    except FileNotFoundError:
-        logger.error(f"Unlabelled folder not found: {UNLABELLED_FOLDER}")
-        return 0
-    except Exception as e:
-        logger.error(f"Error counting images: {e}")
-        return 0
+@app.after_request
+def finish_request_timing(response):
+    elapsed, stages = metrics.finish_request()
+    if elapsed is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    request_seconds.observe(elapsed, endpoint)
+    requests_total.inc(endpoint, response.status_code)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing(elapsed, stages)
+    return response
 
 @app.route('/')
 def index():
     logger.info("=== INDEX PAGE REQUEST ===")
     logger.info("Starting index page load...")
     
-    # Load labels and known faces
-    labels_df = load_labels()
-    known_faces = load_faces()
+    # Matcher over known faces (cached until faces change)
+    matcher = get_face_matcher()
     
-    # Get next unlabeled image
-    next_image = get_next_image(labels_df)
-    total_images = len([f for f in os.listdir(IMAGES_DIR) 
-                     if f.lower().endswith(('jpg', 'jpeg', 'png', 'webp', 'bmp'))])
-    progress = len(labels_df)
+    # Get next unlabeled image, from the filtered view if one was asked for
+    try:
+        with metrics.stage('queue_next'):
+            queue = current_queue()
+            next_image = queue.next()
+    except ValueError as e:
+        return str(e), 400
+    filters = filter_args(parse_filter(request.args))
+    total_images = image_queue.total
+    progress = len(label_store)
     
     logger.info(f"Progress: {progress}/{total_images} images labeled")
     
     # Load categories
-    categories = DEFAULT_CATEGORIES
-    try:
-        if os.path.exists('categories.json'):
-            with open('categories.json', 'r') as f:
-                categories = json.load(f)
-                logger.info(f"Loaded {len(categories)} categories from JSON")
-    except Exception as e:
-        logger.error(f"Error loading categories: {e}")
+    categories = load_categories()
     
     if next_image:
         logger.info(f"Displaying image: {next_image}")
+        preload_upcoming()
         
-        # Process image for faces
-        image = load_image(next_image)
-        face_locations = []
-        face_names = []
-        ocr_text = ""
-        
-        if image is not None:
-            # Detect faces
-            face_locations, face_encodings = detect_faces(image, next_image)
-            face_names = identify_faces(face_encodings, known_faces)
-            
-            # Get OCR text if available
-            ocr_text = get_ocr_text(next_image)
+        # Faces come from the face cache; the detector only runs on a miss
+        current = describe_image(next_image, matcher)
         
         logger.info("Rendering index template")
-        return render_template('index.html', 
-                             image=next_image, 
-                             progress=progress, 
-                             total=total_images,
-                             categories=categories,
-                             face_count=len(face_locations),
-                             face_names=face_names,
-                             face_locations=face_locations,
-                             ocr_text=ocr_text)
+        with metrics.stage('render'):
+            return render_template('index.html', 
+                                 image=next_image, 
+                                 current=current,
+                                 progress=progress, 
+                                 total=total_images,
+                                 categories=categories,
+                                 face_count=len(current['faces']),
+                                 face_names=[face['name'] for face in current['faces']],
+                                 ocr_text=current['ocr_text'],
+                                 display_size=IMAGE_DISPLAY_SIZE,
+                                 face_tile=FACE_TILE_SIZE,
+                                 filters=filters,
+                                 matching=len(queue.candidates) if filters else total_images)
     else:
         logger.info("All images completed, showing completion page")
         return render_template('completed.html', progress=progress, total=total_images)
@@ -410,106 +686,25 @@ def label():
     
     # Update known faces if names were provided
     if face_names and face_encodings:
-        known_faces = load_faces()
         for i, name in enumerate(face_names):
-            if name and name != "Unknown" and i < len(face_encodings):
+            if (name and name != "Unknown" and i < len(face_encodings)
+                    and len(face_encodings[i]) == ENCODING_DIM):
                 # Add to known faces
-                known_faces['encodings'].append(face_encodings[i])
-                known_faces['names'].append(name)
+                face_store.add_face(face_encodings[i], name)
                 logger.info(f"Added new face: {name}")
-        save_faces(known_faces)
-    
-    # Load and update labels dataframe
-    labels_df = load_labels()
-    
-    # Add new label
-    new_row = pd.DataFrame({'filename': [image], 'keep': [label]})
-    labels_df = pd.concat([labels_df, new_row], ignore_index=True)
-    save_labels(labels_df)
-    logger.info(f"Saved label to CSV: {image} -> {label}")
-    
-    # Create symlink in labeled folder if using new architecture
-    labeled_dir = os.path.join(os.getcwd(), 'labeled', label)
-    os.makedirs(labeled_dir, exist_ok=True)
-    
-    # Move file if needed (now we just maintain a symlink)
-    src_path = os.path.join(IMAGES_DIR, image)
-    dst_path = os.path.join(labeled_dir, image)
-    
-    # Remove existing symlink if it exists
-    if os.path.exists(dst_path):
-        try:
-            os.unlink(dst_path)
-            logger.debug(f"Removed existing symlink: {dst_path}")
-        except Exception as e:
-            logger.error(f"Error removing existing symlink: {e}")
     
-    # Create symlink
-    try:
-        if os.name == 'nt':  # Windows
-            import ctypes
-            kdll = ctypes.windll.LoadLibrary("kernel32.dll")
-            # Use Windows API to create symlink
-            flags = 0
-            if os.path.isdir(src_path):
-                flags = 1  # SYMBOLIC_LINK_FLAG_DIRECTORY
-            res = kdll.CreateSymbolicLinkW(dst_path, src_path, flags)
-            if res == 0:
-                logger.error(f"Failed to create symlink: {dst_path} -> {src_path}")
-            else:
-                logger.info(f"Created symlink: {dst_path} -> {src_path}")
-        else:  # Unix/Linux
-            os.symlink(src_path, dst_path)
-            logger.info(f"Created symlink: {dst_path} -> {src_path}")
-    except Exception as e:
-        logger.error(f"Error creating symlink: {e}")
-
-    # Remove from cache to ensure it's reloaded next time
-    if image in image_cache:
-        del image_cache[image]
-        logger.debug(f"Removed {image} from cache")
+    record_label(image, label)
 
     logger.info("Redirecting to index page")
-    return redirect(url_for('index'))
+    return redirect(url_for('index', **request.args))
 
 @app.route('/undo')
 def undo():
     logger.info("=== UNDO REQUEST ===")
-    labels_df = load_labels()
-    
-    if len(labels_df) == 0:
-        logger.info("No labeled images to undo")
-        return redirect(url_for('index'))
-    
-    # Get last labeled image
-    last_row = labels_df.iloc[-1]
-    last_image = last_row['filename']
-    last_label = last_row['keep']
-    
-    logger.info(f"Undoing last label: {last_image} ({last_label})")
-
-    # Remove last row from dataframe
-    labels_df = labels_df.iloc[:-1]
-    save_labels(labels_df)
-    logger.info(f"Removed last entry from labels CSV")
-    
-    # Remove symlink from labeled folder if it exists
-    symlink_path = os.path.join(os.getcwd(), 'labeled', last_label, last_image)
-    
-    if os.path.exists(symlink_path):
-        try:
-            os.unlink(symlink_path)
-            logger.info(f"Removed symlink: {symlink_path}")
-        except Exception as e:
-            logger.error(f"Error removing symlink: {e}")
-    
-    # Remove from cache to ensure fresh load
-    if last_image in image_cache:
-        del image_cache[last_image]
-        logger.debug(f"Removed {last_image} from cache")
+    revert_last_label()
 
     logger.info("Redirecting to index page")
-    return redirect(url_for('index'))
+    return redirect(url_for('index', **request.args))
 
 @app.route('/categories')
 def manage_categories():
@@ -524,21 +719,22 @@ def add_category():
     data = request.get_json()
     logger.info(f"Adding category: {data}")
     
-    categories = load_categories()
-    
-    category_id = data['id'].lower().replace(' ', '_')
-    if category_id not in categories:
-        categories[category_id] = {
-            'name': data['name'],
-            'key': data['key']
-        }
-        save_categories(categories)
-        ensure_category_folders()
-        logger.info(f"Successfully added category: {category_id}")
-        return jsonify({'success': True})
-    else:
-        logger.warning(f"Category already exists: {category_id}")
-        return jsonify({'success': False, 'error': 'Category already exists'})
+    with categories_lock:
+        categories = load_categories()
+        
+        category_id = data['id'].lower().replace(' ', '_')
+        if category_id not in categories:
+            categories[category_id] = {
+                'name': data['name'],
+                'key': data['key']
+            }
+            save_categories(categories)
+            labeled_tree_sync.reconcile()
+            logger.info(f"Successfully added category: {category_id}")
+            return jsonify({'success': True})
+        else:
+            logger.warning(f"Category already exists: {category_id}")
+            return jsonify({'success': False, 'error': 'Category already exists'})
 
 @app.route('/categories/delete', methods=['POST'])
 def delete_category():
@@ -546,17 +742,19 @@ def delete_category():
     data = request.get_json()
     logger.info(f"Deleting category: {data}")
     
-    categories = load_categories()
-    
-    category_id = data['id']
-    if category_id in categories and len(categories) > 1:  # Keep at least one category
-        del categories[category_id]
-        save_categories(categories)
-        logger.info(f"Successfully deleted category: {category_id}")
-        return jsonify({'success': True})
-    else:
-        logger.warning(f"Cannot delete category: {category_id} (not found or last category)")
-        return jsonify({'success': False, 'error': 'Cannot delete category'})
+    with categories_lock:
+        categories = load_categories()
+        
+        category_id = data['id']
+        if category_id in categories and len(categories) > 1:  # Keep at least one category
+            del categories[category_id]
+            save_categories(categories)
+            labeled_tree_sync.reconcile()
+            logger.info(f"Successfully deleted category: {category_id}")
+            return jsonify({'success': True})
+        else:
+            logger.warning(f"Cannot delete category: {category_id} (not found or last category)")
+            return jsonify({'success': False, 'error': 'Cannot delete category'})
 
 @app.route('/categories/update', methods=['POST'])
 def update_category():
@@ -564,31 +762,49 @@ def update_category():
     data = request.get_json()
     logger.info(f"Updating category: {data}")
     
-    categories = load_categories()
-    
-    category_id = data['id']
-    if category_id in categories:
-        categories[category_id].update({
-            'name': data['name'],
-            'key': data['key']
-        })
-        save_categories(categories)
-        logger.info(f"Successfully updated category: {category_id}")
-        return jsonify({'success': True})
-    else:
-        logger.warning(f"Category not found for update: {category_id}")
-        return jsonify({'success': False, 'error': 'Category not found'})
+    with categories_lock:
+        categories = load_categories()
+        
+        category_id = data['id']
+        if category_id in categories:
+            categories[category_id].update({
+                'name': data['name'],
+                'key': data['key']
+            })
+            save_categories(categories)
+            labeled_tree_sync.reconcile()
+            logger.info(f"Successfully updated category: {category_id}")
+            return jsonify({'success': True})
+        else:
+            logger.warning(f"Category not found for update: {category_id}")
+            return jsonify({'success': False, 'error': 'Category not found'})
 
 # Serve images from cache directory
 @app.route('/image/<filename>')
 def serve_image(filename):
     logger.debug(f"=== IMAGE REQUEST: {filename} ===")
-    from flask import send_file, Response
     
     try:
         file_path = os.path.join(IMAGES_DIR, filename)
-        logger.debug(f"Serving from path: {file_path}")
-        return send_file(file_path)
+        stamp = file_stamp(file_path)
+        if stamp is None:
+            logger.error(f"Image not found: {filename}")
+            return "Image not found", 404
+        last_modified = stamp[0] / 1e9
+        
+        # ?size=N serves a resized derivative generated once and cached on disk
+        size = derivative_cache.normalize_size(request.args.get('size', type=int))
+        if size:
+            path = derivative_cache.get(filename, size)
+            return send_file(path, mimetype=derivative_cache.mimetype, conditional=True,
+                             etag=derivative_cache.etag(filename, size, stamp),
+                             last_modified=last_modified, max_age=0)
+        
+        data = load_image_bytes(filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return send_file(BytesIO(data), mimetype=mimetype, conditional=True,
+                         etag=f"{stamp[0]:x}-{stamp[1]:x}",
+                         last_modified=last_modified, max_age=0)
     except FileNotFoundError:
         logger.error(f"Image not found: {filename}")
         return "Image not found", 404
@@ -596,57 +812,280 @@ def serve_image(filename):
         logger.error(f"Error serving image {filename}: {e}")
         return "Error serving image", 500
 
-# API endpoint to get next image info for preloading
+# Image cache counters for monitoring
+@app.route('/api/cache-stats')
+def cache_stats_api():
+    return jsonify(image_cache.stats())
+
+@metrics.collector
+def _collect_app_state():
+    """Cache counters and queue/store sizes, read at scrape time"""
+    tiers = image_cache.stats()
+    def per_tier(key):
+        return [({'tier': tier}, stats[key]) for tier, stats in tiers.items()]
+    return [
+        ('app_image_cache_hits_total', 'counter', "Image cache hits per tier", per_tier('hits')),
+        ('app_image_cache_misses_total', 'counter', "Image cache misses per tier", per_tier('misses')),
+        ('app_image_cache_evictions_total', 'counter', "Image cache evictions per tier", per_tier('evictions')),
+        ('app_image_cache_hit_ratio', 'gauge', "Image cache hit rate per tier", per_tier('hit_rate')),
+        ('app_image_cache_bytes', 'gauge', "Bytes held per image cache tier", per_tier('bytes')),
+        ('app_images_total', 'gauge', "Images in the cache directory", [({}, image_queue.total)]),
+        ('app_images_remaining', 'gauge', "Images still to label", [({}, image_queue.remaining)]),
+        ('app_labels_total', 'gauge', "Labelled images", [({}, len(label_store))]),
+        ('app_known_faces', 'gauge', "Rows in the known face store", [({}, len(face_store))]),
+        ('app_face_cache_images', 'gauge', "Images with a cached face analysis", [({}, len(face_cache))]),
+        ('app_ocr_documents', 'gauge', "OCR files in the search index", [({}, len(ocr_index))]),
+    ]
+
+@metrics.collector
+def _collect_sync_metrics():
+    """Per-channel stats written by worker.py after each run"""
+    channels = sync_metrics_state.get() or {}
+    last = []
+    totals = []
+    for channel, entry in sorted(channels.items()):
+        last.extend(({'channel': channel, 'stat': stat}, value) for stat, value in entry.get('last', {}).items())
+        totals.extend(({'channel': channel, 'stat': stat}, value) for stat, value in entry.get('totals', {}).items())
+    finished = [({'channel': channel}, entry.get('finished', 0)) for channel, entry in sorted(channels.items())]
+    return [
+        ('sync_channel_last', 'gauge', "Stats of the last worker.py run per channel", last),
+        ('sync_channel_total', 'counter', "Stats summed over worker.py runs per channel", totals),
+        ('sync_channel_last_run_timestamp_seconds', 'gauge', "When the channel last ran", finished),
+    ]
+
+# Prometheus text exposition of the metrics above (per process)
+@app.route('/metrics')
+def metrics_api():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Last-sync status of the worker.py --daemon process
+@app.route('/api/sync-status')
+def sync_status_api():
+    status = sync_status_state.get()
+    if status is None:
+        return jsonify({'state': 'unknown', 'running': False})
+    status = dict(status)
+    status['age'] = time.time() - status.get('updated', 0)
+    status['running'] = status.get('state') != 'stopped' and status['age'] < SYNC_STATUS_STALE_AFTER
+    return jsonify(status)
+
+# JSON labelling API: the page keeps a few image descriptors buffered and
+# swaps images client-side instead of the POST/redirect/render cycle
 @app.route('/api/next-image')
+@app.route('/api/next-images')
 def get_next_image_api():
     logger.debug("=== NEXT IMAGE API REQUEST ===")
-    labeled = load_labeled_images()
-    next_images = get_next_images(labeled, 3)
+    count = min(max(request.args.get('count', 3, type=int), 1), 10)
+    # Images the client already holds (including ones whose labels are still in flight)
+    exclude = set(request.args.getlist('exclude'))
+    try:
+        queue = current_queue()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    next_images = [f for f in queue.peek(count + len(exclude)) if f not in exclude][:count]
+    
+    # Only the image about to be shown may wait for face detection
+    matcher = get_face_matcher()
+    images = [describe_image(f, matcher, analyse=(i == 0 and not exclude))
+              for i, f in enumerate(next_images)]
     cache_status = {img: img in image_cache for img in next_images}
+    faces_status = {d['filename']: not d['faces_pending'] for d in images}
     
     logger.info(f"API returning {len(next_images)} next images")
     logger.debug(f"Cache status: {cache_status}")
     
-    return jsonify({
+    response = {
+        'images': images,
         'next_images': next_images,
-        'cache_status': cache_status
+        'cache_status': cache_status,
+        'faces_status': faces_status
+    }
+    response.update(queue_status())
+    if queue is not image_queue:
+        response['matching'] = len(queue.candidates)
+    return jsonify(response)
+
+# Full-text search over the OCR text of the cached images
+@app.route('/api/search')
+def search_api():
+    start = time.perf_counter()
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 50, type=int), 1), SEARCH_MAX_RESULTS)
+    unlabelled_only = request.args.get('unlabelled', '').lower() in ('1', 'true', 'yes')
+    if not query:
+        return jsonify({"success": False, "error": "Missing search query"}), 400
+
+    results = []
+    # Over-fetch when filtering so a page of unlabelled matches is still returned
+    for stem, snippet in ocr_index.search(query, limit=SEARCH_MAX_RESULTS if unlabelled_only else limit):
+        filename = image_queue.image_for_stem(stem)
+        if filename is None:
+            continue
+        labelled = filename not in image_queue
+        if unlabelled_only and labelled:
+            continue
+        results.append({'filename': filename, 'snippet': snippet, 'labelled': labelled})
+        if len(results) >= limit:
+            break
+
+    return jsonify({
+        'success': True,
+        'query': query,
+        'results': results,
+        'count': len(results),
+        'elapsed_ms': (time.perf_counter() - start) * 1000
     })
 
+@app.route('/api/image/<filename>')
+def image_api(filename):
+    logger.debug(f"=== IMAGE API REQUEST: {filename} ===")
+    if file_stamp(os.path.join(IMAGES_DIR, filename)) is None:
+        return jsonify({"success": False, "error": "Image not found"}), 404
+    return jsonify(describe_image(filename, get_face_matcher()))
+
+@app.route('/api/label', methods=['POST'])
+def label_api():
+    logger.info("=== LABEL API REQUEST ===")
+    data = request.get_json(silent=True) or {}
+    image = data.get('filename')
+    label = data.get('label')
+    if not image or not label:
+        return jsonify({"success": False, "error": "filename and label are required"}), 400
+    if label not in load_categories():
+        return jsonify({"success": False, "error": f"Unknown category: {label}"}), 400
+    if file_stamp(os.path.join(IMAGES_DIR, image)) is None:
+        return jsonify({"success": False, "error": "Image not found"}), 404
+    
+    logger.info(f"Labeling image '{image}' as '{label}'")
+    record_label(image, label)
+    
+    response = {"success": True, "filename": image, "label": label}
+    response.update(queue_status())
+    return jsonify(response)
+
+@app.route('/api/label-batch', methods=['POST'])
+def label_batch_api():
+    """Apply a batch of labelling decisions coalesced by the client
+
+    Body: {"decisions": [{"filename": ..., "label": ..., "faces": [{"id": 0, "name": ...}]}]}
+    Valid decisions are journaled together as one record; each item gets its own status.
+    """
+    logger.info("=== LABEL BATCH API REQUEST ===")
+    data = request.get_json(silent=True) or {}
+    decisions = data.get('decisions')
+    if not isinstance(decisions, list):
+        return jsonify({"success": False, "error": "decisions must be a list"}), 400
+    
+    categories = load_categories()
+    results = []
+    accepted = []
+    for item in decisions:
+        item = item if isinstance(item, dict) else {}
+        image = item.get('filename')
+        label = item.get('label')
+        result = {'filename': image, 'label': label, 'status': 'ok'}
+        if not image or not label:
+            result.update(status='error', error="filename and label are required")
+        elif label not in categories:
+            result.update(status='error', error=f"Unknown category: {label}")
+        elif file_stamp(os.path.join(IMAGES_DIR, image)) is None:
+            result.update(status='error', error="Image not found")
+        else:
+            accepted.append((image, label, item.get('faces') or []))
+        results.append(result)
+    
+    if accepted:
+        record_labels([(image, label) for image, label, _ in accepted])
+    logger.info(f"Applied {len(accepted)} of {len(decisions)} labels in batch")
+    
+    # Face names ride along with the decision; a bad name does not undo the label
+    face_errors = {}
+    for image, _, faces in accepted:
+        for face in faces:
+            name = (face.get('name') or '').strip()
+            if not name or name == "Unknown":
+                continue
+            try:
+                error = assign_face_name(image, int(face.get('id')), name)
+            except Exception as e:
+                logger.error(f"Error assigning name in batch: {e}")
+                error = str(e)
+            if error:
+                face_errors.setdefault(image, []).append({'id': face.get('id'), 'error': error})
+    for result in results:
+        if result['filename'] in face_errors and result['status'] == 'ok':
+            result['face_errors'] = face_errors[result['filename']]
+    
+    response = {"success": len(accepted) == len(decisions), "results": results}
+    response.update(queue_status())
+    return jsonify(response)
+
+@app.route('/api/undo', methods=['POST'])
+def undo_api():
+    logger.info("=== UNDO API REQUEST ===")
+    last = revert_last_label()
+    if last is None:
+        response = {"success": False, "error": "Nothing to undo"}
+    else:
+        last_image, last_label = last
+        response = {
+            "success": True,
+            "filename": last_image,
+            "label": last_label,
+            # The undone image is back at the front of the queue
+            "image": describe_image(last_image, get_face_matcher())
+        }
+    response.update(queue_status())
+    return jsonify(response)
+
 # API endpoints for face recognition
 @app.route('/face/<filename>/<int:face_id>')
 def serve_face(filename, face_id):
     logger.info(f"=== FACE REQUEST: {filename}, face #{face_id} ===")
     try:
-        # Load the image
-        image = load_image(filename)
-        if image is None:
-            logger.error(f"Failed to load image for face extraction: {filename}")
-            return "Image not found", 404
-        
-        # Get face locations
-        face_locations, _ = detect_faces(image, filename)
+        # Face locations come from the face cache; the crop is cut from the cached sprite
+        face_locations, _ = get_face_analysis(filename)
         
         if face_id >= len(face_locations):
             logger.error(f"Face index out of range: {face_id} >= {len(face_locations)}")
             return "Face not found", 404
         
-        # Extract the face
-        face_location = face_locations[face_id]
-        top, right, bottom, left = face_location
-        face_image = image[top:bottom, left:right]
-        
-        # Convert the face to a PIL image and serve it
-        pil_image = Image.fromarray(face_image)
-        img_io = BytesIO()
-        pil_image.save(img_io, 'JPEG')
-        img_io.seek(0)
+        data = face_sprites.crop(filename, face_locations, face_id)
+        if data is None:
+            logger.error(f"Failed to load image for face extraction: {filename}")
+            return "Image not found", 404
         
         logger.info(f"Serving face #{face_id} from {filename}")
-        return send_file(img_io, mimetype='image/jpeg')
+        return send_file(BytesIO(data), mimetype='image/jpeg')
     except Exception as e:
         logger.error(f"Error serving face: {e}")
         return "Error processing face", 500
 
+# All faces of an image in one response: boxes, names and tile offsets in the sprite
+@app.route('/faces/<filename>')
+def faces_api(filename):
+    logger.debug(f"=== FACES REQUEST: {filename} ===")
+    face_locations, face_encodings = get_face_analysis(filename)
+    
+    response = {'filename': filename}
+    response.update(describe_faces(filename, face_locations, face_encodings, get_face_matcher()))
+    return jsonify(response)
+
+@app.route('/faces/<filename>/sprite.jpg')
+def serve_face_sprite(filename):
+    logger.debug(f"=== FACE SPRITE REQUEST: {filename} ===")
+    try:
+        face_locations, _ = get_face_analysis(filename)
+        path = face_sprites.get(filename, face_locations)
+        if path is None:
+            return "No faces", 404
+        stamp = file_stamp(os.path.join(IMAGES_DIR, filename))
+        return send_file(path, mimetype='image/jpeg', conditional=True,
+                         etag=face_sprites.etag(stamp, face_locations), max_age=0)
+    except Exception as e:
+        logger.error(f"Error serving face sprite for {filename}: {e}")
+        return "Error processing faces", 500
+
 @app.route('/assign-name', methods=['POST'])
 def assign_name():
     logger.info("=== ASSIGN NAME REQUEST ===")
@@ -658,41 +1097,14 @@ def assign_name():
         
         logger.info(f"Assigning name {name} to face #{face_id} in {filename}")
         
-        # Load image and get face encoding
-        image = load_image(filename)
-        if image is None:
+        # Get face encoding from the face cache
+        if not os.path.exists(os.path.join(IMAGES_DIR, filename)):
             logger.error(f"Failed to load image: {filename}")
             return jsonify({"success": False, "error": "Image not found"})
         
-        face_locations, face_encodings = detect_faces(image, filename)
-        
-        if face_id >= len(face_locations) or face_id >= len(face_encodings):
-            logger.error(f"Face index out of range: {face_id}")
-            return jsonify({"success": False, "error": "Face not found"})
-        
-        # Add face to known faces
-        known_faces = load_faces()
-        face_encoding = face_encodings[face_id]
-        
-        # Check if this is an update to an existing face
-        updated = False
-        for i, existing_name in enumerate(known_faces['names']):
-            # Compare face with existing faces
-            if face_recognition.compare_faces([known_faces['encodings'][i]], face_encoding, tolerance=0.6)[0]:
-                # Update existing face name
-                known_faces['names'][i] = name
-                updated = True
-                logger.info(f"Updated existing face: {name}")
-                break
-        
-        if not updated:
-            # Add as new face
-            known_faces['encodings'].append(face_encoding)
-            known_faces['names'].append(name)
-            logger.info(f"Added new face: {name}")
-        
-        # Save updated faces
-        save_faces(known_faces)
+        error = assign_face_name(filename, face_id, name)
+        if error:
+            return jsonify({"success": False, "error": error})
         
         return jsonify({"success": True})
     except Exception as e:
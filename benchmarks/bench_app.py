@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Latency of the labelling hot paths on a synthetic cache.
+
+Generates a cache/ (images, OCR text, labels, known faces) in a temporary
+directory, drives the Flask routes through the test client and runs the
+worker.py sync against a local stand-in NAS directory. Reports p50/p95
+latency and throughput per endpoint; --json writes the results so two
+versions can be diffed. A request that takes longer than --timeout seconds
+dumps every thread's stack and aborts the run. face_recognition is replaced by a deterministic stub
+unless --real-faces is given, so dlib is not needed. Run from the repository
+root:
+
+    python benchmarks/bench_app.py
+    python benchmarks/bench_app.py --images 2000 --labels 1000 --known-faces 500 --json after.json
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import atexit
+import faulthandler
+import shutil
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Deterministic face_recognition replacement: 0-2 faces per image depending on
+# its corner pixel, encodings derived from the face position
+FACE_RECOGNITION_STUB = '''
+import numpy as np
+from PIL import Image
+
+
+def load_image_file(path, mode='RGB'):
+    return np.asarray(Image.open(path).convert(mode))
+
+
+def face_locations(image, number_of_times_to_upsample=1, model='hog'):
+    h, w = image.shape[:2]
+    count = int(image[0, 0, 0]) % 3
+    return [(h * (i + 1) // 5, w * (i + 2) // 5, h * (i + 2) // 5, w * (i + 1) // 5) for i in range(count)]
+
+
+def face_encodings(image, known_face_locations=None, num_jitters=1, model='small'):
+    encodings = []
+    for top, right, bottom, left in known_face_locations or []:
+        rng = np.random.default_rng(int(image[top, left].sum()) * 7919 + top)
+        encodings.append(rng.normal(0, 0.1, 128))
+    return encodings
+'''
+
+WORDS = ('receipt', 'invoice', 'birthday', 'holiday', 'school', 'report', 'letter', 'bank',
+         'statement', 'ticket', 'menu', 'passport', 'certificate', 'photo', 'family', 'garden')
+
+
+def install_face_stub(directory):
+    """Make `import face_recognition` load the stub, here and in worker processes"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'face_recognition.py'), 'w') as f:
+        f.write(FACE_RECOGNITION_STUB)
+    sys.path.insert(0, directory)
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [directory, os.environ.get('PYTHONPATH')]))
+
+
+def make_image(path, rng, size):
+    """A JPEG with some structure, so it compresses like a photo rather than noise"""
+    width, height = size
+    image = Image.new('RGB', size, tuple(int(v) for v in rng.integers(0, 256, 3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        w, h = int(rng.integers(width // 20, width // 3)), int(rng.integers(height // 20, height // 3))
+        draw.rectangle([x, y, x + w, y + h], fill=tuple(int(v) for v in rng.integers(0, 256, 3)))
+    image.save(path, quality=85)
+
+
+def make_synthetic_cache(root, images, ocr, labels, known_faces, size, seed):
+    """Populate root/cache like a synced laptop; returns the image filenames"""
+    from face_store import FaceStore
+
+    rng = np.random.default_rng(seed)
+    cache_dir = os.path.join(root, 'cache')
+    images_dir = os.path.join(cache_dir, 'images')
+    ocr_dir = os.path.join(cache_dir, 'ocr')
+    os.makedirs(images_dir)
+    os.makedirs(ocr_dir)
+
+    filenames = [f"IMG_{i:06d}.jpg" for i in range(images)]
+    for filename in filenames:
+        make_image(os.path.join(images_dir, filename), rng, size)
+    for filename in filenames[:ocr]:
+        words = rng.choice(WORDS, int(rng.integers(5, 60)))
+        with open(os.path.join(ocr_dir, os.path.splitext(filename)[0] + '.txt'), 'w', encoding='utf-8') as f:
+            f.write(' '.join(words))
+
+    with open(os.path.join(cache_dir, 'labels.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filename', 'keep'])
+        # Label rows beyond the image count stand in for images already removed from the cache
+        for i in range(labels):
+            writer.writerow([f"IMG_{images - 1 - i:06d}.jpg" if i < images else f"OLD_{i:06d}.jpg",
+                             'keep' if i % 3 else 'delete'])
+
+    store = FaceStore(os.path.join(cache_dir, 'faces'))
+    store.load()
+    for i in range(known_faces):
+        store.add_face(rng.normal(0, 0.1, 128).astype(np.float32), f"Person {i % max(known_faces // 3, 1)}")
+    store.compact()
+    return filenames
+
+
+def summarise(name, seconds, errors=0):
+    seconds = np.asarray(seconds) if seconds else np.zeros(1)
+    total = float(seconds.sum())
+    return {
+        'endpoint': name,
+        'requests': len(seconds),
+        'errors': errors,
+        'p50_ms': 1000 * float(np.percentile(seconds, 50)),
+        'p95_ms': 1000 * float(np.percentile(seconds, 95)),
+        'max_ms': 1000 * float(seconds.max()),
+        'per_second': len(seconds) / total if total else 0.0,
+    }
+
+
+class Timer:
+    """Collects per-request latencies and non-2xx/3xx responses per endpoint"""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.seconds = {}
+        self.errors = {}
+
+    def request(self, name, call, *args, **kwargs):
+        if self.timeout:
+            # A hung request (e.g. a deadlock) fails the run instead of stalling it
+            faulthandler.dump_traceback_later(self.timeout, exit=True)
+        start = time.perf_counter()
+        try:
+            response = call(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.timeout:
+                faulthandler.cancel_dump_traceback_later()
+        self.seconds.setdefault(name, []).append(elapsed)
+        if response.status_code >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return response
+
+    def rows(self):
+        return [summarise(name, seconds, self.errors.get(name, 0)) for name, seconds in self.seconds.items()]
+
+
+def bench_app(iterations, seed, timeout=None):
+    """Drive the Flask routes; returns result rows"""
+    import app
+
+    rng = random.Random(seed)
+    client = app.app.test_client()
+    timer = Timer(timeout)
+    people = sorted(set(app.face_store.names())) or ['Someone']
+
+    try:
+        # Label through the queue the way the fallback form does, then undo it all again
+        labelled = 0
+        for _ in range(iterations):
+            timer.request('index', client.get, '/')
+            image = app.image_queue.next()
+            if image is None:
+                break
+            timer.request('label', client.post, '/label', data={'image': image, 'label': 'keep'})
+            labelled += 1
+        for _ in range(labelled):
+            timer.request('undo', client.get, '/undo')
+
+        for _ in range(iterations):
+            timer.request('next_images', client.get, '/api/next-images?count=5')
+
+        images = app.image_queue.peek(iterations)
+        for image in images:
+            timer.request('serve_image', client.get, f'/image/{image}')
+        for image in images:
+            timer.request('serve_image_resized_cold', client.get, f'/image/{image}?size={app.IMAGE_DISPLAY_SIZE}')
+        for image in images:
+            timer.request('serve_image_resized', client.get, f'/image/{image}?size={app.IMAGE_DISPLAY_SIZE}')
+
+        with_faces = [image for image in images if app.get_face_analysis(image)[0]]
+        for image in with_faces:
+            timer.request('serve_face', client.get, f'/face/{image}/0')
+        for image in with_faces:
+            timer.request('assign_name', client.post, '/assign-name',
+                          json={'filename': image, 'face_id': 0, 'name': rng.choice(people)})
+    finally:
+        app.face_precomputer.shutdown()
+    return timer.rows()
+
+
+def bench_sync(root, workers, new_fraction, seed):
+    """worker.py sync against a stand-in NAS directory; returns result rows"""
+    import worker
+
+    nas = os.path.join(root, 'nas')
+    laptop = os.path.join(root, 'laptop', 'cache')
+    photos = os.path.join(nas, worker.NAS_PHOTOS)
+    shutil.copytree(os.path.join(root, 'cache', 'images'), photos)
+    shutil.copytree(os.path.join(root, 'cache', 'ocr'), os.path.join(nas, worker.NAS_OCR))
+    os.makedirs(os.path.join(nas, worker.NAS_LABELS))
+    os.makedirs(os.path.join(nas, worker.NAS_FACES))
+
+    # Point the worker at a second, empty laptop cache instead of the repository's
+    worker.CACHE_DIR = laptop
+    worker.IMAGES_DIR = os.path.join(laptop, 'images')
+    worker.OCR_DIR = os.path.join(laptop, 'ocr')
+    worker.OCR_INDEX_DB = os.path.join(laptop, 'ocr_index.sqlite')
+    worker.LABELS_CSV = os.path.join(laptop, 'labels.csv')
+    worker.LABELS_JOURNAL = os.path.join(laptop, 'labels.journal')
+    worker.FACES_DIR = os.path.join(laptop, 'faces')
+    worker.SYNC_STATE_DIR = os.path.join(laptop, 'sync')
+    worker.SYNC_STATUS_JSON = os.path.join(laptop, 'sync_status.json')
+    worker.SYNC_METRICS_JSON = os.path.join(laptop, 'sync_metrics.json')
+    worker._ocr_index = None
+    worker.ensure_dirs()
+
+    def run(name):
+        files = sum(len(files) for _, _, files in os.walk(nas))
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(nas) for f in fs)
+        start = time.perf_counter()
+        ok = worker.sync_files(nas, workers=workers, check_network=False)
+        elapsed = time.perf_counter() - start
+        return {'endpoint': name, 'requests': 1, 'errors': 0 if ok else 1,
+                'p50_ms': 1000 * elapsed, 'p95_ms': 1000 * elapsed, 'max_ms': 1000 * elapsed,
+                'per_second': 1 / elapsed if elapsed else 0.0,
+                'nas_files': files, 'nas_mb': size / 1e6}
+
+    rows = [run('sync_cold'), run('sync_noop')]
+    existing = sorted(os.listdir(photos))
+    rng = random.Random(seed)
+    for filename in rng.sample(existing, max(1, int(len(existing) * new_fraction))):
+        shutil.copy2(os.path.join(photos, filename), os.path.join(photos, 'NEW_' + filename))
+    rows.append(run('sync_incremental'))
+    if getattr(worker, '_ocr_index', None) is not None:
+        worker._ocr_index.close()
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the labelling app on a synthetic cache")
+    parser.add_argument('--images', type=int, default=300)
+    parser.add_argument('--ocr', type=int, help="OCR files (default: one per image)")
+    parser.add_argument('--labels', type=int, help="Label rows (default: a third of the images)")
+    parser.add_argument('--known-faces', type=int, default=100)
+    parser.add_argument('--size', type=int, nargs=2, default=[2400, 1800], metavar=('W', 'H'))
+    parser.add_argument('--iterations', type=int, default=50, help="Requests per endpoint")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="Seconds before a single request is considered hung (0: no limit)")
+    parser.add_argument('--workers', type=int, default=4, help="Sync copy workers")
+    parser.add_argument('--new-fraction', type=float, default=0.1,
+                        help="Share of photos added to the NAS before the incremental sync")
+    parser.add_argument('--real-faces', action='store_true',
+                        help="Use the installed face_recognition instead of the stub")
+    parser.add_argument('--no-sync', action='store_true', help="Skip the worker.py sync benchmark")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary directory")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args(argv)
+    ocr = args.images if args.ocr is None else args.ocr
+    labels = args.images // 3 if args.labels is None else args.labels
+
+    root = tempfile.mkdtemp(prefix='bench_app_')
+    if not args.keep:
+        # Registered before the app is imported so it runs after the app's own exit handlers
+        atexit.register(shutil.rmtree, root, ignore_errors=True)
+    if not args.real_faces:
+        install_face_stub(os.path.join(root, 'stub'))
+    print(f"Generating {args.images} images, {ocr} OCR files, {labels} labels, "
+          f"{args.known_faces} known faces in {root}...")
+    start = time.perf_counter()
+    make_synthetic_cache(root, args.images, ocr, labels, args.known_faces, tuple(args.size), args.seed)
+    print(f"Generated in {time.perf_counter() - start:.1f}s")
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        # The app and worker log every request; keep the output to the results
+        logging.disable(logging.INFO)
+        startup = time.perf_counter()
+        import app  # noqa: F401  (paths are taken from the working directory at import)
+        rows = [summarise('startup', [time.perf_counter() - startup])]
+        rows += bench_app(args.iterations, args.seed, args.timeout)
+        if not args.no_sync:
+            rows += bench_sync(root, args.workers, args.new_fraction, args.seed)
+    finally:
+        logging.disable(logging.NOTSET)
+        os.chdir(cwd)
+
+    print(f"{'endpoint':<26}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'req/s':>9}")
+    for row in rows:
+        print(f"{row['endpoint']:<26}{row['requests']:>9}{row['errors']:>8}{row['p50_ms']:>10.1f}"
+              f"{row['p95_ms']:>10.1f}{row['max_ms']:>10.1f}{row['per_second']:>9.1f}")
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != 'json'}
+        config.update(ocr=ocr, labels=labels)
+        with open(args.json, 'w') as f:
+            json.dump({'config': config, 'results': rows}, f, indent=2)
+        print(f"Wrote {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Speed vs. recall of downscaled face detection.
+
+Runs full-resolution detection on a sample of images as the reference, then
+each downscaled max dimension, and reports per-image time and recall (share
+of reference faces found again with IoU >= 0.5), plus how far encodings drift
+from the reference ones. Run from the repository root:
+
+    python benchmarks/bench_detection.py --images cache/images --sample 50
+    python benchmarks/bench_detection.py --dimensions 800 1200 1600 --json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import face_analysis  # noqa: E402
+from image_queue import is_image_file  # noqa: E402
+
+
+def iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - inter
+    return inter / union if union > 0 else 0.0
+
+
+def match_faces(reference, candidate, threshold=0.5):
+    """Pairs (reference index, candidate index) matched greedily by IoU"""
+    pairs = []
+    used = set()
+    for i, ref_box in enumerate(reference):
+        best, best_iou = None, threshold
+        for j, box in enumerate(candidate):
+            if j in used:
+                continue
+            overlap = iou(ref_box, box)
+            if overlap >= best_iou:
+                best, best_iou = j, overlap
+        if best is not None:
+            used.add(best)
+            pairs.append((i, best))
+    return pairs
+
+
+def run_setting(images, max_dimension, encode_from_original):
+    """Per-image seconds, locations and encodings for one configuration"""
+    results = []
+    for image in images:
+        timings = {}
+        start = time.perf_counter()
+        locations, encodings = face_analysis.detect_and_encode(
+            image, timings, max_dimension=max_dimension, encode_from_original=encode_from_original)
+        results.append((time.perf_counter() - start, locations, encodings, timings))
+    return results
+
+
+def summarise(name, results, reference):
+    seconds = [r[0] for r in results]
+    ref_faces = sum(len(r[1]) for r in reference)
+    found = 0
+    drift = []
+    for (_, ref_locs, ref_encs, _), (_, locs, encs, _) in zip(reference, results):
+        pairs = match_faces(ref_locs, locs)
+        found += len(pairs)
+        drift.extend(float(np.linalg.norm(np.asarray(ref_encs[i]) - np.asarray(encs[j]))) for i, j in pairs)
+    stage_totals = {}
+    for _, _, _, timings in results:
+        for stage, value in timings.items():
+            stage_totals[stage] = stage_totals.get(stage, 0.0) + value
+    return {
+        'setting': name,
+        'images': len(results),
+        'mean_ms': 1000 * float(np.mean(seconds)),
+        'p95_ms': 1000 * float(np.percentile(seconds, 95)),
+        'faces': sum(len(r[1]) for r in results),
+        'reference_faces': ref_faces,
+        'recall': found / ref_faces if ref_faces else 1.0,
+        'mean_encoding_drift': float(np.mean(drift)) if drift else 0.0,
+        'stage_ms': {stage: 1000 * value / len(results) for stage, value in stage_totals.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark downscaled face detection")
+    parser.add_argument('--images', default=os.path.join('cache', 'images'))
+    parser.add_argument('--sample', type=int, default=30, help="Number of images to sample")
+    parser.add_argument('--dimensions', type=int, nargs='+', default=[800, 1200, 1600, 2400])
+    parser.add_argument('--encode-from-small', action='store_true',
+                        help="Also compute encodings from the downscaled copy")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args(argv)
+
+    if not face_analysis.FACE_RECOGNITION_AVAILABLE:
+        print("face_recognition module not found; install with: pip install face-recognition")
+        return 1
+
+    filenames = sorted(f for f in os.listdir(args.images) if is_image_file(f))
+    random.Random(args.seed).shuffle(filenames)
+    filenames = filenames[:args.sample]
+    print(f"Loading {len(filenames)} images from {args.images}...")
+    images = [face_analysis.load_image_file(os.path.join(args.images, f)) for f in filenames]
+    megapixels = np.mean([im.shape[0] * im.shape[1] / 1e6 for im in images]) if images else 0
+    print(f"Mean size {megapixels:.1f} MP")
+
+    reference = run_setting(images, 0, True)
+    rows = [summarise('full', reference, reference)]
+    for dimension in args.dimensions:
+        rows.append(summarise(f"max {dimension}", run_setting(images, dimension, True), reference))
+        if args.encode_from_small:
+            rows.append(summarise(f"max {dimension} (small enc)",
+                                  run_setting(images, dimension, False), reference))
+
+    print(f"{'setting':<22}{'mean ms':>10}{'p95 ms':>10}{'speedup':>9}{'faces':>7}{'recall':>8}{'drift':>8}")
+    base = rows[0]['mean_ms'] or 1.0
+    for row in rows:
+        print(f"{row['setting']:<22}{row['mean_ms']:>10.0f}{row['p95_ms']:>10.0f}"
+              f"{base / row['mean_ms'] if row['mean_ms'] else 0:>8.1f}x{row['faces']:>7}"
+              f"{row['recall']:>8.2f}{row['mean_encoding_drift']:>8.3f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'images': filenames, 'megapixels': megapixels, 'results': rows}, f, indent=2)
+        print(f"Wrote {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Time from process start to the first image being served.
+
+Generates a synthetic cache (see bench_app.py) with every image already in
+the face cache, then starts the app in fresh processes and measures the
+import of app.py, the first GET / and the first image request. Each run is
+done cold (no warm-state snapshot: the label index, queue, face cache index
+and OCR listing are rebuilt from the files) and warm (snapshot left by the
+previous process). The face_recognition stub sleeps on import to stand in for
+loading dlib and its models. Pass --repo to time another checkout on the same
+cache, e.g. the commit before the warm-state snapshot. Run from the
+repository root:
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --images 20000 --labels 15000 --repo ../AI-Classifier-before
+"""
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_app import FACE_RECOGNITION_STUB, make_synthetic_cache  # noqa: E402
+
+# Runs in the child process; prints one JSON line of timings in seconds
+CHILD = '''
+import time
+start = time.perf_counter()
+import os, re, sys, json, logging
+sys.path.insert(0, {repo!r})
+logging.disable(logging.INFO)
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+page = client.get('/')
+paged = time.perf_counter()
+match = re.search(r'/image/([^"\\'?\\\\]+)', page.get_data(as_text=True))
+image = client.get('/image/' + match.group(1) + '?size=1600') if match else None
+done = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'first_page': paged - start, 'first_image': done - start,
+                  'status': [page.status_code, image.status_code if image is not None else None]}}))
+'''
+
+
+def seed_face_cache(root, filenames, seed):
+    """Record an analysis for every image, as after a previous session"""
+    from face_cache import FaceCache
+    from face_analysis import detection_tag
+    from state import file_stamp
+
+    rng = np.random.default_rng(seed)
+    images_dir = os.path.join(root, 'cache', 'images')
+    cache = FaceCache(os.path.join(root, 'cache', 'face_cache.bin'), tag=detection_tag())
+    for filename in filenames:
+        count = int(rng.integers(0, 3))
+        locations = np.tile(np.array([[10, 60, 60, 10]]), (count, 1))
+        cache.put(filename, file_stamp(os.path.join(images_dir, filename)), locations,
+                  rng.normal(0, 0.1, (count, 128)))
+    cache.close()
+
+
+def drop_warm_state(root):
+    """Remove the snapshot and the OCR index's remembered listing"""
+    shutil.rmtree(os.path.join(root, 'cache', 'warm_state'), ignore_errors=True)
+    db_path = os.path.join(root, 'cache', 'ocr_index.sqlite')
+    if os.path.exists(db_path):
+        db = sqlite3.connect(db_path)
+        try:
+            with db:
+                db.execute("DELETE FROM meta WHERE key = 'dir_mtime'")
+        except sqlite3.OperationalError:
+            pass
+        db.close()
+
+
+def run_child(root, repo, env):
+    result = subprocess.run([sys.executable, '-c', CHILD.format(repo=repo)], cwd=root, env=env,
+                            capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(f"App process failed:\n{result.stderr[-2000:]}")
+    return json.loads(lines[-1])
+
+
+def bench_startup(root, repo, repeats, env):
+    """{'cold': [timings], 'warm': [timings]} for one checkout"""
+    results = {'cold': [], 'warm': []}
+    for _ in range(repeats):
+        drop_warm_state(root)
+        results['cold'].append(run_child(root, repo, env))
+        # The cold run left a snapshot behind on exit
+        results['warm'].append(run_child(root, repo, env))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark app startup and time to first image")
+    parser.add_argument('--images', type=int, default=5000)
+    parser.add_argument('--ocr', type=int, help="OCR files (default: one per image)")
+    parser.add_argument('--labels', type=int, help="Label rows (default: half of the images)")
+    parser.add_argument('--known-faces', type=int, default=100)
+    parser.add_argument('--size', type=int, nargs=2, default=[320, 240], metavar=('W', 'H'))
+    parser.add_argument('--stub-import-delay', type=float, default=2.0,
+                        help="Seconds the face_recognition stub takes to import (dlib model load)")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--repo', action='append', default=[],
+                        help="Checkout to benchmark (repeatable; default: this one)")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary directory")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Write results to this file")
+    args = parser.parse_args(argv)
+    ocr = args.images if args.ocr is None else args.ocr
+    labels = args.images // 2 if args.labels is None else args.labels
+    repos = [os.path.abspath(repo) for repo in args.repo] or [REPO_DIR]
+
+    root = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        stub_dir = os.path.join(root, 'stub')
+        os.makedirs(stub_dir)
+        with open(os.path.join(stub_dir, 'face_recognition.py'), 'w') as f:
+            f.write(f"import time\ntime.sleep({args.stub_import_delay!r})\n" + FACE_RECOGNITION_STUB)
+        env = dict(os.environ, SERVER_TIMING='0',
+                   PYTHONPATH=os.pathsep.join(filter(None, [stub_dir, os.environ.get('PYTHONPATH')])))
+
+        print(f"Generating {args.images} images, {ocr} OCR files, {labels} labels in {root}...")
+        filenames = make_synthetic_cache(root, args.images, ocr, labels, args.known_faces,
+                                         tuple(args.size), args.seed)
+        seed_face_cache(root, filenames, args.seed)
+
+        rows = []
+        for repo in repos:
+            print(f"Timing {repo} ({args.repeats} cold and warm starts)...")
+            for mode, runs in bench_startup(root, repo, args.repeats, env).items():
+                row = {'repo': repo, 'mode': mode, 'runs': len(runs)}
+                for key in ('import', 'first_page', 'first_image'):
+                    row[f"{key}_ms"] = 1000 * statistics.median(run[key] for run in runs)
+                row['status'] = runs[-1]['status']
+                rows.append(row)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print(f"{'repo':<40}{'mode':<6}{'import ms':>11}{'first page ms':>15}{'first image ms':>16}")
+    for row in rows:
+        print(f"{row['repo'][-39:]:<40}{row['mode']:<6}{row['import_ms']:>11.0f}"
+              f"{row['first_page_ms']:>15.0f}{row['first_image_ms']:>16.0f}")
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != 'json'}
+        config.update(ocr=ocr, labels=labels)
+        with open(args.json, 'w') as f:
+            json.dump({'config': config, 'results': rows}, f, indent=2)
+        print(f"Wrote {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
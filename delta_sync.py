@@ -0,0 +1,398 @@
+"""
+Delta push of labels and faces to the NAS, and the merge of all machines.
+
+Instead of uploading labels.csv and the faces store whole, each labelling
+machine appends only what the NAS has not seen yet to files of its own:
+
+    labels/journals/<machine>.jsonl      label journal records, by sequence number
+    known_faces/machines/<machine>.encodings   raw float32 (n, 128) face rows
+    known_faces/machines/<machine>.person_ids  raw int32 person id per row
+                                               (rewritten in place when a face
+                                               is moved to another person)
+    known_faces/machines/<machine>.people.json person id -> name
+
+What to send is read back from the NAS files themselves (last sequence
+number, row count), so a push interrupted half way is simply resumed. The
+local ack file tells the label store which journal records it may drop; if
+it is gone while the NAS has records from this machine, the local labels
+were wiped and are sent again as a snapshot numbered past the NAS's records.
+
+After pushing, the per-machine files are merged deterministically into
+labels/labels.csv and known_faces/faces_merged.npz: label records are
+applied in (timestamp, machine, seq) order, last decision wins, and an undo
+withdraws its machine's label for the file, leaving it unlabelled as the
+local undo does (another machine's decision for it, if any, applies again).
+Every machine computes the same result from the same files, so concurrent
+merges are harmless.
+"""
+
+import io
+import os
+import re
+import csv
+import json
+import time
+import socket
+import logging
+
+import numpy as np
+
+from face_store import FaceStore, ENCODING_DIM
+from label_store import LabelStore, CSV_COLUMNS
+from state import file_stamp, FileLock
+
+logger = logging.getLogger(__name__)
+
+MACHINE_ID = re.sub(r'[^A-Za-z0-9_.-]', '_', os.environ.get('SYNC_MACHINE_ID') or socket.gethostname())
+
+JOURNALS_DIR = 'journals'
+MACHINES_DIR = 'machines'
+MERGED_LABELS = 'labels.csv'
+MERGED_FACES = 'faces_merged.npz'
+
+_ROW_BYTES = ENCODING_DIM * 4
+_TAIL_BYTES = 64 * 1024
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{MACHINE_ID}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _append(path, data):
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_records(path, after_seq=None):
+    """Complete JSON records of a journal file, optionally only those after a sequence number"""
+    records = []
+    try:
+        with open(path, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(raw)
+                except ValueError:
+                    break
+                if after_seq is None or record.get('seq', 0) > after_seq:
+                    records.append(record)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def remote_last_seq(path):
+    """Sequence number of the last complete record in a NAS journal, dropping a torn tail
+
+    Returns None if the file does not exist.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+    with open(path, 'rb+') as f:
+        f.seek(max(0, size - _TAIL_BYTES))
+        tail = f.read()
+        if tail and not tail.endswith(b'\n'):
+            # An earlier push died mid-write; cut the partial record off
+            size = size - len(tail) + tail.rfind(b'\n') + 1
+            logger.warning(f"Truncating torn record at end of {path}")
+            f.truncate(size)
+
+        # Read further back until the tail holds a whole record (records can be large snapshots)
+        chunk = _TAIL_BYTES
+        while True:
+            start = max(0, size - chunk)
+            f.seek(start)
+            lines = f.read(size - start).split(b'\n')
+            if start:
+                # Probably cut off in the middle
+                lines = lines[1:]
+            for raw in reversed(lines):
+                try:
+                    return json.loads(raw).get('seq', 0)
+                except ValueError:
+                    continue
+            if not start:
+                return 0
+            chunk *= 4
+
+
+def _write_ack(ack_path, seq):
+    os.makedirs(os.path.dirname(ack_path), exist_ok=True)
+    _write_atomic(ack_path, json.dumps({'seq': seq, 'machine': MACHINE_ID, 'time': time.time()}).encode('utf-8'))
+
+
+def _snapshot_record(csv_path, journal_path, after=0):
+    """The current labels as one record, for a machine's first push or after its labels were reset
+
+    labels.csv already holds the effect of journal records that compaction
+    kept (they wait for the ack), so the CSV and the journal are sent as one
+    snapshot carrying the journal's last sequence number; only later records
+    are pushed on top of it, and none is counted twice. If the NAS already
+    holds records up to `after` from an earlier life of this machine's
+    labels, the snapshot is numbered past them instead.
+    """
+    store = LabelStore(csv_path, journal_path, read_only=True)
+    if not len(store):
+        return None
+    labels = [[filename, '' if label is None else label] for filename, label in store.items()]
+    stamp = file_stamp(csv_path)
+    ts = max([stamp[0] / 1e9 if stamp else 0] + [r.get('ts', 0) for r in read_records(journal_path, after_seq=0)])
+    seq = max(store.seq, after + 1) if after else store.seq
+    return {'op': 'snapshot', 'labels': labels, 'seq': seq, 'ts': ts}
+
+
+def push_labels(csv_path, journal_path, ack_path, nas_labels_dir, machine=MACHINE_ID):
+    """Append this machine's label records the NAS has not seen yet"""
+    journals = os.path.join(nas_labels_dir, JOURNALS_DIR)
+    os.makedirs(journals, exist_ok=True)
+    remote = os.path.join(journals, f"{machine}.jsonl")
+
+    last = remote_last_seq(remote)
+    sent = 0
+    if last is None or not os.path.exists(ack_path):
+        if last is not None:
+            # The ack lives next to the labels, so they were wiped too and their
+            # sequence numbers started again below what the NAS already has
+            logger.warning(f"NAS has label records up to seq {last} from {machine} but no push is "
+                           f"recorded locally, sending the local labels as a new snapshot")
+        # With the store's writers held off, snapshot its labels and raise its
+        # sequence numbers past the snapshot through the ack before they resume
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        with FileLock(journal_path + '.lock'):
+            snapshot = _snapshot_record(csv_path, journal_path, after=last or 0)
+            if snapshot is not None:
+                _append(remote, (json.dumps(snapshot, separators=(',', ':')) + '\n').encode('utf-8'))
+                sent = 1
+            last = snapshot['seq'] if snapshot is not None else last or 0
+            _write_ack(ack_path, last)
+
+    records = [r for r in read_records(journal_path, after_seq=last) if r.get('op') != 'mark']
+    if records:
+        data = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records)
+        _append(remote, data.encode('utf-8'))
+        last = max(last, max(r.get('seq', 0) for r in records))
+    if sent or records:
+        logger.info(f"Pushed {sent + len(records)} label records to {remote} (up to seq {last})")
+    _write_ack(ack_path, last)
+    return {'records': sent + len(records), 'seq': last}
+
+
+def merge_labels(nas_labels_dir):
+    """Combine every machine's journal into labels/labels.csv; returns the label count"""
+    journals = os.path.join(nas_labels_dir, JOURNALS_DIR)
+    events = []
+    for name in sorted(os.listdir(journals)) if os.path.isdir(journals) else []:
+        if not name.endswith('.jsonl'):
+            continue
+        machine = name[:-len('.jsonl')]
+        for record in read_records(os.path.join(journals, name)):
+            events.append((record.get('ts', 0), machine, record.get('seq', 0), record))
+    events.sort(key=lambda event: event[:3])
+
+    # filename -> stack of (label, machine) decisions, files in decision order;
+    # an undo drops all of that machine's decisions for the file
+    history = {}
+    for _, machine, _, record in events:
+        op = record.get('op')
+        if op == 'label':
+            decisions = [(record['filename'], record.get('keep'))]
+        elif op in ('batch', 'snapshot'):
+            decisions = record.get('labels', [])
+        elif op == 'undo':
+            stack = [decision for decision in history.pop(record['filename'], []) if decision[1] != machine]
+            if stack:
+                history[record['filename']] = stack
+            continue
+        else:
+            continue
+        for filename, label in decisions:
+            stack = history.pop(filename, [])
+            stack.append((label, machine))
+            history[filename] = stack
+    labels = {filename: stack[-1][0] for filename, stack in history.items()}
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    writer.writerows(labels.items())
+    data = out.getvalue().encode('utf-8')
+
+    merged_path = os.path.join(nas_labels_dir, MERGED_LABELS)
+    try:
+        with open(merged_path, 'rb') as f:
+            unchanged = f.read() == data
+    except FileNotFoundError:
+        unchanged = False
+    if not unchanged:
+        _write_atomic(merged_path, data)
+        logger.info(f"Merged {len(events)} label records from {len(set(e[1] for e in events))} "
+                    f"machines into {merged_path} ({len(labels)} labels)")
+    return len(labels)
+
+
+def _remote_rows(enc_path, pid_path):
+    """Complete rows in a machine's NAS face files, trimming a half-written row"""
+    sizes = [os.path.getsize(p) if os.path.exists(p) else 0 for p in (enc_path, pid_path)]
+    rows = min(sizes[0] // _ROW_BYTES, sizes[1] // 4)
+    for path, size, row_bytes in ((enc_path, sizes[0], _ROW_BYTES), (pid_path, sizes[1], 4)):
+        if size > rows * row_bytes:
+            with open(path, 'rb+') as f:
+                f.truncate(rows * row_bytes)
+    return rows
+
+
+def push_faces(faces_dir, nas_faces_dir, machine=MACHINE_ID):
+    """Append this machine's face rows the NAS has not seen yet, and its name table"""
+    machines = os.path.join(nas_faces_dir, MACHINES_DIR)
+    os.makedirs(machines, exist_ok=True)
+    enc_path = os.path.join(machines, f"{machine}.encodings")
+    pid_path = os.path.join(machines, f"{machine}.person_ids")
+    people_path = os.path.join(machines, f"{machine}.people.json")
+
+    store = FaceStore(faces_dir)
+    local_rows = len(store)
+    remote_rows = _remote_rows(enc_path, pid_path)
+    if remote_rows > local_rows:
+        # The local store was reset; start this machine's NAS copy again
+        logger.warning(f"NAS has {remote_rows} faces from {machine} but only {local_rows} exist locally, re-pushing")
+        for path in (enc_path, pid_path):
+            os.remove(path)
+        remote_rows = 0
+
+    local_person_ids = np.ascontiguousarray(store.person_ids(), dtype='<i4')
+    moved = 0
+    if remote_rows:
+        # Faces moved to another person since they were pushed
+        remote_person_ids = np.fromfile(pid_path, dtype='<i4', count=remote_rows)
+        changed = np.flatnonzero(remote_person_ids != local_person_ids[:remote_rows])
+        if len(changed):
+            with open(pid_path, 'rb+') as f:
+                for row in changed:
+                    f.seek(int(row) * 4)
+                    f.write(local_person_ids[row].tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            moved = len(changed)
+            logger.info(f"Updated the person of {moved} pushed face rows in {machines}")
+
+    new_rows = local_rows - remote_rows
+    if new_rows:
+        encodings = np.ascontiguousarray(store.encodings()[remote_rows:], dtype='<f4')
+        person_ids = local_person_ids[remote_rows:]
+        # Person ids first: a row only counts once its encoding is complete too
+        _append(pid_path, person_ids.tobytes())
+        _append(enc_path, encodings.tobytes())
+        logger.info(f"Pushed {new_rows} face rows to {machines} ({local_rows} total)")
+
+    people = json.dumps({str(pid): name for pid, name in sorted(store.people.items())},
+                        indent=2, sort_keys=True).encode('utf-8')
+    try:
+        with open(people_path, 'rb') as f:
+            people_changed = f.read() != people
+    except FileNotFoundError:
+        people_changed = True
+    if people_changed:
+        _write_atomic(people_path, people)
+    return {'rows': new_rows, 'moved': moved, 'total': local_rows, 'people_changed': people_changed}
+
+
+def merge_faces(nas_faces_dir):
+    """Combine every machine's face rows into known_faces/faces_merged.npz; returns the row count"""
+    machines = os.path.join(nas_faces_dir, MACHINES_DIR)
+    names = sorted(n[:-len('.people.json')] for n in os.listdir(machines)
+                   if n.endswith('.people.json')) if os.path.isdir(machines) else []
+
+    all_encodings = []
+    all_names = []
+    all_machines = []
+    for machine in names:
+        base = os.path.join(machines, machine)
+        with open(f"{base}.people.json", 'r', encoding='utf-8') as f:
+            people = {int(pid): name for pid, name in json.load(f).items()}
+        encodings = np.fromfile(f"{base}.encodings", dtype='<f4') if os.path.exists(f"{base}.encodings") \
+            else np.empty(0, dtype='<f4')
+        person_ids = np.fromfile(f"{base}.person_ids", dtype='<i4') if os.path.exists(f"{base}.person_ids") \
+            else np.empty(0, dtype='<i4')
+        rows = min(len(encodings) // ENCODING_DIM, len(person_ids))
+        all_encodings.append(encodings[:rows * ENCODING_DIM].reshape(rows, ENCODING_DIM))
+        all_names.extend(people.get(int(pid), "Unknown") for pid in person_ids[:rows])
+        all_machines.extend([machine] * rows)
+
+    encodings = np.concatenate(all_encodings) if all_encodings else np.empty((0, ENCODING_DIM), dtype='<f4')
+    merged_path = os.path.join(nas_faces_dir, MERGED_FACES)
+    tmp_path = f"{merged_path}.{MACHINE_ID}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, encodings=encodings, names=np.array(all_names, dtype=str),
+                 machines=np.array(all_machines, dtype=str))
+    os.replace(tmp_path, merged_path)
+    logger.info(f"Merged {len(encodings)} faces from {len(names)} machines into {merged_path}")
+    return len(encodings)
+
+
+class DeltaPusher:
+    """Pushes label and face deltas and re-merges when any machine's files changed"""
+
+    def __init__(self, cache_dir, nas_labels_dir, nas_faces_dir, state_dir, machine=MACHINE_ID):
+        self.csv_path = os.path.join(cache_dir, 'labels.csv')
+        self.journal_path = os.path.join(cache_dir, 'labels.journal')
+        self.faces_dir = os.path.join(cache_dir, 'faces')
+        self.ack_path = os.path.join(state_dir, 'labels_ack.json')
+        self.merge_state_path = os.path.join(state_dir, 'merge.json')
+        self.nas_labels_dir = nas_labels_dir
+        self.nas_faces_dir = nas_faces_dir
+        self.machine = machine
+
+    def _inputs(self, directory):
+        """Stamps of every machine's files in a NAS directory"""
+        if not os.path.isdir(directory):
+            return {}
+        return {name: list(file_stamp(os.path.join(directory, name)) or ())
+                for name in sorted(os.listdir(directory)) if not name.endswith('.tmp')}
+
+    def run(self):
+        """Push and merge both channels; returns {channel: stats}"""
+        results = {}
+        try:
+            with open(self.merge_state_path, 'r', encoding='utf-8') as f:
+                merged = json.load(f)
+        except (OSError, ValueError):
+            merged = {}
+
+        for channel, push, merge, inputs_dir in (
+                ('labels',
+                 lambda: push_labels(self.csv_path, self.journal_path, self.ack_path,
+                                     self.nas_labels_dir, self.machine),
+                 lambda: merge_labels(self.nas_labels_dir),
+                 os.path.join(self.nas_labels_dir, JOURNALS_DIR)),
+                ('faces',
+                 lambda: push_faces(self.faces_dir, self.nas_faces_dir, self.machine),
+                 lambda: merge_faces(self.nas_faces_dir),
+                 os.path.join(self.nas_faces_dir, MACHINES_DIR))):
+            start = time.time()
+            try:
+                stats = push()
+                inputs = self._inputs(inputs_dir)
+                # Other machines' pushes also change the inputs, so compare them all
+                if inputs != merged.get(channel):
+                    stats['merged'] = merge()
+                    merged[channel] = inputs
+                stats['errors'] = 0
+            except Exception as e:
+                logger.error(f"Delta push of {channel} failed: {e}", exc_info=True)
+                stats = {'error': str(e), 'errors': 1}
+            stats['seconds'] = time.time() - start
+            results[channel] = stats
+
+        os.makedirs(os.path.dirname(self.merge_state_path), exist_ok=True)
+        _write_atomic(self.merge_state_path, json.dumps(merged).encode('utf-8'))
+        return results
@@ -0,0 +1,130 @@
+"""
+Resized image derivatives cached on disk.
+
+The labelling page shows photos in a ~1200 px viewport, so instead of
+sending the original 12-24 MP JPEG every time, /image/<filename>?size=N
+serves a resized, re-encoded copy. Copies are generated once per
+(image, size) under cache/derivatives/<size>/ and regenerated only when the
+original changes: each copy carries its source's mtime, so a copy whose
+mtime differs from the source's (newer or older, e.g. a replacement copied
+in with copy2) is stale. Requested sizes are rounded up to a fixed ladder so a
+resizing browser window cannot fill the disk.
+"""
+
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, features
+
+from state import file_stamp
+
+logger = logging.getLogger(__name__)
+
+SIZE_LADDER = (320, 640, 1200, 1600, 2400)
+
+
+class DerivativeCache:
+    """Generates and caches resized copies of images in IMAGES_DIR"""
+
+    def __init__(self, images_dir, root, fmt='webp', quality=80, workers=2):
+        self.images_dir = images_dir
+        self.root = root
+        if fmt == 'webp' and not features.check('webp'):
+            logger.warning("Pillow was built without WebP support, using JPEG derivatives")
+            fmt = 'jpeg'
+        self.fmt = fmt
+        self.quality = quality
+        self.extension = 'webp' if fmt == 'webp' else 'jpg'
+        self.mimetype = 'image/webp' if fmt == 'webp' else 'image/jpeg'
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def normalize_size(size):
+        """Round a requested size up to the ladder (None = original)"""
+        if not size or size <= 0:
+            return None
+        for step in SIZE_LADDER:
+            if size <= step:
+                return step
+        return None
+
+    def path_for(self, filename, size):
+        return os.path.join(self.root, str(size), f"{filename}.{self.extension}")
+
+    def etag(self, filename, size, stamp):
+        """Strong validator derived from the source stamp and output settings"""
+        mtime_ns, source_size = stamp
+        return f"{mtime_ns:x}-{source_size:x}-{size}-{self.extension}{self.quality}"
+
+    def get(self, filename, size):
+        """Path of an up-to-date derivative, generating it if needed (None if the source is missing)"""
+        source = os.path.join(self.images_dir, filename)
+        stamp = file_stamp(source)
+        if stamp is None:
+            return None
+        path = self.path_for(filename, size)
+        if self._is_fresh(path, stamp):
+            return path
+
+        with self._key_lock(path):
+            # Another thread may have generated it while we waited
+            if not self._is_fresh(path, stamp):
+                self._generate(source, path, size, stamp)
+        return path
+
+    def _is_fresh(self, path, stamp):
+        derived = file_stamp(path)
+        return derived is not None and derived[0] == stamp[0]
+
+    def _key_lock(self, path):
+        with self._lock:
+            lock = self._key_locks.get(path)
+            if lock is None:
+                lock = self._key_locks[path] = threading.Lock()
+            return lock
+
+    def _generate(self, source, path, size, stamp):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with Image.open(source) as im:
+                # Let the JPEG decoder skip detail we are about to throw away
+                im.draft('RGB', (size, size))
+                im = ImageOps.exif_transpose(im)
+                im = im.convert('RGB')
+                im.thumbnail((size, size), Image.LANCZOS)
+                im.save(tmp_path, self.fmt.upper(), quality=self.quality)
+            # Stamp the copy with the source mtime it was made from
+            os.utime(tmp_path, ns=(stamp[0], stamp[0]))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._lock:
+                self._key_locks.pop(path, None)
+        logger.info(f"Generated {size}px derivative of {os.path.basename(source)}")
+
+    def prefetch(self, filenames, size):
+        """Generate derivatives for upcoming images in the background"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='derivatives')
+        for filename in filenames:
+            stamp = file_stamp(os.path.join(self.images_dir, filename))
+            if stamp is not None and not self._is_fresh(self.path_for(filename, size), stamp):
+                self._executor.submit(self._prefetch_one, filename, size)
+
+    def _prefetch_one(self, filename, size):
+        try:
+            self.get(filename, size)
+        except Exception as e:
+            logger.error(f"Error generating derivative for {filename}: {e}")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
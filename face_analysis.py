@@ -0,0 +1,135 @@
+"""
+Face detection and encoding, importable without the Flask app.
+
+Kept separate from app.py so worker processes (the background pre-compute
+pool and the bulk indexing CLI) can import it without creating the app,
+opening log files or loading the label store.
+"""
+
+import os
+import time
+import logging
+import importlib.util
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from state import file_stamp
+
+# Importing face_recognition loads dlib and its models, which takes seconds; only
+# check that it is installed here and import it when the first face is detected
+FACE_RECOGNITION_AVAILABLE = importlib.util.find_spec('face_recognition') is not None
+_face_recognition = None
+
+logger = logging.getLogger(__name__)
+
+# Detect on a copy whose longest side is at most this many pixels (0 = full resolution).
+# Boxes are mapped back to original coordinates. Read from the environment so the
+# app, its background pool and index_faces.py all agree.
+DETECTION_MAX_DIMENSION = int(os.environ.get('FACE_DETECTION_MAX_DIMENSION', '1600'))
+
+# Compute encodings from the full-resolution image (more accurate) rather than the
+# downscaled copy (faster)
+ENCODE_FROM_ORIGINAL = os.environ.get('FACE_ENCODE_FROM_ORIGINAL', '1') != '0'
+
+
+def detection_tag(max_dimension=DETECTION_MAX_DIMENSION, encode_from_original=ENCODE_FROM_ORIGINAL):
+    """Face cache tag for a detection configuration, so changing it re-analyses images
+
+    '+upright' marks analyses of EXIF-rotated pixels; older entries located
+    faces on the stored orientation and are redone.
+    """
+    if not max_dimension:
+        return 'hog+upright'
+    return f"hog@{max_dimension}" + ('' if encode_from_original else 's') + '+upright'
+
+
+def load_image_file(path):
+    """Decode an image file to an upright RGB array, EXIF orientation applied like the derivatives shown"""
+    with Image.open(path) as im:
+        return np.asarray(ImageOps.exif_transpose(im).convert('RGB'))
+
+
+def downscale(image, max_dimension):
+    """Resized copy of an RGB array with its longest side at most max_dimension, and the scale used"""
+    height, width = image.shape[:2]
+    longest = max(height, width)
+    if not max_dimension or longest <= max_dimension:
+        return image, 1.0
+    scale = max_dimension / longest
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    small = Image.fromarray(image).resize(size, Image.BILINEAR, reducing_gap=2.0)
+    return np.asarray(small), scale
+
+
+def scale_locations(locations, scale, shape):
+    """Map (top, right, bottom, left) boxes from a scaled copy back to the original image"""
+    height, width = shape[:2]
+    mapped = []
+    for top, right, bottom, left in locations:
+        mapped.append((
+            max(0, min(height, int(round(top / scale)))),
+            max(0, min(width, int(round(right / scale)))),
+            max(0, min(height, int(round(bottom / scale)))),
+            max(0, min(width, int(round(left / scale)))),
+        ))
+    return mapped
+
+
+def face_recognition_module():
+    """The face_recognition module, imported on first use"""
+    global _face_recognition
+    if _face_recognition is None:
+        start = time.perf_counter()
+        import face_recognition
+        _face_recognition = face_recognition
+        logger.info(f"Loaded face_recognition in {time.perf_counter() - start:.1f}s")
+    return _face_recognition
+
+
+def detect_and_encode(image, timings=None, max_dimension=DETECTION_MAX_DIMENSION,
+                      encode_from_original=ENCODE_FROM_ORIGINAL):
+    """Run the face detector and encoder on an RGB array, raising on failure
+
+    Detection runs on a copy downscaled to max_dimension; returned locations are
+    always in original image coordinates. If a timings dict is given, seconds
+    spent in 'resize', 'detect' and 'encode' are added to it.
+    """
+    face_recognition = face_recognition_module()
+    start = time.perf_counter()
+    small, scale = downscale(image, max_dimension)
+    resized = time.perf_counter()
+    small_locations = face_recognition.face_locations(small)
+    detected = time.perf_counter()
+
+    if scale == 1.0:
+        face_locations = small_locations
+        face_encodings = face_recognition.face_encodings(image, face_locations)
+    else:
+        face_locations = scale_locations(small_locations, scale, image.shape)
+        if encode_from_original:
+            face_encodings = face_recognition.face_encodings(image, face_locations)
+        else:
+            face_encodings = face_recognition.face_encodings(small, small_locations)
+
+    if timings is not None:
+        timings['resize'] = timings.get('resize', 0.0) + resized - start
+        timings['detect'] = timings.get('detect', 0.0) + detected - resized
+        timings['encode'] = timings.get('encode', 0.0) + time.perf_counter() - detected
+    return face_locations, face_encodings
+
+
+def analyse_file(path, timings=None, max_dimension=DETECTION_MAX_DIMENSION,
+                 encode_from_original=ENCODE_FROM_ORIGINAL):
+    """Stamp, locations and encodings for an image file (runs in worker processes)"""
+    stamp = file_stamp(path)
+    start = time.perf_counter()
+    image = load_image_file(path)
+    if timings is not None:
+        timings['load'] = timings.get('load', 0.0) + time.perf_counter() - start
+    locations, encodings = detect_and_encode(image, timings, max_dimension, encode_from_original)
+    return (
+        stamp,
+        np.asarray(locations, dtype=np.int32).reshape(-1, 4),
+        np.asarray(encodings, dtype=np.float32).reshape(-1, 128),
+    )
@@ -0,0 +1,284 @@
+"""
+Persistent cache of face-analysis results.
+
+Face locations and 128-d encodings are stored per image in an append-only
+binary log so each photo is run through the detector at most once, across
+restarts. Entries are keyed by filename and validated against the image's
+(mtime, size) stamp plus a detector tag, so a changed file or detector
+configuration is simply re-analysed and appended again (last record wins).
+
+Record layout (little endian):
+    u32 payload length, u32 crc32(payload), payload
+    payload = u16 key length, key, u8 tag length, tag,
+              i64 mtime_ns, i64 size, u16 face count,
+              i32[count, 4] locations (top, right, bottom, left),
+              f32[count, 128] encodings
+
+Appends are single O_APPEND writes made under a lock file shared with other
+processes (server workers, worker.py), which compaction also takes, so no
+record is written to a log that is being replaced.
+
+Indexing means parsing every record, so the index can also be restored from
+a warm-state snapshot taken at some offset of the same file; only records
+appended after that offset are parsed.
+"""
+
+import os
+import struct
+import zlib
+import logging
+import threading
+
+import numpy as np
+
+from state import FileLock
+
+logger = logging.getLogger(__name__)
+
+ENCODING_DIM = 128
+
+_RECORD_HEADER = struct.Struct('<II')
+_STAMP = struct.Struct('<qqH')
+
+
+class FaceCache:
+    """Append-only on-disk cache of face locations and encodings per image"""
+
+    def __init__(self, path, tag='hog', snapshot=None):
+        self.path = path
+        self.tag = tag
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(path + '.lock')
+        # filename -> (stamp, tag, locations offset, face count)
+        self._index = {}
+        # Filenames in record order, so consumers can follow what was added
+        self._order = []
+        self._offset = 0
+        self._file_id = None
+        self._records = 0
+        self._reader = None
+        # Bumped whenever the log is replaced and positions start over
+        self.generation = 0
+        if snapshot is not None:
+            self._restore(snapshot)
+        self.refresh()
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+
+    def refresh(self):
+        """Index records appended since the last call (e.g. by another process)"""
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                self._reset()
+                return 0
+
+            file_id = (st.st_dev, st.st_ino)
+            if file_id != self._file_id or st.st_size < self._offset:
+                # File was replaced by compaction, start over
+                self._reset()
+                self._file_id = file_id
+            if st.st_size == self._offset:
+                return 0
+
+            added = 0
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read(st.st_size - self._offset)
+            pos = 0
+            while pos + _RECORD_HEADER.size <= len(data):
+                length, crc = _RECORD_HEADER.unpack_from(data, pos)
+                start = pos + _RECORD_HEADER.size
+                payload = data[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    # Torn or in-progress write; pick it up on a later refresh
+                    break
+                self._index_record(payload, self._offset + start)
+                pos = start + length
+                added += 1
+
+            self._offset += pos
+            self._records += added
+            if added:
+                logger.debug(f"Face cache indexed {added} new records ({len(self._index)} images)")
+            return added
+
+    def _reset(self):
+        self._index = {}
+        self._order = []
+        self.generation += 1
+        self._offset = 0
+        self._file_id = None
+        self._records = 0
+        self._close_reader()
+
+    def _restore(self, snapshot):
+        """Adopt a snapshot's index if it was taken from the current file"""
+        meta, arrays = snapshot
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        if [st.st_dev, st.st_ino] != meta.get('file_id') or st.st_size < meta['offset']:
+            logger.info("Face cache replaced since the warm-state snapshot, indexing it")
+            return False
+        tags = arrays['tags']
+        # Record order: later records for the same file win, as when parsing the log
+        for filename, tag_id, (mtime_ns, size, offset, count) in zip(arrays['files'], arrays['tag_ids'],
+                                                                      arrays['entries'].tolist()):
+            self._index[filename] = ((mtime_ns, size), tags[tag_id], offset, count)
+        self._order = list(arrays['files'])
+        self._file_id = (st.st_dev, st.st_ino)
+        self._offset = meta['offset']
+        self._records = meta['records']
+        logger.info(f"Face cache restored from warm-state snapshot: {len(self._index)} images")
+        return True
+
+    def snapshot(self):
+        """(meta, arrays) describing the index, for warm_state.py"""
+        with self._lock:
+            if self._file_id is None:
+                return None
+            tags = sorted({entry[1] for entry in self._index.values()})
+            tag_ids = {tag: i for i, tag in enumerate(tags)}
+            # Only the latest record per file matters, in record order
+            latest = list(dict.fromkeys(reversed(self._order)))[::-1]
+            entries = [self._index[f] for f in latest]
+            meta = {'file_id': list(self._file_id), 'offset': self._offset, 'records': self._records}
+            return meta, {
+                'files': latest,
+                'tags': tags,
+                'tag_ids': np.array([tag_ids[e[1]] for e in entries], dtype=np.int32),
+                'entries': np.array([(e[0][0], e[0][1], e[2], e[3]) for e in entries],
+                                    dtype=np.int64).reshape(-1, 4),
+            }
+
+    def _index_record(self, payload, payload_offset):
+        pos = 0
+        (key_len,) = struct.unpack_from('<H', payload, pos)
+        pos += 2
+        filename = payload[pos:pos + key_len].decode('utf-8')
+        pos += key_len
+        tag_len = payload[pos]
+        pos += 1
+        tag = payload[pos:pos + tag_len].decode('utf-8')
+        pos += tag_len
+        mtime_ns, size, count = _STAMP.unpack_from(payload, pos)
+        pos += _STAMP.size
+        self._index[filename] = ((mtime_ns, size), tag, payload_offset + pos, count)
+        self._order.append(filename)
+
+    def _read_arrays(self, offset, count):
+        if self._reader is None:
+            self._reader = open(self.path, 'rb')
+        self._reader.seek(offset)
+        loc_bytes = count * 4 * 4
+        enc_bytes = count * ENCODING_DIM * 4
+        data = self._reader.read(loc_bytes + enc_bytes)
+        locations = np.frombuffer(data, dtype='<i4', count=count * 4).reshape(count, 4)
+        encodings = np.frombuffer(data, dtype='<f4', offset=loc_bytes).reshape(count, ENCODING_DIM)
+        return locations, encodings
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __contains__(self, filename):
+        return filename in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def filenames(self):
+        """Filenames with a cached analysis (valid or stale)"""
+        with self._lock:
+            return list(self._index)
+
+    def is_current(self, filename, stamp):
+        """True if the cached entry matches the image stamp and detector tag"""
+        entry = self._index.get(filename)
+        return entry is not None and entry[0] == tuple(stamp) and entry[1] == self.tag
+
+    def records_since(self, position):
+        """(new position, filenames of records indexed after position) within this generation"""
+        with self._lock:
+            return len(self._order), self._order[position:]
+
+    def read(self, filename):
+        """Latest (locations, encodings) arrays for an image regardless of its stamp, or None"""
+        with self._lock:
+            entry = self._index.get(filename)
+            if entry is None or entry[1] != self.tag:
+                return None
+            return self._read_arrays(entry[2], entry[3])
+
+    def lookup(self, filename, stamp):
+        """Cached (locations, encodings) arrays for an image, or None if missing or stale"""
+        with self._lock:
+            if not self.is_current(filename, stamp):
+                return None
+            _, _, offset, count = self._index[filename]
+            return self._read_arrays(offset, count)
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def put(self, filename, stamp, locations, encodings):
+        """Append the analysis for an image"""
+        locations = np.asarray(locations, dtype='<i4').reshape(-1, 4)
+        encodings = np.asarray(encodings, dtype='<f4').reshape(-1, ENCODING_DIM)
+        record = _encode_record(filename, self.tag, stamp, locations, encodings)
+
+        with self._lock, self._file_lock:
+            # Pick up records from other writers first so our offsets stay correct
+            self.refresh()
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+            self.refresh()
+        logger.debug(f"Cached {len(locations)} faces for {filename}")
+
+    def compact(self):
+        """Rewrite the log keeping only the latest record per image"""
+        with self._lock, self._file_lock:
+            self.refresh()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for filename, (stamp, tag, offset, count) in self._index.items():
+                    locations, encodings = self._read_arrays(offset, count)
+                    f.write(_encode_record(filename, tag, stamp, locations, encodings))
+                f.flush()
+                os.fsync(f.fileno())
+            live = len(self._index)
+            dropped = self._records - live
+            self._close_reader()
+            os.replace(tmp_path, self.path)
+            self._reset()
+            self.refresh()
+            logger.info(f"Compacted face cache: kept {live} records, dropped {dropped}")
+            return dropped
+
+    def close(self):
+        with self._lock:
+            self._close_reader()
+
+
+def _encode_record(filename, tag, stamp, locations, encodings):
+    key = filename.encode('utf-8')
+    tag_bytes = tag.encode('utf-8')
+    mtime_ns, size = stamp
+    payload = b''.join([
+        struct.pack('<H', len(key)), key,
+        bytes([len(tag_bytes)]), tag_bytes,
+        _STAMP.pack(mtime_ns, size, len(locations)),
+        locations.tobytes(),
+        encodings.tobytes(),
+    ])
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
@@ -0,0 +1,147 @@
+"""
+Face crop sprite sheets cached on disk.
+
+All face crops of an image are cut once, from the cached face locations,
+into a single horizontal strip of fixed-size tiles stored under
+cache/face_crops/. The page shows every face of a photo from that one file
+via CSS background offsets, so a photo costs two requests (image + sprite)
+however many faces it has. Crops are cut from the upright image (EXIF
+orientation applied), which is what the face locations refer to. A small JSON sidecar records the source stamp
+and boxes the sprite was built from, so it is rebuilt when either changes.
+"""
+
+import os
+import json
+import zlib
+import logging
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from state import file_stamp
+
+logger = logging.getLogger(__name__)
+
+
+class FaceSpriteCache:
+    """Builds and caches one sprite of face crops per image"""
+
+    def __init__(self, images_dir, root, tile=150, quality=85, workers=1):
+        self.images_dir = images_dir
+        self.root = root
+        self.tile = tile
+        self.quality = quality
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(root, exist_ok=True)
+
+    def sprite_path(self, filename):
+        return os.path.join(self.root, f"{filename}.jpg")
+
+    def _meta_path(self, filename):
+        return os.path.join(self.root, f"{filename}.json")
+
+    def layout(self, locations):
+        """Tile rectangle in the sprite for each face"""
+        return [{'id': i, 'x': i * self.tile, 'y': 0, 'w': self.tile, 'h': self.tile}
+                for i in range(len(locations))]
+
+    def etag(self, stamp, locations):
+        mtime_ns, size = stamp
+        boxes = zlib.crc32(json.dumps([list(map(int, box)) for box in locations]).encode('ascii'))
+        return f"{mtime_ns:x}-{size:x}-{len(locations)}-{boxes:x}-{self.tile}"
+
+    def _is_fresh(self, filename, stamp, locations):
+        try:
+            with open(self._meta_path(filename), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return (meta.get('stamp') == list(stamp)
+                and meta.get('boxes') == [list(map(int, box)) for box in locations]
+                and meta.get('tile') == self.tile
+                and os.path.exists(self.sprite_path(filename)))
+
+    def get(self, filename, locations):
+        """Path of an up-to-date sprite for these face locations (None if no faces or no source)"""
+        if not len(locations):
+            return None
+        source = os.path.join(self.images_dir, filename)
+        stamp = file_stamp(source)
+        if stamp is None:
+            return None
+        if self._is_fresh(filename, stamp, locations):
+            return self.sprite_path(filename)
+        with self._key_lock(filename):
+            try:
+                # Another thread may have built it while we waited
+                if not self._is_fresh(filename, stamp, locations):
+                    self._build(filename, source, stamp, locations)
+            finally:
+                with self._lock:
+                    self._key_locks.pop(filename, None)
+        return self.sprite_path(filename)
+
+    def _key_lock(self, filename):
+        with self._lock:
+            lock = self._key_locks.get(filename)
+            if lock is None:
+                lock = self._key_locks[filename] = threading.Lock()
+            return lock
+
+    def _build(self, filename, source, stamp, locations):
+        sprite = Image.new('RGB', (self.tile * len(locations), self.tile))
+        with Image.open(source) as im:
+            im = ImageOps.exif_transpose(im)
+            im = im.convert('RGB')
+            for i, (top, right, bottom, left) in enumerate(locations):
+                crop = im.crop((int(left), int(top), int(right), int(bottom)))
+                crop = crop.resize((self.tile, self.tile), Image.LANCZOS)
+                sprite.paste(crop, (i * self.tile, 0))
+
+        path = self.sprite_path(filename)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        sprite.save(tmp_path, 'JPEG', quality=self.quality)
+        os.replace(tmp_path, path)
+        # Replaced whole, so a concurrent reader never sees a half-written sidecar
+        meta_path = self._meta_path(filename)
+        tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'stamp': list(stamp), 'tile': self.tile,
+                       'boxes': [list(map(int, box)) for box in locations]}, f)
+        os.replace(tmp_path, meta_path)
+        logger.info(f"Built face sprite for {filename} ({len(locations)} faces)")
+
+    def crop(self, filename, locations, face_id):
+        """JPEG bytes of a single face tile cut from the sprite"""
+        path = self.get(filename, locations)
+        if path is None or not 0 <= face_id < len(locations):
+            return None
+        with Image.open(path) as sprite:
+            tile = sprite.crop((face_id * self.tile, 0, (face_id + 1) * self.tile, self.tile))
+            out = BytesIO()
+            tile.save(out, 'JPEG', quality=self.quality)
+        return out.getvalue()
+
+    def prefetch(self, items):
+        """Build sprites for (filename, locations) pairs in the background"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='face-sprites')
+        for filename, locations in items:
+            if len(locations):
+                self._executor.submit(self._prefetch_one, filename, locations)
+
+    def _prefetch_one(self, filename, locations):
+        try:
+            self.get(filename, locations)
+        except Exception as e:
+            logger.error(f"Error building face sprite for {filename}: {e}")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,74 @@
+"""
+Vectorized nearest-neighbour matching against known faces.
+
+Known encodings are held as one contiguous float32 matrix with precomputed
+squared norms, so matching every detected face against every known face is
+a single matrix product:
+
+    |q - k|^2 = |q|^2 + |k|^2 - 2 q.k
+
+Each query gets the nearest known face and its distance (best match, not the
+first one under tolerance).
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ENCODING_DIM = 128
+DEFAULT_TOLERANCE = 0.6
+
+
+def as_matrix(encodings):
+    """Stack encodings into a C-contiguous float32 (n, 128) matrix"""
+    if isinstance(encodings, np.ndarray):
+        matrix = encodings
+    elif len(encodings):
+        matrix = np.stack([np.asarray(e, dtype=np.float32) for e in encodings])
+    else:
+        matrix = np.empty((0, ENCODING_DIM), dtype=np.float32)
+    return np.ascontiguousarray(matrix, dtype=np.float32).reshape(-1, ENCODING_DIM)
+
+
+class FaceMatcher:
+    """Known face encodings plus names, matched in one batched distance computation"""
+
+    def __init__(self, encodings, names):
+        self.matrix = as_matrix(encodings)
+        self.names = list(names)
+        if len(self.names) != len(self.matrix):
+            raise ValueError(f"{len(self.matrix)} encodings but {len(self.names)} names")
+        self._sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def nearest(self, queries):
+        """Index and distance of the nearest known face for each query (-1/inf if none known)"""
+        queries = as_matrix(queries)
+        n = len(queries)
+        if n == 0 or len(self.matrix) == 0:
+            return np.full(n, -1, dtype=np.intp), np.full(n, np.inf, dtype=np.float32)
+
+        q_sq = np.einsum('ij,ij->i', queries, queries)
+        d2 = queries @ self.matrix.T
+        d2 *= -2.0
+        d2 += q_sq[:, None]
+        d2 += self._sq_norms[None, :]
+        indices = np.argmin(d2, axis=1)
+        best = d2[np.arange(n), indices]
+        np.maximum(best, 0.0, out=best)
+        return indices, np.sqrt(best)
+
+    def identify(self, queries, tolerance=DEFAULT_TOLERANCE):
+        """(name or None, distance) for each query, using the best match under tolerance"""
+        indices, distances = self.nearest(queries)
+        results = []
+        for index, distance in zip(indices, distances):
+            if index >= 0 and distance <= tolerance:
+                results.append((self.names[index], float(distance)))
+            else:
+                results.append((None, float(distance)))
+        return results
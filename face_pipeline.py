@@ -0,0 +1,133 @@
+"""
+Background face analysis for upcoming images.
+
+Face detection is CPU-bound and holds the GIL, so the next few images in the
+unlabelled queue are analysed on a process pool and the results are written
+to the face cache by the parent. Whenever the queue moves (label, undo, page
+load) the window is rescheduled: work for images that dropped out of the
+window is cancelled if it has not started yet, and missing images are
+submitted in queue order.
+"""
+
+import os
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import face_analysis
+from state import file_stamp
+
+logger = logging.getLogger(__name__)
+
+
+def default_workers():
+    """Leave one core for the web server"""
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+class FacePrecomputer:
+    """Keeps face analysis for the next few queued images running ahead on a process pool"""
+
+    def __init__(self, images_dir, face_cache, lookahead=5, workers=None, on_result=None):
+        self.images_dir = images_dir
+        self.face_cache = face_cache
+        # Called as on_result(filename, locations) after a result is cached
+        self.on_result = on_result
+        self.lookahead = lookahead
+        self.workers = workers or default_workers()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+
+    @property
+    def enabled(self):
+        return face_analysis.FACE_RECOGNITION_AVAILABLE and self.lookahead > 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            logger.info(f"Started face analysis pool with {self.workers} workers")
+        return self._executor
+
+    def schedule(self, filenames):
+        """Make the first `lookahead` of these images the work set, in order"""
+        if not self.enabled:
+            return
+
+        wanted = []
+        for filename in filenames:
+            if len(wanted) >= self.lookahead:
+                break
+            stamp = file_stamp(os.path.join(self.images_dir, filename))
+            if stamp is not None and not self.face_cache.is_current(filename, stamp):
+                wanted.append(filename)
+
+        with self._lock:
+            dropped = [(filename, future) for filename, future in self._pending.items() if filename not in wanted]
+
+        # cancel() and add_done_callback() on a finished future run _on_done on this
+        # thread, which takes the lock, so both happen with the lock released
+        for filename, future in dropped:
+            # No-op once it has started; _on_done forgets the cancelled ones
+            if future.cancel():
+                logger.debug(f"Cancelled face analysis for {filename}")
+
+        submitted = []
+        with self._lock:
+            executor = self._get_executor()
+            for filename in wanted:
+                if filename in self._pending:
+                    continue
+                path = os.path.join(self.images_dir, filename)
+                future = executor.submit(face_analysis.analyse_file, path)
+                self._pending[filename] = future
+                submitted.append((filename, future))
+
+        for filename, future in submitted:
+            future.add_done_callback(lambda f, name=filename: self._on_done(name, f))
+        if submitted:
+            logger.info(f"Submitted {len(submitted)} images for background face analysis")
+
+    def _on_done(self, filename, future):
+        with self._lock:
+            if self._pending.get(filename) is future:
+                del self._pending[filename]
+        if future.cancelled():
+            return
+        try:
+            stamp, locations, encodings = future.result()
+        except Exception as e:
+            logger.error(f"Background face analysis failed for {filename}: {e}")
+            return
+        if stamp is not None:
+            self.face_cache.put(filename, stamp, locations, encodings)
+            logger.info(f"Pre-computed {len(locations)} faces for {filename}")
+            if self.on_result is not None:
+                self.on_result(filename, locations)
+
+    def wait_for(self, filename, timeout=None):
+        """Result of in-flight analysis of this image, or None if none is running or it failed"""
+        with self._lock:
+            future = self._pending.get(filename)
+        if future is None:
+            return None
+        try:
+            # The done callback stores the result in the face cache
+            return future.result(timeout=timeout)
+        except Exception:
+            return None
+
+    def is_pending(self, filename):
+        with self._lock:
+            return filename in self._pending
+
+    def shutdown(self):
+        with self._lock:
+            futures = list(self._pending.values())
+            self._pending.clear()
+            executor, self._executor = self._executor, None
+        # Cancelling runs the done callbacks, which take the lock
+        for future in futures:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,322 @@
+"""
+Known-faces database.
+
+Replaces the pickled dict of lists in faces.pkl with:
+
+    faces/store.json                 manifest: generation, base row count,
+                                     person id -> name table, rows moved to
+                                     another person since compaction
+    faces/encodings.<gen>.npy        compacted float32 (n, 128) matrix
+    faces/person_ids.<gen>.npy       int32 person id per row
+    faces/encodings.<gen>.append     raw float32 rows added since compaction
+    faces/person_ids.<gen>.append    raw int32 person ids for those rows
+
+Startup memory-maps the .npy files instead of unpickling. New faces are
+appended to the .append files, moving a face to another person only touches
+the small manifest, and compaction writes generation gen+1 (folding the moved
+rows into its person ids) and commits it by atomically replacing store.json,
+so a crash at any point leaves a consistent generation. Because the .append
+files only ever grow, the NAS sync can ship just their tails.
+
+Writers hold faces/store.lock and reload first, so server processes sharing
+the store never allocate the same person id or append to a generation that
+another process has just compacted away.
+"""
+
+import os
+import json
+import pickle
+import logging
+import threading
+
+import numpy as np
+
+from state import file_stamp, FileLock
+
+logger = logging.getLogger(__name__)
+
+ENCODING_DIM = 128
+_ROW_BYTES = ENCODING_DIM * 4
+
+
+class FaceStore:
+    """Append-only store of known face encodings with a person id -> name table"""
+
+    def __init__(self, directory, compact_every=1000):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.manifest_path = os.path.join(directory, 'store.json')
+        self._lock = threading.RLock()
+        self._file_lock = FileLock(os.path.join(directory, 'store.lock'))
+        # Bumped whenever encodings or names change so callers can cache derived data
+        self.version = 0
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    # ------------------------------------------------------------------
+    # Paths
+    # ------------------------------------------------------------------
+
+    def _path(self, kind, gen, ext):
+        return os.path.join(self.directory, f"{kind}.{gen}.{ext}")
+
+    @property
+    def append_paths(self):
+        """The files that only grow between compactions"""
+        return [self._path('encodings', self.generation, 'append'),
+                self._path('person_ids', self.generation, 'append')]
+
+    # ------------------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------------------
+
+    def load(self):
+        """Memory-map the current generation and read its appended rows"""
+        with self._lock:
+            manifest = {'generation': 0, 'base_rows': 0, 'next_person_id': 1, 'people': {}, 'reassigned': {}}
+            if os.path.exists(self.manifest_path):
+                try:
+                    with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                        manifest.update(json.load(f))
+                except Exception as e:
+                    logger.error(f"Error loading face store manifest: {e}")
+
+            self.generation = manifest['generation']
+            self.next_person_id = manifest['next_person_id']
+            self.people = {int(pid): name for pid, name in manifest['people'].items()}
+            # row -> person id for faces assigned to another person since compaction
+            self.reassigned = {int(row): int(pid) for row, pid in manifest['reassigned'].items()}
+            self._manifest_stamp = file_stamp(self.manifest_path)
+
+            base_rows = manifest['base_rows']
+            if base_rows:
+                self._base_encodings = np.load(self._path('encodings', self.generation, 'npy'), mmap_mode='r')
+                self._base_person_ids = np.load(self._path('person_ids', self.generation, 'npy'), mmap_mode='r')
+            else:
+                self._base_encodings = np.empty((0, ENCODING_DIM), dtype=np.float32)
+                self._base_person_ids = np.empty(0, dtype=np.int32)
+
+            self._read_appended()
+            self.version += 1
+            logger.info(f"Loaded face store: {len(self)} faces of {len(self.people)} people "
+                        f"(generation {self.generation}, {len(self._append_person_ids)} appended)")
+
+    def _read_appended(self):
+        enc_path, pid_path = self.append_paths
+        encodings = _read_raw(enc_path, np.float32)
+        person_ids = _read_raw(pid_path, np.int32)
+        # A crash between the two appends can leave one file a row ahead
+        rows = min(len(encodings) // ENCODING_DIM, len(person_ids))
+        self._append_encodings = encodings[:rows * ENCODING_DIM].reshape(rows, ENCODING_DIM)
+        self._append_person_ids = person_ids[:rows]
+        self._append_stamp = (file_stamp(enc_path), file_stamp(pid_path))
+        self._matrix = None
+
+    def reload_if_changed(self):
+        """Reload if another process compacted, renamed or appended since we last looked"""
+        with self._lock:
+            if file_stamp(self.manifest_path) != self._manifest_stamp:
+                self.load()
+                return True
+            if (file_stamp(self.append_paths[0]), file_stamp(self.append_paths[1])) != self._append_stamp:
+                self._read_appended()
+                self.version += 1
+                return True
+            return False
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self._base_person_ids) + len(self._append_person_ids)
+
+    @property
+    def base_rows(self):
+        return len(self._base_person_ids)
+
+    def encodings(self):
+        """All known encodings as a float32 (n, 128) matrix (memory-mapped when no appends)"""
+        with self._lock:
+            if self._matrix is None:
+                if len(self._append_person_ids):
+                    self._matrix = np.concatenate([self._base_encodings, self._append_encodings])
+                else:
+                    self._matrix = self._base_encodings
+            return self._matrix
+
+    def person_ids(self):
+        """Person id for every row of encodings()"""
+        with self._lock:
+            person_ids = np.concatenate([self._base_person_ids, self._append_person_ids])
+            if self.reassigned:
+                rows = np.fromiter(self.reassigned.keys(), dtype=np.int64)
+                person_ids[rows] = np.fromiter(self.reassigned.values(), dtype=np.int32)
+            return person_ids
+
+    def names(self):
+        """Name for every row of encodings()"""
+        with self._lock:
+            return [self.people.get(int(pid), "Unknown") for pid in self.person_ids()]
+
+    def person_id(self, name):
+        """Id of the person with this name or None"""
+        for pid, existing in self.people.items():
+            if existing == name:
+                return pid
+        return None
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def _person_for(self, name):
+        """Id of the named person, adding them to the table (unsaved) if new; returns (pid, created)"""
+        pid = self.person_id(name)
+        if pid is not None:
+            return pid, False
+        pid = self.next_person_id
+        self.next_person_id += 1
+        self.people[pid] = name
+        return pid, True
+
+    def add_face(self, encoding, name):
+        """Append a face for the named person, creating the person if needed"""
+        with self._lock, self._file_lock:
+            self.reload_if_changed()
+            pid, created = self._person_for(name)
+            if created:
+                self._write_manifest()
+
+            enc_path, pid_path = self.append_paths
+            row = np.asarray(encoding, dtype='<f4').reshape(ENCODING_DIM)
+            _append_raw(enc_path, row.tobytes())
+            _append_raw(pid_path, np.int32(pid).tobytes())
+            self._read_appended()
+            self.version += 1
+            logger.info(f"Added face for {name} (person {pid}, {len(self)} faces)")
+
+            if len(self._append_person_ids) >= self.compact_every:
+                self.compact()
+            return pid
+
+    def assign_row(self, row, name):
+        """Move one known face to the named person, creating the person if needed
+
+        The person it belonged to and their other faces keep their name.
+        """
+        with self._lock, self._file_lock:
+            # Compaction keeps row order, so the row still names the same face after a reload
+            self.reload_if_changed()
+            row = int(row)
+            old_pid = int(self.person_ids()[row])
+            pid, _ = self._person_for(name)
+            if pid == old_pid:
+                return pid
+            if row < self.base_rows:
+                stored = self._base_person_ids[row]
+            else:
+                stored = self._append_person_ids[row - self.base_rows]
+            if int(stored) == pid:
+                # Back to the person the row was written with
+                self.reassigned.pop(row, None)
+            else:
+                self.reassigned[row] = pid
+            self._write_manifest()
+            self.version += 1
+            logger.info(f"Moved face {row} from person {old_pid} to {name} (person {pid})")
+            return pid
+
+    def compact(self):
+        """Fold appended rows into a new generation and commit it atomically"""
+        with self._lock, self._file_lock:
+            self.reload_if_changed()
+            old_gen = self.generation
+            new_gen = old_gen + 1
+            encodings = np.ascontiguousarray(self.encodings(), dtype='<f4')
+            person_ids = np.ascontiguousarray(self.person_ids(), dtype='<i4')
+
+            for kind, data in (('encodings', encodings), ('person_ids', person_ids)):
+                path = self._path(kind, new_gen, 'npy')
+                with open(path, 'wb') as f:
+                    np.save(f, data)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            old_files = [self._path(kind, old_gen, ext)
+                         for kind in ('encodings', 'person_ids') for ext in ('npy', 'append')]
+            self.generation = new_gen
+            self.reassigned = {}
+            self._write_manifest(base_rows=len(person_ids))
+
+            # Drop our maps on the old generation before deleting it
+            self._base_encodings = self._base_person_ids = self._matrix = None
+            for path in old_files:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Could not remove old face store file {path}: {e}")
+            self.load()
+            logger.info(f"Compacted face store to generation {new_gen} ({len(person_ids)} faces)")
+
+    def _write_manifest(self, base_rows=None):
+        manifest = {
+            'generation': self.generation,
+            'base_rows': self.base_rows if base_rows is None else base_rows,
+            'next_person_id': self.next_person_id,
+            'people': {str(pid): name for pid, name in self.people.items()},
+            'reassigned': {str(row): pid for row, pid in sorted(self.reassigned.items())},
+        }
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_stamp = file_stamp(self.manifest_path)
+
+    # ------------------------------------------------------------------
+    # Migration
+    # ------------------------------------------------------------------
+
+    def migrate_from_pickle(self, pkl_path):
+        """One-time import of a legacy faces.pkl into an empty store"""
+        with self._lock, self._file_lock:
+            self.reload_if_changed()
+            if len(self) or self.people or not os.path.exists(pkl_path):
+                return 0
+            try:
+                with open(pkl_path, 'rb') as f:
+                    known_faces = pickle.load(f)
+            except Exception as e:
+                logger.error(f"Error reading {pkl_path} for migration: {e}")
+                return 0
+
+            encodings = known_faces.get('encodings', [])
+            names = known_faces.get('names', [])
+            for encoding, name in zip(encodings, names):
+                pid, _ = self._person_for(name)
+                enc_path, pid_path = self.append_paths
+                _append_raw(enc_path, np.asarray(encoding, dtype='<f4').reshape(ENCODING_DIM).tobytes())
+                _append_raw(pid_path, np.int32(pid).tobytes())
+            self._write_manifest()
+            self._read_appended()
+            self.compact()
+            logger.info(f"Migrated {len(encodings)} faces from {pkl_path}")
+            return len(encodings)
+
+
+def _read_raw(path, dtype):
+    try:
+        return np.fromfile(path, dtype=np.dtype(dtype).newbyteorder('<'))
+    except (FileNotFoundError, ValueError):
+        return np.empty(0, dtype=dtype)
+
+
+def _append_raw(path, data):
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
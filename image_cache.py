@@ -0,0 +1,122 @@
+"""
+Bounded in-memory image cache.
+
+Two tiers with separate byte budgets, since a decoded 24 MP photo is ~70 MB
+while its JPEG is a few MB:
+
+    decoded  RGB numpy arrays used for face detection and face crops
+    encoded  raw file bytes used to serve images
+
+Each tier is a thread-safe LRU (OrderedDict, O(1) get/put/evict) bounded by
+bytes rather than entry count, with hit/miss/eviction counters for
+monitoring.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by total bytes"""
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Cached value (marked most recently used) or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        """Insert a value, evicting least recently used entries to stay within budget"""
+        if nbytes > self.max_bytes:
+            logger.debug(f"{self.name} cache: {key} ({nbytes} bytes) exceeds budget, not cached")
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                evicted_key, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+                self.evictions += 1
+                logger.debug(f"{self.name} cache: evicted {evicted_key} ({evicted_bytes} bytes)")
+            return True
+
+    def discard(self, key):
+        """Drop an entry if present"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+                return True
+            return False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class ImageCache:
+    """Decoded-array and encoded-bytes tiers for images, keyed by filename"""
+
+    def __init__(self, decoded_bytes, encoded_bytes):
+        self.decoded = LRUCache('decoded', decoded_bytes)
+        self.encoded = LRUCache('encoded', encoded_bytes)
+
+    def __contains__(self, filename):
+        return filename in self.decoded or filename in self.encoded
+
+    def get_decoded(self, filename):
+        return self.decoded.get(filename)
+
+    def put_decoded(self, filename, image):
+        return self.decoded.put(filename, image, image.nbytes)
+
+    def get_encoded(self, filename):
+        return self.encoded.get(filename)
+
+    def put_encoded(self, filename, data):
+        return self.encoded.put(filename, data, len(data))
+
+    def discard(self, filename):
+        """Drop an image from both tiers"""
+        self.decoded.discard(filename)
+        self.encoded.discard(filename)
+
+    def stats(self):
+        return {'decoded': self.decoded.stats(), 'encoded': self.encoded.stats()}
@@ -0,0 +1,176 @@
+"""
+Incrementally maintained queue of unlabelled images.
+
+The images directory is listed once and the unlabelled files are kept in an
+ordered set, so "next image" and "remaining count" are O(1). Labelling and
+undo update the queue in place; the directory is only re-listed when its
+mtime changes (checked at most once per poll interval), which is what
+happens when worker.py copies new photos in.
+
+At startup the listing can come from a warm-state snapshot instead, as long
+as the directory's mtime is the one recorded with it.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'webp', 'bmp')
+
+
+def is_image_file(filename):
+    """True if the filename has a supported image extension"""
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def queue_order(filenames):
+    """Order in which images are presented for labelling"""
+    return sorted(filenames)
+
+
+class ImageQueue:
+    """Ordered set of unlabelled images in IMAGES_DIR"""
+
+    def __init__(self, images_dir, is_labeled, poll_interval=1.0, snapshot=None):
+        self.images_dir = images_dir
+        self.is_labeled = is_labeled
+        self.poll_interval = poll_interval
+
+        self._lock = threading.RLock()
+        self._all = set()
+        self._by_stem = {}
+        self._pending = OrderedDict()
+        self._dir_mtime = None
+        self._last_poll = 0.0
+        # Bumped whenever the directory listing changes
+        self.version = 0
+
+        if snapshot is None or not self._restore(snapshot):
+            self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """Re-list the directory if it changed since the last scan"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_poll < self.poll_interval:
+                return False
+            self._last_poll = now
+
+            try:
+                mtime = os.stat(self.images_dir).st_mtime_ns
+            except OSError as e:
+                logger.error(f"Error checking images directory: {e}")
+                return False
+            if not force and mtime == self._dir_mtime:
+                return False
+
+            self._dir_mtime = mtime
+            self._scan()
+            return True
+
+    def _scan(self):
+        try:
+            files = [f for f in os.listdir(self.images_dir) if is_image_file(f)]
+        except Exception as e:
+            logger.error(f"Error listing images directory: {e}")
+            return
+        self._index(queue_order(files))
+        logger.info(f"Image queue rebuilt: {len(self._pending)}/{len(self._all)} unlabeled images")
+
+    def _index(self, ordered):
+        self._all = set(ordered)
+        self.version += 1
+        # OCR text and other per-image data is keyed by name without extension
+        self._by_stem = {}
+        for f in ordered:
+            self._by_stem.setdefault(os.path.splitext(f)[0], f)
+        self._pending = OrderedDict.fromkeys(f for f in ordered if not self.is_labeled(f))
+
+    def _restore(self, snapshot):
+        """Use a snapshot's listing if the directory has not changed since it was taken"""
+        meta, arrays = snapshot
+        try:
+            mtime = os.stat(self.images_dir).st_mtime_ns
+        except OSError:
+            return False
+        if mtime != meta.get('dir_mtime'):
+            logger.info("Images directory changed since the warm-state snapshot, listing it")
+            return False
+        self._dir_mtime = mtime
+        self._last_poll = time.monotonic()
+        self._index(arrays['files'])
+        logger.info(f"Image queue restored from warm-state snapshot: "
+                    f"{len(self._pending)}/{len(self._all)} unlabeled images")
+        return True
+
+    def snapshot(self):
+        """(meta, arrays) describing the listing, for warm_state.py"""
+        with self._lock:
+            if self._dir_mtime is None:
+                return None
+            return {'dir_mtime': self._dir_mtime}, {'files': queue_order(self._all)}
+
+    def rebuild(self):
+        """Recompute the pending set, e.g. after labels were reloaded from disk"""
+        with self._lock:
+            self._pending = OrderedDict.fromkeys(
+                f for f in queue_order(self._all) if not self.is_labeled(f)
+            )
+
+    @property
+    def total(self):
+        """Number of images in the directory"""
+        return len(self._all)
+
+    @property
+    def remaining(self):
+        """Number of images still to label"""
+        return len(self._pending)
+
+    def __contains__(self, filename):
+        return filename in self._pending
+
+    def filenames(self):
+        """All images in the directory, labelled or not"""
+        with self._lock:
+            return list(self._all)
+
+    def has_image(self, filename):
+        """True if the image is in the directory, labelled or not"""
+        return filename in self._all
+
+    def image_for_stem(self, stem):
+        """Image file whose name without extension is stem, or None"""
+        return self._by_stem.get(stem)
+
+    def next(self):
+        """Next image to label or None"""
+        with self._lock:
+            return next(iter(self._pending), None)
+
+    def peek(self, count):
+        """The next `count` images to label"""
+        with self._lock:
+            result = []
+            for filename in self._pending:
+                if len(result) >= count:
+                    break
+                result.append(filename)
+            return result
+
+    def mark_labeled(self, filename):
+        """Remove an image from the queue once it has been labelled"""
+        with self._lock:
+            self._pending.pop(filename, None)
+
+    def mark_unlabeled(self, filename):
+        """Put an image back at the front of the queue (undo)"""
+        with self._lock:
+            if filename not in self._all:
+                return
+            self._pending[filename] = None
+            self._pending.move_to_end(filename, last=False)
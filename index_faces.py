@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Bulk offline face indexing.
+
+Walks cache/images and runs face detection on every image that does not yet
+have a current entry in the face cache, using all cores. Each result is
+appended to cache/face_cache.bin as soon as it arrives, so the run can be
+interrupted and resumed at any time. Run it after worker.py pulls a new
+batch so detection is not paid for interactively:
+
+    python index_faces.py
+    python index_faces.py --workers 4 --chunksize 8
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from multiprocessing import Pool
+
+import face_analysis
+from face_cache import FaceCache
+from image_queue import is_image_file, queue_order
+from state import file_stamp
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('index_faces.log'),
+        logging.StreamHandler()  # Also log to console
+    ]
+)
+logger = logging.getLogger("FaceIndexer")
+
+STAGES = ('load', 'resize', 'detect', 'encode')
+
+
+def _index_one(path):
+    """Analyse one image in a pool worker; errors are returned, not raised"""
+    timings = {}
+    try:
+        stamp, locations, encodings = face_analysis.analyse_file(path, timings)
+        return os.path.basename(path), stamp, locations, encodings, timings, None
+    except Exception as e:
+        return os.path.basename(path), None, None, None, timings, str(e)
+
+
+def find_unindexed(images_dir, face_cache):
+    """Images without a current face cache entry, in labelling-queue order"""
+    todo = []
+    try:
+        filenames = [f for f in os.listdir(images_dir) if is_image_file(f)]
+    except Exception as e:
+        logger.error(f"Error listing images directory: {e}")
+        return todo
+    for filename in queue_order(filenames):
+        stamp = file_stamp(os.path.join(images_dir, filename))
+        if stamp is not None and not face_cache.is_current(filename, stamp):
+            todo.append(filename)
+    return todo
+
+
+def run_index(images_dir, face_cache, workers, chunksize, limit=None, report_every=5.0):
+    """Index all unindexed images, returning a stats dict"""
+    todo = find_unindexed(images_dir, face_cache)
+    if limit:
+        todo = todo[:limit]
+    total = len(todo)
+    logger.info(f"{len(face_cache)} images already indexed, {total} to go "
+                f"({workers} workers, chunksize {chunksize})")
+
+    stats = {'images': 0, 'faces': 0, 'errors': 0, 'elapsed': 0.0,
+             'stage_seconds': {stage: 0.0 for stage in STAGES}, 'store_seconds': 0.0}
+    if not total:
+        return stats
+
+    paths = [os.path.join(images_dir, f) for f in todo]
+    start = time.perf_counter()
+    last_report = start
+
+    with Pool(processes=workers) as pool:
+        try:
+            for filename, stamp, locations, encodings, timings, error in \
+                    pool.imap_unordered(_index_one, paths, chunksize=chunksize):
+                stats['images'] += 1
+                for stage, seconds in timings.items():
+                    stats['stage_seconds'][stage] += seconds
+
+                if error is not None:
+                    stats['errors'] += 1
+                    logger.error(f"Error indexing {filename}: {error}")
+                elif stamp is not None:
+                    store_start = time.perf_counter()
+                    face_cache.put(filename, stamp, locations, encodings)
+                    stats['store_seconds'] += time.perf_counter() - store_start
+                    stats['faces'] += len(locations)
+
+                now = time.perf_counter()
+                if now - last_report >= report_every or stats['images'] == total:
+                    last_report = now
+                    _report_progress(stats, total, now - start)
+        except KeyboardInterrupt:
+            logger.warning("Interrupted; indexed images are saved, re-run to resume")
+            pool.terminate()
+
+    stats['elapsed'] = time.perf_counter() - start
+    return stats
+
+
+def _report_progress(stats, total, elapsed):
+    done = stats['images']
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = (total - done) / rate if rate > 0 else 0.0
+    per_stage = ', '.join(f"{stage} {1000 * seconds / done:.0f}ms"
+                          for stage, seconds in stats['stage_seconds'].items() if done)
+    logger.info(f"{done}/{total} images ({100 * done / total:.1f}%), {rate:.2f} images/sec, "
+                f"{stats['faces']} faces, {stats['errors']} errors, ETA {eta:.0f}s "
+                f"[per image: {per_stage}]")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-compute face analysis for every cached image")
+    parser.add_argument('--cache-dir', default=os.path.join(os.getcwd(), 'cache'),
+                        help="Cache directory containing images/ and face_cache.bin")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes (default: all cores)")
+    parser.add_argument('--chunksize', type=int, default=4,
+                        help="Images handed to a worker at a time")
+    parser.add_argument('--limit', type=int, default=None,
+                        help="Only index this many images")
+    parser.add_argument('--compact', action='store_true',
+                        help="Drop superseded records from the face cache afterwards")
+    args = parser.parse_args(argv)
+
+    if not face_analysis.FACE_RECOGNITION_AVAILABLE:
+        logger.error("face_recognition module not found; install with: pip install face-recognition")
+        return 1
+
+    images_dir = os.path.join(args.cache_dir, 'images')
+    face_cache = FaceCache(os.path.join(args.cache_dir, 'face_cache.bin'), tag=face_analysis.detection_tag())
+
+    stats = run_index(images_dir, face_cache, max(1, args.workers),
+                      max(1, args.chunksize), args.limit)
+    if stats['images']:
+        logger.info(f"Indexed {stats['images']} images ({stats['faces']} faces, {stats['errors']} errors) "
+                    f"in {stats['elapsed']:.1f}s, {stats['images'] / stats['elapsed']:.2f} images/sec")
+        stage_totals = ', '.join(f"{stage} {seconds:.1f}s" for stage, seconds in stats['stage_seconds'].items())
+        logger.info(f"Worker CPU time by stage: {stage_totals}; cache writes {stats['store_seconds']:.1f}s")
+
+    if args.compact:
+        face_cache.compact()
+    face_cache.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
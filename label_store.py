@@ -0,0 +1,475 @@
+"""
+Append-only label store.
+
+Every labelling decision is appended as one JSON line to a journal next to
+labels.csv instead of rewriting the whole CSV. An in-memory index of
+filename -> label is kept for reads, undo is recorded as a tombstone record,
+a batch of decisions is written as a single record so it replays atomically,
+and the journal is periodically compacted back into the plain labels.csv
+format.
+
+Record sequence numbers keep increasing across compactions: worker.py pushes
+journal records to the NAS by sequence number and acknowledges them in
+ack_path, and compaction keeps every record that has not been acknowledged
+yet (replaying them over the new CSV is idempotent).
+
+Several server processes can share one store: writers serialise on a lock
+file next to the journal, catch up on records the other processes appended
+before writing their own, and the others follow the journal from the byte
+offset they last read. A compaction by any process replaces both files,
+which the others notice and answer with a full reload.
+
+`snapshot()` describes the index for warm_state.py; a store constructed with
+that snapshot skips parsing labels.csv if the file is unchanged and only
+replays the journal records written after it.
+"""
+
+import os
+import csv
+import json
+import time
+import logging
+import threading
+from contextlib import nullcontext
+from collections import OrderedDict
+
+from state import file_stamp, FileLock
+
+logger = logging.getLogger(__name__)
+
+CSV_COLUMNS = ['filename', 'keep']
+
+
+def _file_id(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+class LabelStore:
+    """Journal-backed filename -> label index"""
+
+    def __init__(self, csv_path, journal_path, fsync_every=20, fsync_interval=2.0,
+                 compact_every=1000, compact_interval=300.0, read_only=False, ack_path=None, snapshot=None):
+        self.csv_path = csv_path
+        self.journal_path = journal_path
+        # JSON {"seq": n} written by the sync worker once records up to n reached the NAS
+        self.ack_path = ack_path
+        # Read-only stores (e.g. the sync worker's view) never touch the files
+        self.read_only = read_only
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+
+        self._lock = threading.RLock()
+        # Shared with the other processes writing to this journal
+        self._file_lock = None if read_only else FileLock(journal_path + '.lock')
+        self._labels = OrderedDict()
+        self._journal = None
+        self._seq = 0
+        self._csv_stamp = None
+        # Identity of the journal file and how much of it has been applied
+        self._journal_id = None
+        self._journal_offset = 0
+        # Filenames changed by records of other processes, until follow() returns them
+        self._changed = set()
+        # Set when catching up before a write required a full reload
+        self._reloaded = False
+        self._journal_records = 0
+        self._unsynced = 0
+        self._last_fsync = time.time()
+        self._last_compact = time.time()
+
+        self.load(snapshot)
+
+    # ------------------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------------------
+
+    def load(self, snapshot=None):
+        """Load labels.csv and replay the journal on top of it
+
+        If a snapshot from `snapshot()` is given and labels.csv has not changed
+        since, its labels are used instead of the CSV and only later journal
+        records are replayed.
+        """
+        with self._lock, self._exclusive():
+            self._close_journal()
+            self._labels = OrderedDict()
+            self._changed = set()
+            after = self._restore(snapshot) if snapshot is not None else None
+            if after is None:
+                after = 0
+                self._read_csv()
+            self._journal_records = self._replay_journal(after)
+            self._seq = max(self._seq, self.acked_seq())
+            if not self.read_only:
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal_id = _file_id(self.journal_path)
+            logger.info(f"Label store ready: {len(self._labels)} labels "
+                        f"({self._journal_records} journal records pending compaction)")
+
+    def _exclusive(self):
+        return self._file_lock if self._file_lock is not None else nullcontext()
+
+    def _stale(self):
+        """True if another process compacted (replaced labels.csv and the journal)"""
+        return (file_stamp(self.csv_path) != self._csv_stamp
+                or _file_id(self.journal_path) != self._journal_id)
+
+    def reload_if_changed(self):
+        """Reload if labels.csv or the journal was replaced by another process since we last saw it"""
+        with self._lock:
+            if self._stale():
+                logger.info(f"{self.csv_path} changed on disk, reloading labels")
+                self.load()
+                return True
+            reloaded, self._reloaded = self._reloaded, False
+            return reloaded
+
+    def follow(self):
+        """Filenames whose label was changed by records other processes appended to the journal"""
+        with self._lock:
+            self._tail()
+            changed, self._changed = self._changed, set()
+            return changed
+
+    def _tail(self):
+        """Apply complete records appended to the journal since we last read it"""
+        try:
+            size = os.path.getsize(self.journal_path)
+        except OSError:
+            return
+        if size <= self._journal_offset:
+            return
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            data = f.read(size - self._journal_offset)
+        for raw in data.splitlines(keepends=True):
+            if not raw.endswith(b'\n'):
+                # Still being written; picked up next time
+                break
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                break
+            self._changed.update(self._apply(record))
+            self._seq = max(self._seq, record.get('seq', 0))
+            self._journal_offset += len(raw)
+            self._journal_records += 1
+
+    def _catch_up(self):
+        """Bring the index up to date with other processes before writing (file lock held)"""
+        if self._stale():
+            self.load()
+            self._reloaded = True
+        else:
+            self._tail()
+            # The sync worker raises the ack past our records when it re-sends reset labels
+            self._seq = max(self._seq, self.acked_seq())
+
+    def _read_csv(self):
+        self._csv_stamp = file_stamp(self.csv_path)
+        if self._csv_stamp is None:
+            return
+        try:
+            with open(self.csv_path, 'r', newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    filename = row.get('filename')
+                    if filename:
+                        self._set(filename, row.get('keep', ''))
+            logger.info(f"Loaded {len(self._labels)} labeled images from CSV")
+        except Exception as e:
+            logger.error(f"Error loading labels CSV: {e}")
+
+    def _restore(self, snapshot):
+        """Adopt a snapshot's labels, returning its sequence number, or None if it is stale"""
+        meta, arrays = snapshot
+        stamp = file_stamp(self.csv_path)
+        if (list(stamp) if stamp else None) != meta.get('csv_stamp'):
+            logger.info("labels.csv changed since the warm-state snapshot, reading it")
+            return None
+        self._csv_stamp = stamp
+        self._labels = OrderedDict(zip(arrays['files'], arrays['labels']))
+        self._seq = meta['seq']
+        logger.info(f"Restored {len(self._labels)} labels from warm-state snapshot")
+        return meta['seq']
+
+    def snapshot(self):
+        """(meta, arrays) describing the index, for warm_state.py"""
+        with self._lock:
+            meta = {'csv_stamp': list(self._csv_stamp) if self._csv_stamp else None, 'seq': self._seq}
+            labels = ['' if label is None else str(label) for label in self._labels.values()]
+            return meta, {'files': list(self._labels), 'labels': labels}
+
+    def _replay_journal(self, after=0):
+        """Apply journal records after sequence number `after`, dropping a torn trailing line from a crash
+
+        Returns the number of records in the journal, applied or not.
+        """
+        if not os.path.exists(self.journal_path):
+            return 0
+
+        count = 0
+        valid_bytes = 0
+        with open(self.journal_path, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(raw)
+                except ValueError:
+                    break
+                if record.get('seq', 0) > after:
+                    self._apply(record)
+                self._seq = max(self._seq, record.get('seq', 0))
+                valid_bytes += len(raw)
+                count += 1
+
+        # Writers hold the file lock while appending, so with it held a partial line is a crash
+        if valid_bytes < os.path.getsize(self.journal_path) and not self.read_only:
+            logger.warning(f"Truncating torn record at end of {self.journal_path}")
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(valid_bytes)
+        self._journal_offset = valid_bytes
+        return count
+
+    def _apply(self, record):
+        """Apply a journal record, returning the filenames it changed"""
+        op = record.get('op')
+        filename = record.get('filename')
+        if op == 'label':
+            self._set(filename, record.get('keep'))
+            return [filename]
+        elif op == 'batch':
+            labels = record.get('labels', [])
+            for filename, label in labels:
+                self._set(filename, label)
+            return [filename for filename, _ in labels]
+        elif op == 'undo':
+            self._labels.pop(filename, None)
+            return [filename]
+        # 'mark' records only carry the sequence number across compactions
+        return []
+
+    def _set(self, filename, label):
+        # Relabelling moves the file to the end so undo always pops the latest decision
+        self._labels.pop(filename, None)
+        self._labels[filename] = label
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __contains__(self, filename):
+        return filename in self._labels
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def get(self, filename, default=None):
+        return self._labels.get(filename, default)
+
+    def filenames(self):
+        """Labelled filenames in labelling order"""
+        with self._lock:
+            return list(self._labels)
+
+    def items(self):
+        """(filename, label) pairs in labelling order"""
+        with self._lock:
+            return list(self._labels.items())
+
+    @property
+    def seq(self):
+        """Sequence number of the latest record in the index"""
+        with self._lock:
+            return self._seq
+
+    def acked_seq(self):
+        """Highest sequence number the sync worker has pushed to the NAS"""
+        if self.ack_path is None:
+            return 0
+        try:
+            with open(self.ack_path, 'r', encoding='utf-8') as f:
+                return int(json.load(f).get('seq', 0))
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error(f"Error reading label sync ack {self.ack_path}: {e}")
+            return 0
+
+    def last(self):
+        """Most recent (filename, label) decision or None"""
+        with self._lock:
+            if not self._labels:
+                return None
+            return next(reversed(self._labels.items()))
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def add(self, filename, label):
+        """Record a label decision"""
+        with self._lock, self._exclusive():
+            self._catch_up()
+            self._append({'op': 'label', 'filename': filename, 'keep': label})
+            self._set(filename, label)
+            logger.info(f"Journaled label: {filename} -> {label}")
+            self._maybe_compact()
+
+    def add_many(self, decisions):
+        """Record several (filename, label) decisions as one journal record
+
+        The batch is a single journal line, so after a crash replay applies
+        either all of it or none of it.
+        """
+        decisions = [(filename, label) for filename, label in decisions]
+        if not decisions:
+            return
+        if len(decisions) == 1:
+            self.add(*decisions[0])
+            return
+        with self._lock, self._exclusive():
+            self._catch_up()
+            self._append({'op': 'batch', 'labels': [list(d) for d in decisions]})
+            for filename, label in decisions:
+                self._set(filename, label)
+            logger.info(f"Journaled batch of {len(decisions)} labels")
+            self._maybe_compact()
+
+    def undo(self):
+        """Remove the most recent decision, returning (filename, label) or None"""
+        with self._lock, self._exclusive():
+            self._catch_up()
+            last = self.last()
+            if last is None:
+                return None
+            filename, label = last
+            self._append({'op': 'undo', 'filename': filename, 'keep': label})
+            del self._labels[filename]
+            logger.info(f"Journaled undo: {filename} ({label})")
+            self._maybe_compact()
+            return last
+
+    def _append(self, record):
+        if self.read_only:
+            raise RuntimeError(f"Label store {self.csv_path} is open read-only")
+        self._seq += 1
+        record['seq'] = self._seq
+        record['ts'] = time.time()
+        self._journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._journal.flush()
+        # Caught up under the file lock, so the journal ends with our record
+        self._journal_offset = os.fstat(self._journal.fileno()).st_size
+        self._journal_records += 1
+        self._unsynced += 1
+
+        now = time.time()
+        if self._unsynced >= self.fsync_every or now - self._last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def _fsync(self):
+        if self._journal is None or not self._unsynced:
+            return
+        try:
+            os.fsync(self._journal.fileno())
+        except OSError as e:
+            logger.error(f"Error syncing label journal: {e}")
+        self._unsynced = 0
+        self._last_fsync = time.time()
+
+    def flush(self):
+        """Force pending journal records to disk"""
+        with self._lock:
+            self._fsync()
+
+    # ------------------------------------------------------------------
+    # Compaction
+    # ------------------------------------------------------------------
+
+    def _maybe_compact(self):
+        if not self._journal_records:
+            return
+        if (self._journal_records >= self.compact_every
+                or time.time() - self._last_compact >= self.compact_interval):
+            self.compact()
+
+    def compact(self):
+        """Rewrite labels.csv from the index and drop acknowledged journal records"""
+        with self._lock, self._exclusive():
+            self._catch_up()
+            self._fsync()
+            tmp_path = self.csv_path + '.tmp'
+            try:
+                with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(CSV_COLUMNS)
+                    writer.writerows(self._labels.items())
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.csv_path)
+                self._csv_stamp = file_stamp(self.csv_path)
+            except Exception as e:
+                logger.error(f"Error compacting labels to CSV: {e}")
+                return False
+
+            # Replaying the journal over the new CSV is idempotent, so a crash
+            # between the two replaces (or a failed journal rewrite) loses nothing.
+            self._rewrite_journal(self.acked_seq())
+            self._journal_records = 0
+            self._last_compact = time.time()
+            logger.info(f"Compacted {len(self._labels)} labels to {self.csv_path}")
+            return True
+
+    def _rewrite_journal(self, acked):
+        """Replace the journal with its records after `acked` (or a mark holding the sequence number)"""
+        retained = []
+        with open(self.journal_path, 'rb') as f:
+            for raw in f:
+                try:
+                    if raw.endswith(b'\n') and json.loads(raw).get('seq', 0) > acked:
+                        retained.append(raw)
+                except ValueError:
+                    continue
+        if not retained:
+            mark = {'op': 'mark', 'seq': self._seq, 'ts': time.time()}
+            retained.append((json.dumps(mark, separators=(',', ':')) + '\n').encode('utf-8'))
+
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.writelines(retained)
+            f.flush()
+            os.fsync(f.fileno())
+        # Windows cannot replace a file that is open, so close our handle first
+        self._journal.close()
+        try:
+            os.replace(tmp_path, self.journal_path)
+        except OSError as e:
+            logger.warning(f"Could not rewrite label journal, keeping it whole: {e}")
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_id = _file_id(self.journal_path)
+        self._journal_offset = os.path.getsize(self.journal_path)
+        logger.debug(f"Label journal keeps {len(retained)} records after seq {acked}")
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._fsync()
+            self._journal.close()
+            self._journal = None
+
+    def close(self):
+        """Compact outstanding records and close the journal"""
+        with self._lock, self._exclusive():
+            if self._journal is None:
+                return
+            if self._journal_records:
+                self.compact()
+            self._close_journal()
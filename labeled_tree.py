@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+The labeled/ tree: labeled/<category>/<image> symlinks to cache/images/<image>.
+
+The tree mirrors the label store. Rather than creating and removing one link
+per labelling request, the desired tree ({image: category}) is diffed against
+what is on disk and the difference is applied in bulk: missing links are
+created, links whose image was relabelled are renamed into the new category
+folder, and links that are no longer wanted (undone labels, deleted
+categories, images gone from the cache) are removed. Only symlinks and empty
+folders are ever removed; other files under labeled/ are left alone.
+
+The app reconciles the whole tree in the background at startup and after
+category changes or a reload of the labels, and only the images it labels or
+undoes in between. To rebuild the tree offline, run from the directory
+holding cache/ and labeled/:
+
+    python labeled_tree.py
+    python labeled_tree.py --all-labels --dry-run
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+
+from state import FileLock
+
+logger = logging.getLogger("LabeledTree")
+
+
+def make_link(src_path, dst_path):
+    """Create a file symlink dst_path -> src_path"""
+    if os.name == 'nt':
+        import ctypes
+        kdll = ctypes.WinDLL("kernel32.dll", use_last_error=True)
+        if not kdll.CreateSymbolicLinkW(dst_path, src_path, 0):
+            # Maps to FileExistsError etc. like os.symlink
+            raise ctypes.WinError(ctypes.get_last_error())
+    else:
+        os.symlink(src_path, dst_path)
+
+
+def _normalise(path):
+    if path.startswith('\\\\?\\'):
+        path = path[4:]
+    return os.path.normcase(os.path.normpath(path))
+
+
+class LabeledTree:
+    """Applies the difference between a desired {image: category} mapping and the links on disk"""
+
+    def __init__(self, labeled_dir, images_dir, dry_run=False):
+        self.labeled_dir = labeled_dir
+        self.images_dir = images_dir
+        self.dry_run = dry_run
+        os.makedirs(labeled_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        # Shared with other server processes applying changes to the same tree
+        self._file_lock = FileLock(os.path.join(labeled_dir, '.lock'))
+        # image -> {category: link target} as last scanned or applied; None until the first scan
+        self._links = None
+
+    def target(self, filename):
+        return os.path.join(self.images_dir, filename)
+
+    def scan(self):
+        """{image: {category: link target}} of the symlinks on disk"""
+        links = {}
+        try:
+            folders = [entry for entry in os.scandir(self.labeled_dir) if entry.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            return links
+        for folder in folders:
+            for entry in os.scandir(folder.path):
+                if entry.is_symlink():
+                    try:
+                        links.setdefault(entry.name, {})[folder.name] = os.readlink(entry.path)
+                    except OSError:
+                        continue
+        return links
+
+    def reconcile(self, desired, categories=None):
+        """Make the whole tree match desired {image: category}; returns counts of what changed
+
+        A folder is kept for every category given, even if it is empty.
+        """
+        start = time.perf_counter()
+        with self._lock, self._file_lock:
+            self._links = self.scan()
+            folders = set(categories or ()) | set(desired.values())
+            if not self.dry_run:
+                for category in folders:
+                    os.makedirs(os.path.join(self.labeled_dir, category), exist_ok=True)
+            stats = self._apply(desired, set(self._links) | set(desired))
+            stats['folders_removed'] = self._prune_folders(folders)
+        stats['seconds'] = time.perf_counter() - start
+        logger.info(f"Reconciled {self.labeled_dir}: {stats['created']} created, {stats['moved']} moved, "
+                    f"{stats['removed']} removed, {stats['kept']} unchanged, {stats['errors']} errors "
+                    f"in {stats['seconds']:.2f}s")
+        return stats
+
+    def update(self, desired):
+        """Bring the links of just these images in line with desired {image: category or None}"""
+        with self._lock, self._file_lock:
+            if self._links is None:
+                self._links = self.scan()
+            wanted = {filename: category for filename, category in desired.items() if category is not None}
+            if not self.dry_run:
+                for category in set(wanted.values()):
+                    os.makedirs(os.path.join(self.labeled_dir, category), exist_ok=True)
+            stats = self._apply(wanted, set(desired))
+        if stats['created'] or stats['moved'] or stats['removed'] or stats['errors']:
+            logger.debug(f"Updated {len(desired)} images in {self.labeled_dir}: {stats}")
+        return stats
+
+    def _apply(self, desired, filenames):
+        stats = {'created': 0, 'moved': 0, 'removed': 0, 'kept': 0, 'errors': 0}
+        first_error = None
+        for filename in filenames:
+            want = desired.get(filename)
+            target = self.target(filename)
+            existing = self._links.get(filename, {})
+            # Links to drop; a relabelled image's link is renamed rather than recreated
+            stale = [category for category, link in existing.items()
+                     if category != want or _normalise(link) != _normalise(target)]
+            try:
+                if want is not None and (want not in existing or want in stale):
+                    dst_path = os.path.join(self.labeled_dir, want, filename)
+                    if want in stale:
+                        # Link in the right folder pointing elsewhere: replaced below
+                        stale.remove(want)
+                        existing.pop(want)
+                        stats['removed'] += 1
+                        self._unlink(dst_path)
+                    movable = [category for category in stale
+                               if _normalise(existing[category]) == _normalise(target)]
+                    if movable:
+                        source = movable[0]
+                        if not self.dry_run:
+                            os.replace(os.path.join(self.labeled_dir, source, filename), dst_path)
+                        stale.remove(source)
+                        existing.pop(source)
+                        stats['moved'] += 1
+                    else:
+                        self._link(target, dst_path)
+                        stats['created'] += 1
+                    existing[want] = target
+                elif want is not None:
+                    stats['kept'] += 1
+                for category in stale:
+                    self._unlink(os.path.join(self.labeled_dir, category, filename))
+                    existing.pop(category)
+                    stats['removed'] += 1
+            except OSError as e:
+                stats['errors'] += 1
+                first_error = first_error or e
+            if existing:
+                self._links[filename] = existing
+            else:
+                self._links.pop(filename, None)
+        if first_error is not None:
+            logger.error(f"{stats['errors']} links under {self.labeled_dir} could not be updated, "
+                         f"first error: {first_error}")
+        return stats
+
+    def _link(self, target, dst_path):
+        if self.dry_run:
+            return
+        try:
+            make_link(target, dst_path)
+        except FileExistsError:
+            # Another process got there first, or a link we did not know about
+            if not os.path.islink(dst_path):
+                raise
+            if _normalise(os.readlink(dst_path)) != _normalise(target):
+                os.unlink(dst_path)
+                make_link(target, dst_path)
+
+    def _unlink(self, path):
+        if self.dry_run:
+            return
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _prune_folders(self, keep):
+        removed = 0
+        try:
+            folders = [entry for entry in os.scandir(self.labeled_dir) if entry.is_dir(follow_symlinks=False)]
+        except FileNotFoundError:
+            return removed
+        for folder in folders:
+            if folder.name in keep:
+                continue
+            try:
+                if not self.dry_run:
+                    os.rmdir(folder.path)
+                removed += 1
+            except OSError:
+                # Not empty: holds files we do not manage
+                pass
+        return removed
+
+
+class LabeledTreeSync:
+    """Applies label changes to the tree on a background thread, batched off the request path
+
+    desired(filenames) returns {image: category or None} for the given images,
+    or for every labelled image when filenames is None; categories() returns
+    the category ids that get a folder.
+    """
+
+    def __init__(self, tree, desired, categories, delay=1.0):
+        self.tree = tree
+        self.desired = desired
+        self.categories = categories
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._full = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='labeled-tree', daemon=True)
+        self._thread.start()
+
+    def mark(self, filenames):
+        """Queue images whose label changed"""
+        with self._lock:
+            self._pending.update(filenames)
+        self._wake.set()
+
+    def reconcile(self):
+        """Queue a reconciliation of the whole tree"""
+        with self._lock:
+            self._full = True
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait()
+            # Let a burst of labels accumulate into one batch
+            self._stop.wait(self.delay)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Apply whatever is queued now"""
+        with self._lock:
+            full, pending = self._full, self._pending
+            self._full, self._pending = False, set()
+        try:
+            if full:
+                self.tree.reconcile(self.desired(None), self.categories())
+            elif pending:
+                self.tree.update(self.desired(pending))
+        except Exception as e:
+            logger.error(f"Error updating {self.tree.labeled_dir}: {e}")
+
+    def shutdown(self):
+        """Stop the thread after applying what is still queued"""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=30)
+        self.flush()
+
+
+def main(argv=None):
+    from label_store import LabelStore
+    from image_queue import is_image_file
+
+    parser = argparse.ArgumentParser(description="Rebuild the labeled/ symlink tree from the labels")
+    parser.add_argument('--cache-dir', default=os.path.join(os.getcwd(), 'cache'),
+                        help="Cache directory containing images/, labels.csv and labels.journal")
+    parser.add_argument('--labeled-dir', default=os.path.join(os.getcwd(), 'labeled'))
+    parser.add_argument('--categories', default='categories.json',
+                        help="Categories file; labels of other categories get no links")
+    parser.add_argument('--all-labels', action='store_true',
+                        help="Link every label, whether or not it is a current category")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would change")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    images_dir = os.path.join(args.cache_dir, 'images')
+    labels = LabelStore(os.path.join(args.cache_dir, 'labels.csv'), os.path.join(args.cache_dir, 'labels.journal'),
+                        read_only=True)
+    categories = None
+    if not args.all_labels:
+        try:
+            with open(args.categories, 'r') as f:
+                categories = set(json.load(f))
+        except FileNotFoundError:
+            logger.warning(f"{args.categories} not found, linking every label")
+    images = {f for f in os.listdir(images_dir) if is_image_file(f)}
+    desired = {filename: label for filename, label in labels.items()
+               if label and filename in images and (categories is None or label in categories)}
+
+    tree = LabeledTree(args.labeled_dir, images_dir, dry_run=args.dry_run)
+    stats = tree.reconcile(desired, categories)
+    if args.dry_run:
+        logger.info("Dry run, nothing was changed")
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+In-process counters, histograms and per-request stage timings.
+
+The app times the stages of each request (label reload, queue refresh, face
+analysis, template rendering, ...) with `stage()`. Each stage feeds a
+histogram and the request's own timings, which the app can return in a
+Server-Timing header so the browser's network panel shows where a slow
+request spent its time. `render()` produces the Prometheus text format
+served at /metrics; values owned by other objects (cache hit counters, queue
+sizes) are read at scrape time through collectors.
+"""
+
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+# Seconds; covers cache hits (sub-millisecond) up to cold face detection
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                       .replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic count per label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observations per label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for labels, entry in self._values.items():
+                for bound, count in zip(self.buckets, entry):
+                    result.append((f"{self.name}_bucket", labels + (f"{bound:g}",), count))
+                result.append((f"{self.name}_bucket", labels + ('+Inf',), entry[-1]))
+                result.append((f"{self.name}_sum", labels, entry[-2]))
+                result.append((f"{self.name}_count", labels, entry[-1]))
+        return result
+
+
+class Registry:
+    """Metrics of one process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._local = threading.local()
+        self.stages = self.histogram('app_stage_seconds', "Time spent in each stage of a request", ['stage'])
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, function):
+        """Register a function returning [(name, kind, help, [(labels dict, value)])] at scrape time"""
+        self._collectors.append(function)
+        return function
+
+    # ------------------------------------------------------------------
+    # Per-request stage timing
+    # ------------------------------------------------------------------
+
+    def start_request(self):
+        self._local.stages = []
+        self._local.start = time.perf_counter()
+
+    def finish_request(self):
+        """(total seconds, [(stage, seconds)]) of the request on this thread"""
+        stages = getattr(self._local, 'stages', None)
+        if stages is None:
+            return None, []
+        elapsed = time.perf_counter() - self._local.start
+        self._local.stages = None
+        return elapsed, stages
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block as a named stage of the current request"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages.observe(elapsed, name)
+            stages = getattr(self._local, 'stages', None)
+            if stages is not None:
+                stages.append((name, elapsed))
+
+    def timed(self, name):
+        """Decorator running a function as a named stage"""
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    # ------------------------------------------------------------------
+    # Exposition
+    # ------------------------------------------------------------------
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            names = metric.labelnames
+            for sample, labels, value in metric.samples():
+                sample_names = names + ('le',) if len(labels) > len(names) else names
+                lines.append(f"{sample}{_format_labels(sample_names, labels)} {_format_value(value)}")
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} "
+                                 f"{_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def server_timing(total, stages):
+    """Server-Timing header value; repeated stages are summed"""
+    totals = {}
+    for name, seconds in stages:
+        totals[name] = totals.get(name, 0.0) + seconds
+    parts = [f"{name};dur={1000 * seconds:.1f}" for name, seconds in totals.items()]
+    parts.append(f"total;dur={1000 * total:.1f}")
+    return ', '.join(parts)
@@ -0,0 +1,230 @@
+"""
+Full-text index of the OCR text files in cache/ocr/.
+
+The text of every <image stem>.txt is stored in a SQLite database
+(cache/ocr_index.sqlite) with an FTS5 table, so finding "all receipts" is an
+index lookup instead of opening thousands of files. SQLite builds without
+FTS5 fall back to a plain table searched with LIKE.
+
+The index is kept up to date incrementally: the app re-lists cache/ocr/ when
+its mtime changes and only indexes names it has not seen, and worker.py
+indexes the files it has just pulled. The database runs in WAL mode so both
+processes can use it at once. The directory mtime of the last listing is
+stored with the index, so a restart does not re-list an unchanged directory.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+
+from state import file_stamp
+
+logger = logging.getLogger(__name__)
+
+OCR_EXTENSION = '.txt'
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+# A document's rowid is its row's in files; `stem` in docs is only returned by searches,
+# since looking it up there (an UNINDEXED FTS5 column) scans the whole table
+_FILE_ROWID = '(SELECT rowid FROM files WHERE stem = ?)'
+
+
+def ocr_stem(filename):
+    """Key of an image's OCR text: the file name without extension"""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+class OcrIndex:
+    """SQLite full-text index of OCR text, keyed by image stem"""
+
+    def __init__(self, db_path, ocr_dir, poll_interval=5.0):
+        self.db_path = db_path
+        self.ocr_dir = ocr_dir
+        self.poll_interval = poll_interval
+        self._lock = threading.RLock()
+        self._dir_mtime = None
+        self._last_poll = 0.0
+        # Bumped whenever documents are added or removed, here or through another connection
+        self.version = 0
+        self._data_version = None
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self.fts = self._create_schema()
+        self._key_docs_by_file_rowid()
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'dir_mtime'").fetchone()
+        if row is not None:
+            self._dir_mtime = int(row[0])
+
+    def _create_schema(self):
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS files '
+                             '(stem TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            try:
+                self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5"
+                                 "(stem UNINDEXED, text, tokenize='unicode61 remove_diacritics 2')")
+                return True
+            except sqlite3.OperationalError:
+                pass
+        # Either this SQLite has no FTS5 or an earlier run created the fallback table
+        with self._db:
+            row = self._db.execute("SELECT sql FROM sqlite_master WHERE name = 'docs'").fetchone()
+            if row is not None and 'fts5' in row[0].lower():
+                return True
+            logger.warning("SQLite FTS5 not available, OCR search falls back to LIKE scans")
+            self._db.execute('CREATE TABLE IF NOT EXISTS docs (stem TEXT PRIMARY KEY, text TEXT)')
+        return False
+
+    def _key_docs_by_file_rowid(self):
+        """Start an index from before documents shared their file's rowid over"""
+        with self._db:
+            if self._db.execute("SELECT 1 FROM meta WHERE key = 'docs_rowid'").fetchone() is not None:
+                return
+            if self._db.execute('SELECT 1 FROM files LIMIT 1').fetchone() is not None:
+                logger.info("OCR index predates rowid-keyed documents, reindexing")
+            self._db.execute('DELETE FROM docs')
+            self._db.execute('DELETE FROM files')
+            self._db.execute("DELETE FROM meta WHERE key = 'dir_mtime'")
+            self._db.execute("INSERT INTO meta (key, value) VALUES ('docs_rowid', '1')")
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    # ------------------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------------------
+
+    def refresh(self, force=False):
+        """Index new and drop deleted OCR files if the directory changed since the last look"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_poll < self.poll_interval:
+                return False
+            self._last_poll = now
+            # Changes committed by other processes (worker.py, other server processes)
+            data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                if self._data_version is not None:
+                    self.version += 1
+                self._data_version = data_version
+            try:
+                mtime = os.stat(self.ocr_dir).st_mtime_ns
+            except OSError:
+                return False
+            if not force and mtime == self._dir_mtime:
+                return False
+            self._dir_mtime = mtime
+
+            try:
+                on_disk = {ocr_stem(f) for f in os.listdir(self.ocr_dir) if f.endswith(OCR_EXTENSION)}
+            except OSError as e:
+                logger.error(f"Error listing OCR directory: {e}")
+                return False
+            indexed = {row[0] for row in self._db.execute('SELECT stem FROM files')}
+            added = self.update(on_disk - indexed)
+            removed = self.remove(indexed - on_disk)
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('dir_mtime', ?)", (str(mtime),))
+            if added or removed:
+                logger.info(f"OCR index: {added} added, {removed} removed ({len(on_disk)} documents)")
+            return bool(added or removed)
+
+    def rebuild(self):
+        """Re-check every file's stamp and reindex the changed ones"""
+        with self._lock:
+            known = {row[0]: (row[1], row[2]) for row in
+                     self._db.execute('SELECT stem, mtime_ns, size FROM files')}
+            changed = []
+            for name in os.listdir(self.ocr_dir):
+                if name.endswith(OCR_EXTENSION):
+                    stem = ocr_stem(name)
+                    if known.pop(stem, None) != file_stamp(os.path.join(self.ocr_dir, name)):
+                        changed.append(stem)
+            self.update(changed)
+            self.remove(known)
+            logger.info(f"OCR index rebuilt: {len(changed)} reindexed, {len(known)} removed")
+
+    def update(self, names):
+        """(Re)index OCR files given by image or OCR file name; returns how many were indexed"""
+        rows = []
+        for name in names:
+            stem = ocr_stem(name)
+            path = os.path.join(self.ocr_dir, stem + OCR_EXTENSION)
+            stamp = file_stamp(path)
+            if stamp is None:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                    text = f.read()
+            except OSError as e:
+                logger.error(f"Error reading OCR text {path}: {e}")
+                continue
+            rows.append((stem, text, stamp))
+        if not rows:
+            return 0
+
+        with self._lock, self._db:
+            # Upserted rather than replaced so a file keeps its rowid, which is its document's rowid
+            self._db.executemany('INSERT INTO files (stem, mtime_ns, size) VALUES (?, ?, ?) '
+                                 'ON CONFLICT (stem) DO UPDATE SET mtime_ns = excluded.mtime_ns, size = excluded.size',
+                                 [(r[0],) + r[2] for r in rows])
+            self._db.executemany(f'DELETE FROM docs WHERE rowid = {_FILE_ROWID}', [(r[0],) for r in rows])
+            self._db.executemany(f'INSERT INTO docs (rowid, stem, text) VALUES ({_FILE_ROWID}, ?, ?)',
+                                 [(r[0], r[0], r[1]) for r in rows])
+            self.version += 1
+        return len(rows)
+
+    def remove(self, stems):
+        stems = [(stem,) for stem in stems]
+        if not stems:
+            return 0
+        with self._lock, self._db:
+            self._db.executemany(f'DELETE FROM docs WHERE rowid = {_FILE_ROWID}', stems)
+            self._db.executemany('DELETE FROM files WHERE stem = ?', stems)
+            self.version += 1
+        return len(stems)
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def text(self, filename):
+        """Indexed OCR text of an image, or None if it is not indexed"""
+        with self._lock:
+            row = self._db.execute('SELECT docs.text FROM files JOIN docs ON docs.rowid = files.rowid '
+                                   'WHERE files.stem = ?', (ocr_stem(filename),)).fetchone()
+        return row[0] if row else None
+
+    def search(self, query, limit=100):
+        """[(stem, snippet)] of documents containing every word of the query (prefix match)
+
+        Results are ranked by relevance with FTS5, by name otherwise.
+        """
+        tokens = _TOKEN.findall(query)
+        if not tokens:
+            return []
+        with self._lock:
+            if self.fts:
+                match = ' '.join(f'"{token}"*' for token in tokens)
+                rows = self._db.execute(
+                    "SELECT stem, snippet(docs, 1, '[', ']', '...', 12) FROM docs "
+                    "WHERE docs MATCH ? ORDER BY rank LIMIT ?", (match, limit)).fetchall()
+            else:
+                where = ' AND '.join(['text LIKE ?'] * len(tokens))
+                rows = self._db.execute(
+                    f"SELECT stem, substr(text, 1, 120) FROM docs WHERE {where} ORDER BY stem LIMIT ?",
+                    [f'%{token}%' for token in tokens] + [limit]).fetchall()
+        return rows
+
+    def matching_stems(self, query):
+        """Set of stems matching the query, unranked (for filtering)"""
+        return {stem for stem, _ in self.search(query, limit=-1)}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,304 @@
+"""
+Filtered and reordered views of the labelling queue.
+
+A review session can restrict the queue to images containing a known person,
+images whose OCR text matches a query or images without faces, and order it
+by name or file mtime. Each filter is answered from an index that is kept up
+to date incrementally, never by scanning images per request:
+
+- people: the nearest known face of every face in the face cache, updated as
+  records are appended to the cache and as known faces are added; renaming a
+  known face costs nothing since names are resolved at query time
+- OCR: the full-text index in ocr_index.py
+- mtime: file mtimes, stat'ed once per image
+
+The candidate list of a view is built once per change of the underlying
+indexes; stepping through it only skips images that have been labelled since.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from face_match import FaceMatcher, DEFAULT_TOLERANCE
+from image_queue import queue_order
+
+logger = logging.getLogger(__name__)
+
+ORDERS = ('name', 'mtime', 'newest')
+
+# Images read from the face cache per distance computation when known faces are added
+MATCH_BATCH = 4096
+
+# person: known person's name, ocr: full-text query, no_faces: only images
+# analysed and found to have no faces, order: one of ORDERS
+QueueFilter = namedtuple('QueueFilter', 'person ocr no_faces order')
+
+
+def parse_filter(args):
+    """QueueFilter from request arguments, or None for the plain queue
+
+    Raises ValueError for an unknown order.
+    """
+    person = args.get('person', '').strip() or None
+    ocr = args.get('ocr', '').strip() or None
+    no_faces = args.get('faces', '') == 'none'
+    order = args.get('order', '') or 'name'
+    if order not in ORDERS:
+        raise ValueError(f"Unknown order '{order}', expected one of {', '.join(ORDERS)}")
+    if person is None and ocr is None and not no_faces and order == 'name':
+        return None
+    return QueueFilter(person, ocr, no_faces, order)
+
+
+def filter_args(queue_filter):
+    """Request arguments that reproduce a QueueFilter (empty for the plain queue)"""
+    if queue_filter is None:
+        return {}
+    args = {}
+    if queue_filter.person:
+        args['person'] = queue_filter.person
+    if queue_filter.ocr:
+        args['ocr'] = queue_filter.ocr
+    if queue_filter.no_faces:
+        args['faces'] = 'none'
+    if queue_filter.order != 'name':
+        args['order'] = queue_filter.order
+    return args
+
+
+class PeopleIndex:
+    """Nearest known face of every face in the face cache
+
+    Faces are kept as flat arrays (owning image, nearest known row, distance),
+    so "images showing X" is one vectorized mask over all faces.
+    """
+
+    def __init__(self, face_cache, tolerance=DEFAULT_TOLERANCE):
+        self.face_cache = face_cache
+        self.tolerance = tolerance
+        self._lock = threading.RLock()
+        # Bumped whenever query results may have changed
+        self.version = 0
+        self._reset()
+
+    def _reset(self):
+        self._generation = None
+        self._position = 0
+        self._rows = 0
+        self._files = []
+        self._file_ids = {}
+        # Per image: slice of the face arrays holding its latest analysis
+        self._spans = {}
+        self._owner = np.empty(0, dtype=np.int32)
+        self._nearest = np.empty(0, dtype=np.int32)
+        self._distance = np.empty(0, dtype=np.float32)
+        self._live = np.empty(0, dtype=bool)
+        self.faceless = set()
+
+    def update(self, matcher):
+        """Index new face cache records and faces added to the matcher since the last call"""
+        with self._lock:
+            self.face_cache.refresh()
+            if self.face_cache.generation != self._generation or len(matcher) < self._rows:
+                # Cache compacted or known faces replaced: positions and rows no longer line up
+                self._reset()
+                self._generation = self.face_cache.generation
+                self.version += 1
+
+            if len(matcher) > self._rows:
+                self._match_new_rows(matcher)
+
+            self._position, filenames = self.face_cache.records_since(self._position)
+            if filenames:
+                self._add_images(list(OrderedDict.fromkeys(filenames)), matcher)
+
+    def _add_images(self, filenames, matcher):
+        owners = []
+        encodings = []
+        for filename in filenames:
+            analysis = self.face_cache.read(filename)
+            if analysis is None:
+                continue
+            file_id = self._file_ids.get(filename)
+            if file_id is None:
+                file_id = self._file_ids[filename] = len(self._files)
+                self._files.append(filename)
+            old = self._spans.pop(filename, None)
+            if old is not None:
+                self._live[old[0]:old[1]] = False
+
+            face_encodings = analysis[1]
+            if len(face_encodings):
+                self.faceless.discard(filename)
+                start = len(self._owner) + len(owners)
+                self._spans[filename] = (start, start + len(face_encodings))
+                owners.extend([file_id] * len(face_encodings))
+                encodings.append(face_encodings)
+            else:
+                self.faceless.add(filename)
+
+        if owners:
+            nearest, distance = matcher.nearest(np.concatenate(encodings))
+            self._owner = np.concatenate([self._owner, np.asarray(owners, dtype=np.int32)])
+            self._nearest = np.concatenate([self._nearest, nearest.astype(np.int32)])
+            self._distance = np.concatenate([self._distance, distance.astype(np.float32)])
+            self._live = np.concatenate([self._live, np.ones(len(owners), dtype=bool)])
+        self._rows = len(matcher)
+        self.version += 1
+
+    def _match_new_rows(self, matcher):
+        """Let faces already indexed move to a newly added known face if it is nearer"""
+        if self._spans:
+            new = FaceMatcher(matcher.matrix[self._rows:], matcher.names[self._rows:])
+            spans = list(self._spans.items())
+            for first in range(0, len(spans), MATCH_BATCH):
+                positions = []
+                encodings = []
+                for filename, (start, end) in spans[first:first + MATCH_BATCH]:
+                    analysis = self.face_cache.read(filename)
+                    if analysis is not None and len(analysis[1]) == end - start:
+                        positions.append(np.arange(start, end))
+                        encodings.append(analysis[1])
+                if not positions:
+                    continue
+                positions = np.concatenate(positions)
+                nearest, distance = new.nearest(np.concatenate(encodings))
+                closer = distance < self._distance[positions]
+                self._nearest[positions[closer]] = nearest[closer] + self._rows
+                self._distance[positions[closer]] = distance[closer]
+            logger.info(f"Matched {len(spans)} analysed images against "
+                        f"{len(matcher) - self._rows} new known faces")
+        self._rows = len(matcher)
+        self.version += 1
+
+    def images_with(self, name, matcher):
+        """Set of images with a face recognised as name"""
+        with self._lock:
+            rows = np.flatnonzero(np.asarray(matcher.names[:self._rows], dtype=object) == name)
+            if not len(rows):
+                return set()
+            mask = self._live & (self._distance <= self.tolerance) & np.isin(self._nearest, rows)
+            return {self._files[i] for i in np.unique(self._owner[mask])}
+
+
+class QueueView:
+    """Unlabelled images passing a filter, in the filter's order"""
+
+    def __init__(self, image_queue, candidates, key, front=()):
+        self.image_queue = image_queue
+        self.candidates = candidates
+        self._members = frozenset(candidates)
+        self.key = key
+        # Request threads share a cached view, and peek() moves the cursor
+        self._lock = threading.Lock()
+        self._cursor = 0
+        # Undone images come back first, as in the main queue
+        self.front = OrderedDict.fromkeys(front)
+
+    def __contains__(self, filename):
+        return filename in self._members
+
+    def peek(self, count):
+        """The next `count` unlabelled images of the view"""
+        with self._lock:
+            self.front = OrderedDict.fromkeys(f for f in self.front if f in self.image_queue)
+            result = list(self.front)[:count]
+            # Images before the cursor are all labelled; skip past newly labelled ones
+            while self._cursor < len(self.candidates) and self.candidates[self._cursor] not in self.image_queue:
+                self._cursor += 1
+            position = self._cursor
+            while len(result) < count and position < len(self.candidates):
+                filename = self.candidates[position]
+                if filename in self.image_queue and filename not in self.front:
+                    result.append(filename)
+                position += 1
+            return result
+
+    def next(self):
+        upcoming = self.peek(1)
+        return upcoming[0] if upcoming else None
+
+    def promote(self, filename):
+        with self._lock:
+            self.front[filename] = None
+            self.front.move_to_end(filename, last=False)
+            self._cursor = 0
+
+
+class QueueFilters:
+    """Cache of queue views, rebuilt only when an index they depend on changes"""
+
+    def __init__(self, image_queue, ocr_index, people_index, images_dir, max_views=8):
+        self.image_queue = image_queue
+        self.ocr_index = ocr_index
+        self.people_index = people_index
+        self.images_dir = images_dir
+        self.max_views = max_views
+        self._lock = threading.RLock()
+        self._views = OrderedDict()
+        self._mtimes = {}
+
+    def view(self, queue_filter, matcher):
+        """The QueueView for a filter, up to date with the indexes"""
+        with self._lock:
+            uses_faces = queue_filter.person is not None or queue_filter.no_faces
+            if uses_faces:
+                self.people_index.update(matcher)
+            key = (self.image_queue.version,
+                   self.ocr_index.version if queue_filter.ocr else None,
+                   (self.people_index.version, matcher) if uses_faces else None)
+
+            view = self._views.get(queue_filter)
+            if view is None or view.key != key:
+                candidates = self._candidates(queue_filter, matcher)
+                view = QueueView(self.image_queue, candidates, key,
+                                 front=view.front if view is not None else ())
+                logger.info(f"Queue view {queue_filter} built: {len(candidates)} images")
+            self._views[queue_filter] = view
+            self._views.move_to_end(queue_filter)
+            while len(self._views) > self.max_views:
+                self._views.popitem(last=False)
+            return view
+
+    def promote(self, filename):
+        """Put an undone image back at the front of every view that contains it"""
+        with self._lock:
+            for view in self._views.values():
+                if filename in view:
+                    view.promote(filename)
+
+    def _candidates(self, queue_filter, matcher):
+        images = None
+        if queue_filter.ocr:
+            stems = self.ocr_index.matching_stems(queue_filter.ocr)
+            images = {self.image_queue.image_for_stem(stem) for stem in stems}
+            images.discard(None)
+        if queue_filter.person:
+            people = self.people_index.images_with(queue_filter.person, matcher)
+            images = people if images is None else images & people
+        if queue_filter.no_faces:
+            faceless = self.people_index.faceless
+            images = set(faceless) if images is None else images & faceless
+        if images is None:
+            images = self.image_queue.filenames()
+        else:
+            # Analyses of images that have since left the directory are dropped here
+            images = [f for f in images if self.image_queue.has_image(f)]
+
+        if queue_filter.order == 'name':
+            return queue_order(images)
+        mtimes = self._image_mtimes(images)
+        return sorted(images, key=lambda f: (mtimes[f], f), reverse=queue_filter.order == 'newest')
+
+    def _image_mtimes(self, filenames):
+        for filename in filenames:
+            if filename not in self._mtimes:
+                try:
+                    self._mtimes[filename] = os.stat(os.path.join(self.images_dir, filename)).st_mtime_ns
+                except OSError:
+                    self._mtimes[filename] = 0
+        return self._mtimes
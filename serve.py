@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Production server for the labelling app.
+
+`python app.py` runs Flask's single-process debug server. This runs the same
+app under gunicorn with several worker processes, so face detection and
+image resizing for different requests use different cores instead of
+queueing behind one interpreter. The processes share cache/ safely: label,
+face and face-cache writes serialise on lock files, and before each request
+every process picks up the labels, known faces and face analyses appended by
+the others or by index_faces.py (see refresh_state in app.py). The cores are divided between the server processes and
+their background face analysis pools.
+
+gunicorn is not available on Windows; there the app is served by waitress in
+a single process with a thread pool. Run from the directory holding cache/:
+
+    python serve.py
+    python serve.py --workers 4 --threads 8 --port 8000
+"""
+
+import os
+import sys
+import logging
+import argparse
+
+logger = logging.getLogger("Serve")
+
+DEFAULT_WORKERS = int(os.environ.get('SERVE_WORKERS', '0'))
+DEFAULT_THREADS = int(os.environ.get('SERVE_THREADS', '4'))
+
+# Seconds a request may take; a cold face detection of a large photo takes a few
+REQUEST_TIMEOUT = 120
+
+
+def default_workers():
+    """Server processes when not configured: half the cores, at least two"""
+    return max(2, (os.cpu_count() or 2) // 2)
+
+
+def face_workers_per_process(workers):
+    """Background face analysis processes per server process, so all of them together fill the cores"""
+    return max(1, ((os.cpu_count() or 2) - workers) // workers)
+
+
+def run_gunicorn(host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class LabelerApplication(BaseApplication):
+        def load_config(self):
+            # Each worker imports the app itself (no preload): its thread and
+            # process pools must not be inherited through fork
+            self.cfg.set('bind', f"{host}:{port}")
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', REQUEST_TIMEOUT)
+            self.cfg.set('graceful_timeout', 30)
+
+        def load(self):
+            from app import app
+            return app
+
+    LabelerApplication().run()
+
+
+def run_waitress(host, port, threads):
+    from waitress import serve
+    from app import app
+
+    serve(app, host=host, port=port, threads=threads, channel_timeout=REQUEST_TIMEOUT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the labelling app with several worker processes")
+    parser.add_argument('--host', default=os.environ.get('SERVE_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVE_PORT', '5000')))
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Server processes (default: half the cores, at least two)")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help="Request threads per server process (default: %(default)s)")
+    args = parser.parse_args(argv)
+    workers = args.workers or default_workers()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    try:
+        import gunicorn  # noqa: F401
+        use_gunicorn = os.name != 'nt'
+    except ImportError:
+        use_gunicorn = False
+
+    if use_gunicorn:
+        os.environ.setdefault('FACE_WORKERS', str(face_workers_per_process(workers)))
+        logger.info(f"Serving on {args.host}:{args.port} with {workers} processes x {args.threads} threads, "
+                    f"{os.environ['FACE_WORKERS']} face analysis processes each")
+        run_gunicorn(args.host, args.port, workers, args.threads)
+        return 0
+
+    try:
+        import waitress  # noqa: F401
+    except ImportError:
+        logger.error("Neither gunicorn nor waitress is installed; install with: pip install gunicorn waitress")
+        return 1
+    if workers > 1:
+        logger.warning("gunicorn is not available here, serving from a single process with waitress")
+    logger.info(f"Serving on {args.host}:{args.port} with {args.threads} threads")
+    run_waitress(args.host, args.port, args.threads)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
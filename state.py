@@ -0,0 +1,125 @@
+"""
+Process-wide state helpers.
+
+Files the app reads on every request (categories.json, faces.pkl) are loaded
+once and served from memory. Each access does a single os.stat and only
+reloads when the file's mtime or size changed, e.g. because worker.py pulled
+a newer copy from the NAS. Writes go straight through to disk.
+
+When several server processes share the cache (serve.py with more than one
+worker), writers serialise on a FileLock next to the file they change.
+"""
+
+import os
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+def file_stamp(path):
+    """Cheap change detector for a file: (mtime_ns, size) or None if missing"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class FileLock:
+    """Exclusive lock shared by threads and processes, held through a lock file
+
+    Re-entrant within a thread, so a locked method can call another one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                else:
+                    # LK_LOCK retries for 10 seconds before giving up; keep waiting
+                    while True:
+                        try:
+                            msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            continue
+            except BaseException:
+                if self._fd is not None:
+                    os.close(self._fd)
+                    self._fd = None
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+        self._lock.release()
+
+
+class WatchedFile:
+    """In-memory copy of a file that reloads only when the file changes on disk"""
+
+    def __init__(self, path, loader, saver):
+        self.path = path
+        self._loader = loader
+        self._saver = saver
+        self._lock = threading.RLock()
+        self._value = None
+        self._stamp = None
+        self._loaded = False
+        # Bumped on every load or save so callers can cache derived data
+        self.version = 0
+
+    def get(self):
+        """Return the cached value, reloading if the file was modified externally"""
+        with self._lock:
+            stamp = file_stamp(self.path)
+            if not self._loaded or stamp != self._stamp:
+                if self._loaded:
+                    logger.info(f"{self.path} changed on disk, reloading")
+                self._value = self._loader()
+                self._stamp = stamp
+                self._loaded = True
+                self.version += 1
+            return self._value
+
+    def save(self, value):
+        """Write the value through to disk and keep it as the cached copy"""
+        with self._lock:
+            self._saver(value)
+            self._value = value
+            self._stamp = file_stamp(self.path)
+            self._loaded = True
+            self.version += 1
+
+    def invalidate(self):
+        """Force a reload on the next access"""
+        with self._lock:
+            self._loaded = False
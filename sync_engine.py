@@ -0,0 +1,346 @@
+"""
+Manifest-based directory sync used by worker.py.
+
+Each channel copies one directory tree to another (NAS -> laptop for photos
+and OCR, laptop -> NAS for labels and faces). Instead of having rsync walk
+both trees on every run, a manifest of (size, mtime_ns, hash) per file is
+kept for each side under cache/sync/. A rescan only stats files; on trees
+that are only ever added to (the NAS photo and OCR folders) directories whose
+mtime has not changed are not even listed again. Hashes are computed only
+when size and mtime cannot settle whether a file changed.
+
+The delta is copied by a bounded pool of workers shared by all channels, and
+the channels themselves run concurrently. Any mounted directory works as
+either side, so a local folder can stand in for the NAS drive.
+"""
+
+import os
+import json
+import time
+import shutil
+import fnmatch
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK = 1 << 20
+# Trailing bytes an append-only file must share with the copy before only its tail is sent
+APPEND_CHECK_BYTES = 64 << 10
+
+# Plan operations
+COPY = 'copy'
+APPEND = 'append'
+
+
+def file_hash(path):
+    """Content hash used when size and mtime are not enough to compare two files"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def native_path(root, rel):
+    return os.path.join(root, *rel.split('/'))
+
+
+class Channel:
+    """One source -> destination tree and the rules for what to transfer
+
+    mode 'ignore_existing' copies files missing at the destination only;
+    'update' also replaces destination files older than the source. Files
+    matching append_patterns only ever grow, so just their new tail is copied.
+
+    order, if given, reorders the relative paths to transfer (most wanted
+    first); with window set they are transferred that many at a time, each
+    window finishing before the next starts.
+
+    on_transfer, if given, is called with the relative paths that arrived in
+    each window, so consumers can pick them up without rescanning.
+    """
+
+    def __init__(self, name, source, dest, mode='update', include=None, exclude=('*.tmp',),
+                 append_patterns=(), recursive=True, source_immutable=False,
+                 order=None, window=None, on_transfer=None):
+        self.name = name
+        self.source = source
+        self.dest = dest
+        self.mode = mode
+        self.include = include
+        self.exclude = exclude
+        self.append_patterns = append_patterns
+        self.recursive = recursive
+        # Files on the source side are never modified in place, so an unchanged
+        # directory mtime means an unchanged listing
+        self.source_immutable = source_immutable
+        self.order = order
+        self.window = window
+        self.on_transfer = on_transfer
+
+    def wants(self, rel):
+        name = rel.rsplit('/', 1)[-1]
+        if self.include is not None and not any(fnmatch.fnmatch(name, p) for p in self.include):
+            return False
+        return not any(fnmatch.fnmatch(name, p) for p in self.exclude)
+
+    def is_append_only(self, rel):
+        name = rel.rsplit('/', 1)[-1]
+        return any(fnmatch.fnmatch(name, p) for p in self.append_patterns)
+
+
+class Manifest:
+    """Last known state of both sides of a channel, persisted as JSON
+
+    Each side maps relative path -> [size, mtime_ns, hash or None] plus, for
+    the directory shortcut, relative dir -> [mtime_ns, [subdir names]].
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sides = {'source': self._empty(), 'dest': self._empty()}
+
+    @staticmethod
+    def _empty():
+        return {'files': {}, 'dirs': {}}
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for side in self.sides:
+                self.sides[side] = {'files': data[side]['files'], 'dirs': data[side]['dirs']}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable sync manifest {self.path}: {e}")
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.sides, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+
+def scan_tree(root, channel, previous, reuse_dirs=False):
+    """Stat the files of a channel under root, reusing what the manifest already knows
+
+    Returns a new manifest side. Hashes carry over for files whose size and
+    mtime are unchanged. With reuse_dirs, a directory whose mtime matches the
+    manifest is not listed again and its files are taken from the manifest.
+    """
+    files = {}
+    dirs = {}
+    if not os.path.isdir(root):
+        return {'files': files, 'dirs': dirs}
+
+    known_by_dir = {}
+    if reuse_dirs:
+        for rel, entry in previous['files'].items():
+            known_by_dir.setdefault(rel.rpartition('/')[0], []).append((rel, entry))
+
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        path = native_path(root, reldir) if reldir else root
+        try:
+            dir_mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+
+        old = previous['dirs'].get(reldir)
+        if reuse_dirs and old is not None and old[0] == dir_mtime:
+            dirs[reldir] = old
+            files.update(known_by_dir.get(reldir, ()))
+            stack.extend(f"{reldir}/{d}" if reldir else d for d in old[1])
+            continue
+
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    rel = f"{reldir}/{entry.name}" if reldir else entry.name
+                    if entry.is_dir():
+                        if channel.recursive:
+                            subdirs.append(entry.name)
+                            stack.append(rel)
+                    elif entry.is_file() and channel.wants(rel):
+                        st = entry.stat()
+                        files[rel] = [st.st_size, st.st_mtime_ns, None]
+        except OSError as e:
+            logger.error(f"Error listing {path}: {e}")
+            continue
+        dirs[reldir] = [dir_mtime, subdirs]
+
+    for rel, entry in files.items():
+        old = previous['files'].get(rel)
+        if old is not None and old[:2] == entry[:2]:
+            entry[2] = old[2]
+    return {'files': files, 'dirs': dirs}
+
+
+class SyncEngine:
+    """Runs channels concurrently, copying their deltas on a shared bounded pool
+
+    tasks, if given, are {name: callable returning {channel name: stats}} run
+    alongside the channels, e.g. the delta push of labels and faces.
+    """
+
+    def __init__(self, channels, state_dir, workers=4, tasks=None):
+        self.channels = channels
+        self.state_dir = state_dir
+        self.workers = workers
+        self.tasks = tasks or {}
+        self._copy_pool = None
+
+    def manifest_path(self, channel):
+        return os.path.join(self.state_dir, f"{channel.name}.json")
+
+    def run(self):
+        """Sync every channel; returns {channel name: stats}"""
+        start = time.time()
+        results = {}
+        self._copy_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sync-copy')
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.channels) + len(self.tasks) or 1,
+                                    thread_name_prefix='sync-channel') as channel_pool:
+                futures = {channel.name: channel_pool.submit(self.sync_channel, channel)
+                           for channel in self.channels}
+                tasks = {name: channel_pool.submit(task) for name, task in self.tasks.items()}
+                for name, future in futures.items():
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logger.error(f"Sync channel {name} failed: {e}", exc_info=True)
+                        results[name] = {'error': str(e)}
+                for name, future in tasks.items():
+                    try:
+                        results.update(future.result())
+                    except Exception as e:
+                        logger.error(f"Sync task {name} failed: {e}", exc_info=True)
+                        results[name] = {'error': str(e)}
+        finally:
+            self._copy_pool.shutdown(wait=True)
+            self._copy_pool = None
+        logger.info(f"Sync finished in {time.time() - start:.1f}s")
+        return results
+
+    def sync_channel(self, channel):
+        start = time.time()
+        manifest = Manifest(self.manifest_path(channel)).load()
+        source = scan_tree(channel.source, channel, manifest.sides['source'],
+                           reuse_dirs=channel.source_immutable)
+        dest = scan_tree(channel.dest, channel, manifest.sides['dest'])
+        manifest.sides = {'source': source, 'dest': dest}
+
+        plan = self.plan(channel, source, dest)
+        stats = {'files': len(source['files']), 'copied': 0, 'appended': 0,
+                 'bytes': 0, 'errors': 0, 'seconds': 0.0}
+        window = channel.window or len(plan) or 1
+        for first in range(0, len(plan), window):
+            batch = plan[first:first + window]
+            futures = [(op, rel, self._copy_pool.submit(self._transfer, channel, op, rel))
+                       for op, rel in batch]
+            done = []
+            for op, rel, future in futures:
+                try:
+                    transferred = future.result()
+                    st = os.stat(native_path(channel.dest, rel))
+                except Exception as e:
+                    logger.error(f"[{channel.name}] Error transferring {rel}: {e}")
+                    stats['errors'] += 1
+                    continue
+                dest['files'][rel] = [st.st_size, st.st_mtime_ns, source['files'][rel][2]]
+                stats['copied' if op == COPY else 'appended'] += 1
+                stats['bytes'] += transferred
+                done.append(rel)
+            if done and channel.on_transfer is not None:
+                try:
+                    channel.on_transfer(done)
+                except Exception as e:
+                    logger.error(f"[{channel.name}] Transfer hook failed: {e}", exc_info=True)
+            if len(batch) < len(plan):
+                # Checkpoint so an interrupted sync does not redo finished windows
+                manifest.save()
+                logger.info(f"[{channel.name}] {first + len(batch)}/{len(plan)} transferred")
+
+        manifest.save()
+        stats['seconds'] = time.time() - start
+        if plan:
+            logger.info(f"[{channel.name}] {stats['copied']} copied, {stats['appended']} appended, "
+                        f"{stats['bytes']} bytes, {stats['errors']} errors in {stats['seconds']:.1f}s")
+        else:
+            logger.info(f"[{channel.name}] Up to date ({stats['files']} files)")
+        return stats
+
+    def plan(self, channel, source, dest):
+        """[(operation, relpath)] needed to bring dest up to date with source"""
+        plan = []
+        for rel, entry in source['files'].items():
+            theirs = dest['files'].get(rel)
+            if theirs is None:
+                plan.append((COPY, rel))
+            elif channel.mode == 'ignore_existing' or entry[:2] == theirs[:2]:
+                continue
+            elif channel.is_append_only(rel) and theirs[0] < entry[0]:
+                plan.append((APPEND, rel))
+            elif theirs[1] >= entry[1] and not channel.is_append_only(rel):
+                # Destination is newer; like rsync --update, leave it alone
+                continue
+            elif theirs[0] != entry[0] or self._hash(channel.source, rel, entry) != \
+                    self._hash(channel.dest, rel, theirs):
+                plan.append((COPY, rel))
+        plan.sort(key=lambda item: item[1])
+        if channel.order is not None:
+            ops = dict((rel, op) for op, rel in plan)
+            plan = [(ops[rel], rel) for rel in channel.order(list(ops))]
+        return plan
+
+    @staticmethod
+    def _hash(root, rel, entry):
+        if entry[2] is None:
+            entry[2] = file_hash(native_path(root, rel))
+        return entry[2]
+
+    def _transfer(self, channel, op, rel):
+        """Copy or append one file; returns the number of bytes written"""
+        src = native_path(channel.source, rel)
+        dst = native_path(channel.dest, rel)
+        if op == APPEND:
+            written = self._append_tail(src, dst)
+            if written is not None:
+                return written
+            logger.warning(f"[{channel.name}] {rel} diverged from the source, copying it whole")
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp_path = f"{dst}.{threading.get_ident()}.tmp"
+        shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dst)
+        return os.path.getsize(dst)
+
+    @staticmethod
+    def _append_tail(src, dst):
+        """Append the part of src beyond dst's length; None if dst does not end like src's prefix
+
+        Only the last APPEND_CHECK_BYTES of dst are compared with the same
+        range of src, so an append costs the new bytes rather than the file.
+        """
+        offset = os.path.getsize(dst)
+        start = max(0, offset - APPEND_CHECK_BYTES)
+        with open(src, 'rb') as f_src:
+            f_src.seek(start)
+            window = f_src.read(offset - start)
+            with open(dst, 'rb') as f_dst:
+                f_dst.seek(start)
+                if f_dst.read() != window:
+                    return None
+            with open(dst, 'ab') as f_dst:
+                shutil.copyfileobj(f_src, f_dst)
+                written = f_dst.tell() - offset
+        st = os.stat(src)
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+        return written
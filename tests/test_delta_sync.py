@@ -0,0 +1,111 @@
+import os
+import csv
+import json
+import shutil
+
+import numpy as np
+
+import delta_sync
+from face_store import FaceStore, ENCODING_DIM
+from label_store import LabelStore
+
+
+def test_moved_face_reaches_the_merge(tmp_path):
+    faces_dir = str(tmp_path / 'faces')
+    nas_faces = str(tmp_path / 'nas')
+    store = FaceStore(faces_dir)
+    store.add_face(np.zeros(ENCODING_DIM), 'Alice')
+    store.add_face(np.ones(ENCODING_DIM), 'Alice')
+    delta_sync.push_faces(faces_dir, nas_faces, machine='m1')
+
+    store.assign_row(1, 'Bob')
+    stats = delta_sync.push_faces(faces_dir, nas_faces, machine='m1')
+    assert stats['rows'] == 0 and stats['moved'] == 1
+    delta_sync.merge_faces(nas_faces)
+    with np.load(os.path.join(nas_faces, delta_sync.MERGED_FACES)) as merged:
+        assert list(merged['names']) == ['Alice', 'Bob']
+
+
+def merged_labels(nas_labels):
+    delta_sync.merge_labels(nas_labels)
+    with open(os.path.join(nas_labels, delta_sync.MERGED_LABELS), newline='', encoding='utf-8') as f:
+        return {row['filename']: row['keep'] for row in csv.DictReader(f)}
+
+
+def test_first_push_counts_each_label_once(tmp_path):
+    csv_path = str(tmp_path / 'labels.csv')
+    journal_path = str(tmp_path / 'labels.journal')
+    ack_path = str(tmp_path / 'sync' / 'labels_ack.json')
+    nas_labels = str(tmp_path / 'nas')
+    store = LabelStore(csv_path, journal_path, ack_path=ack_path)
+    store.add('a.jpg', 'keep')
+    store.add('b.jpg', 'keep')
+    # Nothing acknowledged yet, so the journal keeps both records next to the CSV
+    store.compact()
+    store.add('c.jpg', 'discard')
+
+    delta_sync.push_labels(csv_path, journal_path, ack_path, nas_labels, machine='m1')
+    assert merged_labels(nas_labels) == {'a.jpg': 'keep', 'b.jpg': 'keep', 'c.jpg': 'discard'}
+
+    store.undo()
+    store.undo()
+    store.flush()
+    delta_sync.push_labels(csv_path, journal_path, ack_path, nas_labels, machine='m1')
+    assert merged_labels(nas_labels) == {'a.jpg': 'keep'}
+    store.close()
+
+
+def test_remote_last_seq_reads_past_a_large_record(tmp_path):
+    path = str(tmp_path / 'm1.jsonl')
+    snapshot = {'op': 'snapshot', 'labels': [[f"{i:08d}.jpg", 'keep'] for i in range(20000)], 'seq': 7}
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'op': 'label', 'filename': 'x.jpg', 'keep': 'keep', 'seq': 3}) + '\n')
+        f.write(json.dumps(snapshot) + '\n')
+        f.write('{"op": "label", "filena')
+    assert os.path.getsize(path) > 4 * delta_sync._TAIL_BYTES
+    assert delta_sync.remote_last_seq(path) == 7
+    with open(path, 'rb') as f:
+        assert f.read().endswith(b'\n')
+
+
+def test_push_after_the_local_labels_were_wiped(tmp_path):
+    cache = tmp_path / 'cache'
+    cache.mkdir()
+    csv_path = str(cache / 'labels.csv')
+    journal_path = str(cache / 'labels.journal')
+    ack_path = str(cache / 'sync' / 'labels_ack.json')
+    nas_labels = str(tmp_path / 'nas')
+    store = LabelStore(csv_path, journal_path, ack_path=ack_path)
+    for i in range(5):
+        store.add(f"{i}.jpg", 'keep')
+    delta_sync.push_labels(csv_path, journal_path, ack_path, nas_labels, machine='m1')
+    store.close()
+
+    shutil.rmtree(cache)
+    cache.mkdir()
+    store = LabelStore(csv_path, journal_path, ack_path=ack_path)
+    store.add('new.jpg', 'discard')
+    stats = delta_sync.push_labels(csv_path, journal_path, ack_path, nas_labels, machine='m1')
+    assert stats == {'records': 1, 'seq': 6}
+    # Later records continue past the snapshot and are pushed too
+    store.add('later.jpg', 'keep')
+    assert delta_sync.push_labels(csv_path, journal_path, ack_path, nas_labels, machine='m1') == {'records': 1, 'seq': 7}
+    merged = merged_labels(nas_labels)
+    assert merged['new.jpg'] == 'discard' and merged['later.jpg'] == 'keep'
+    assert len(merged) == 7
+    store.close()
+
+
+def test_undo_means_the_same_locally_and_merged(tmp_path):
+    csv_path = str(tmp_path / 'labels.csv')
+    journal_path = str(tmp_path / 'labels.journal')
+    ack_path = str(tmp_path / 'sync' / 'labels_ack.json')
+    nas_labels = str(tmp_path / 'nas')
+    store = LabelStore(csv_path, journal_path, ack_path=ack_path)
+    store.add('x.jpg', 'keep')
+    store.add('x.jpg', 'discard')
+    store.undo()
+    delta_sync.push_labels(csv_path, journal_path, ack_path, nas_labels, machine='m1')
+    assert store.get('x.jpg') is None
+    assert 'x.jpg' not in merged_labels(nas_labels)
+    store.close()
@@ -0,0 +1,38 @@
+import os
+import shutil
+
+import pytest
+from PIL import Image
+
+from derivatives import DerivativeCache
+
+
+def test_older_replacement_is_regenerated(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    Image.new('RGB', (40, 40), 'red').save(images / 'photo.jpg')
+    cache = DerivativeCache(str(images), str(tmp_path / 'derivatives'), fmt='jpeg')
+    cache.get('photo.jpg', 320)
+
+    # copy2 keeps the replacement's older mtime, so only an exact stamp match is fresh
+    replacement = tmp_path / 'replacement.jpg'
+    Image.new('RGB', (40, 40), 'blue').save(replacement)
+    os.utime(replacement, ns=(1, 1))
+    shutil.copy2(replacement, images / 'photo.jpg')
+    with Image.open(cache.get('photo.jpg', 320)) as im:
+        red, green, blue = im.getpixel((5, 5))
+    assert blue > 200 and red < 60
+
+
+def test_failed_generation_leaves_no_tmp_file(tmp_path, monkeypatch):
+    images = tmp_path / 'images'
+    images.mkdir()
+    Image.new('RGB', (40, 40), 'red').save(images / 'photo.jpg')
+    cache = DerivativeCache(str(images), str(tmp_path / 'derivatives'), fmt='jpeg')
+
+    def fail(src, dst):
+        raise OSError('disk full')
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        cache.get('photo.jpg', 320)
+    assert os.listdir(tmp_path / 'derivatives' / '320') == []
@@ -0,0 +1,21 @@
+from PIL import Image
+
+from face_analysis import load_image_file
+
+
+def save_rotated(path):
+    """A 40x20 JPEG whose EXIF says to show it turned 90 degrees (20x40), left half red"""
+    im = Image.new('RGB', (40, 20), 'blue')
+    im.paste((255, 0, 0), (0, 0, 20, 20))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    im.save(path, 'JPEG', exif=exif, quality=95)
+
+
+def test_load_image_file_applies_exif_orientation(tmp_path):
+    path = str(tmp_path / 'rotated.jpg')
+    save_rotated(path)
+    image = load_image_file(path)
+    assert image.shape == (40, 20, 3)
+    # Orientation 6 turns the image clockwise: the red left half ends up on top
+    assert image[5, 10, 0] > 200 and image[35, 10, 2] > 200
@@ -0,0 +1,16 @@
+from PIL import Image
+
+from face_crops import FaceSpriteCache
+from test_face_analysis import save_rotated
+
+
+def test_sprite_is_cut_from_the_upright_image(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    save_rotated(str(images / 'rotated.jpg'))
+    sprites = FaceSpriteCache(str(images), str(tmp_path / 'crops'), tile=10)
+    # (top, right, bottom, left) of the top half of the upright 20x40 image
+    path = sprites.get('rotated.jpg', [(0, 20, 20, 0)])
+    with Image.open(path) as sprite:
+        red, green, blue = sprite.convert('RGB').getpixel((5, 5))
+    assert red > 200 and blue < 60
@@ -0,0 +1,54 @@
+import os
+import time
+import threading
+
+import numpy as np
+
+import face_analysis
+from face_pipeline import FacePrecomputer
+
+
+def slow_analyse(path):
+    time.sleep(0.2)
+    return (1, 1), np.zeros((0, 4)), np.zeros((0, 128))
+
+
+class MemoryFaceCache:
+    def __init__(self):
+        self.entries = {}
+
+    def is_current(self, filename, stamp):
+        return filename in self.entries
+
+    def put(self, filename, stamp, locations, encodings):
+        self.entries[filename] = locations
+
+
+def run_with_timeout(func, timeout=10):
+    thread = threading.Thread(target=func, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"{func} did not return within {timeout}s"
+
+
+def test_schedule_moving_window_does_not_deadlock(tmp_path, monkeypatch):
+    monkeypatch.setattr(face_analysis, 'FACE_RECOGNITION_AVAILABLE', True)
+    monkeypatch.setattr(face_analysis, 'analyse_file', slow_analyse)
+    filenames = [f"{i}.jpg" for i in range(6)]
+    for filename in filenames:
+        (tmp_path / filename).write_bytes(b'')
+    cache = MemoryFaceCache()
+    precomputer = FacePrecomputer(str(tmp_path), cache, lookahead=3, workers=1)
+    try:
+        # The second window drops the queued images of the first
+        run_with_timeout(lambda: precomputer.schedule(filenames[:3]))
+        run_with_timeout(lambda: precomputer.schedule(filenames[3:]))
+        for filename in filenames[3:]:
+            precomputer.wait_for(filename, timeout=10)
+        deadline = time.monotonic() + 10
+        while any(precomputer.is_pending(f) for f in filenames) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert not any(precomputer.is_pending(f) for f in filenames)
+        assert set(filenames[3:]) <= set(cache.entries)
+    finally:
+        run_with_timeout(precomputer.shutdown)
@@ -0,0 +1,34 @@
+import numpy as np
+
+from face_store import FaceStore, ENCODING_DIM
+
+
+def encoding(value):
+    return np.full(ENCODING_DIM, value, dtype=np.float32)
+
+
+def test_assign_row_moves_only_that_face(tmp_path):
+    store = FaceStore(str(tmp_path))
+    for i in range(3):
+        store.add_face(encoding(i), 'Alice')
+    store.add_face(encoding(9), 'Carol')
+
+    store.assign_row(1, 'Bob')
+    store.assign_row(3, 'Alice')
+    assert store.names() == ['Alice', 'Bob', 'Alice', 'Alice']
+
+    # Other processes and later generations see the same
+    assert FaceStore(str(tmp_path)).names() == ['Alice', 'Bob', 'Alice', 'Alice']
+    store.compact()
+    assert store.reassigned == {}
+    assert FaceStore(str(tmp_path)).names() == ['Alice', 'Bob', 'Alice', 'Alice']
+
+
+def test_assign_row_back_to_original_person(tmp_path):
+    store = FaceStore(str(tmp_path))
+    store.add_face(encoding(0), 'Alice')
+    store.add_face(encoding(1), 'Alice')
+    store.assign_row(0, 'Bob')
+    store.assign_row(0, 'Alice')
+    assert store.reassigned == {}
+    assert store.names() == ['Alice', 'Alice']
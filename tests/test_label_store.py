@@ -0,0 +1,73 @@
+import json
+
+from label_store import LabelStore
+
+
+def open_store(tmp_path, **kwargs):
+    return LabelStore(str(tmp_path / 'labels.csv'), str(tmp_path / 'labels.journal'),
+                      ack_path=str(tmp_path / 'labels_ack.json'), **kwargs)
+
+
+def journal_seqs(tmp_path):
+    with open(tmp_path / 'labels.journal', 'rb') as f:
+        return [json.loads(line)['seq'] for line in f]
+
+
+def test_torn_final_line_is_dropped_on_reload(tmp_path):
+    store = open_store(tmp_path)
+    store.add('a.jpg', 'keep')
+    store.add('b.jpg', 'discard')
+    store._close_journal()
+    with open(tmp_path / 'labels.journal', 'ab') as f:
+        f.write(b'{"op":"label","filename":"c.jpg","ke')
+
+    store = open_store(tmp_path)
+    assert store.items() == [('a.jpg', 'keep'), ('b.jpg', 'discard')]
+    assert journal_seqs(tmp_path) == [1, 2]
+    store.add('c.jpg', 'keep')
+    assert open_store(tmp_path, read_only=True).get('c.jpg') == 'keep'
+
+
+def test_compaction_keeps_unacked_records(tmp_path):
+    store = open_store(tmp_path)
+    for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+        store.add(name, 'keep')
+    with open(tmp_path / 'labels_ack.json', 'w') as f:
+        json.dump({'seq': 2}, f)
+
+    assert store.compact()
+    assert journal_seqs(tmp_path) == [3]
+    store.add('d.jpg', 'keep')
+    assert journal_seqs(tmp_path) == [3, 4]
+    assert open_store(tmp_path, read_only=True).filenames() == ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']
+
+
+def test_undo_after_compaction(tmp_path):
+    store = open_store(tmp_path)
+    store.add('a.jpg', 'keep')
+    store.add('b.jpg', 'discard')
+    store.compact()
+
+    assert store.undo() == ('b.jpg', 'discard')
+    reloaded = open_store(tmp_path, read_only=True)
+    assert reloaded.items() == [('a.jpg', 'keep')]
+    assert reloaded.seq == 3
+
+
+def test_stores_on_the_same_files_follow_each_other(tmp_path):
+    first = open_store(tmp_path)
+    second = open_store(tmp_path)
+    first.add('a.jpg', 'keep')
+    assert second.follow() == {'a.jpg'}
+    assert second.get('a.jpg') == 'keep'
+
+    # A write catches up on the other store's records first, so sequence numbers stay unique
+    second.add('b.jpg', 'discard')
+    assert first.follow() == {'b.jpg'}
+    assert journal_seqs(tmp_path) == [1, 2]
+
+    # A compaction replaces both files, which the other store answers with a reload
+    first.compact()
+    first.add('c.jpg', 'keep')
+    assert second.reload_if_changed()
+    assert second.items() == [('a.jpg', 'keep'), ('b.jpg', 'discard'), ('c.jpg', 'keep')]
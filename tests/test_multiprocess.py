@@ -0,0 +1,46 @@
+import os
+import sys
+import json
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Writes a face analysis into the shared cache, as another server process or index_faces.py would
+WRITER = '''
+import sys
+sys.path.insert(0, {repo!r})
+import numpy as np
+from face_cache import FaceCache
+from face_analysis import detection_tag
+from state import file_stamp
+cache = FaceCache('cache/face_cache.bin', tag=detection_tag())
+cache.put('a.jpg', file_stamp('cache/images/a.jpg'), np.array([[1, 2, 3, 4]]), np.zeros((1, 128)))
+cache.close()
+'''
+
+# A server process: serves a request, lets the writer run, serves another
+SERVER = '''
+import sys, json, logging, subprocess
+sys.path.insert(0, {repo!r})
+logging.disable(logging.INFO)
+import app
+from state import file_stamp
+client = app.app.test_client()
+stamp = file_stamp('cache/images/a.jpg')
+client.get('/metrics')
+before = app.face_cache.is_current('a.jpg', stamp)
+subprocess.run([sys.executable, '-c', {writer!r}], check=True)
+client.get('/metrics')
+print(json.dumps({{'before': before, 'after': app.face_cache.is_current('a.jpg', stamp)}}))
+'''
+
+
+def test_request_sees_face_analysis_from_another_process(tmp_path):
+    images = tmp_path / 'cache' / 'images'
+    images.mkdir(parents=True)
+    (images / 'a.jpg').write_bytes(b'not really a jpeg')
+    script = SERVER.format(repo=REPO_DIR, writer=WRITER.format(repo=REPO_DIR))
+    result = subprocess.run([sys.executable, '-c', script], cwd=str(tmp_path), capture_output=True,
+                            text=True, timeout=120)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert json.loads(result.stdout.strip().splitlines()[-1]) == {'before': False, 'after': True}
@@ -0,0 +1,43 @@
+import sqlite3
+
+from ocr_index import OcrIndex
+
+
+def test_text_follows_updates_and_removals(tmp_path):
+    ocr = tmp_path / 'ocr'
+    ocr.mkdir()
+    (ocr / 'a.txt').write_text('grocery receipt')
+    (ocr / 'b.txt').write_text('parking ticket')
+    index = OcrIndex(str(tmp_path / 'ocr.sqlite'), str(ocr))
+    index.refresh(force=True)
+    assert index.text('a.jpg') == 'grocery receipt'
+
+    (ocr / 'a.txt').write_text('hardware receipt')
+    index.update(['a.jpg'])
+    assert index.text('a.jpg') == 'hardware receipt'
+    assert [stem for stem, _ in index.search('receipt')] == ['a']
+    index.remove(['b'])
+    assert index.text('b.jpg') is None
+    assert index.search('ticket') == []
+
+
+def test_index_from_before_rowid_keys_is_rebuilt(tmp_path):
+    ocr = tmp_path / 'ocr'
+    ocr.mkdir()
+    (ocr / 'a.txt').write_text('grocery receipt')
+    db_path = str(tmp_path / 'ocr.sqlite')
+    index = OcrIndex(db_path, str(ocr))
+    index.refresh(force=True)
+    index.close()
+    # Documents with their own rowids and no marker, as older versions wrote them
+    db = sqlite3.connect(db_path)
+    with db:
+        db.execute("DELETE FROM meta WHERE key = 'docs_rowid'")
+        db.execute('DELETE FROM docs')
+        db.execute("INSERT INTO docs (rowid, stem, text) VALUES (42, 'a', 'grocery receipt')")
+    db.close()
+
+    index = OcrIndex(db_path, str(ocr))
+    index.refresh()
+    assert index.text('a.jpg') == 'grocery receipt'
+    assert len(index) == 1
@@ -0,0 +1,21 @@
+from sync_engine import SyncEngine
+
+
+def test_append_tail_sends_only_new_bytes(tmp_path):
+    src = tmp_path / 'labels.journal'
+    dst = tmp_path / 'copy.journal'
+    src.write_bytes(b'a' * 100000)
+    dst.write_bytes(b'a' * 100000)
+    with open(src, 'ab') as f:
+        f.write(b'new')
+    assert SyncEngine._append_tail(str(src), str(dst)) == 3
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_append_tail_refuses_a_diverged_copy(tmp_path):
+    src = tmp_path / 'labels.journal'
+    dst = tmp_path / 'copy.journal'
+    src.write_bytes(b'a' * 100000 + b'new')
+    dst.write_bytes(b'a' * 99999 + b'b')
+    assert SyncEngine._append_tail(str(src), str(dst)) is None
+    assert dst.read_bytes() == b'a' * 99999 + b'b'
@@ -0,0 +1,138 @@
+"""
+Snapshot of the app's in-memory indexes, so a restart does not rebuild them.
+
+Rebuilding the label index (parsing labels.csv), the image queue (listing
+cache/images/) and the face cache index (parsing every record of
+face_cache.bin) takes seconds on a large cache before the first image can be
+shown. Each of those objects can describe its state as a snapshot component:
+a small JSON-able dict of validity checks (file stamps, directory mtimes,
+offsets) plus arrays. The app saves the components on shutdown and
+periodically, and hands them back to the constructors at startup. A component
+whose checks no longer match the files is ignored and rebuilt the slow way.
+
+Arrays are stored as .npy files and loaded memory-mapped; lists of names are
+stored as one NUL-separated UTF-8 blob, which splits back into a list in a
+single call. A header written last (atomically) names the files of the
+current generation, so a crash mid-save leaves the previous snapshot intact.
+Server processes sharing the cache take turns saving through a lock file.
+"""
+
+import os
+import json
+import glob
+import mmap
+import time
+import logging
+
+import numpy as np
+
+from state import FileLock
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+HEADER = 'header.json'
+
+
+def _write_strings(path, strings):
+    with open(path, 'wb') as f:
+        f.write('\0'.join(strings).encode('utf-8'))
+
+
+def _read_strings(path, count):
+    if count == 0:
+        return []
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return data[:].decode('utf-8').split('\0')
+
+
+class WarmState:
+    """Directory holding the latest snapshot of each component"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        # Metadata of the snapshot on disk, to skip saving an unchanged state
+        self._saved = None
+        self._file_lock = FileLock(os.path.join(directory, 'save.lock'))
+
+    def load(self):
+        """{component: (meta, arrays)} from the last snapshot, or {} if there is none"""
+        start = time.perf_counter()
+        try:
+            with open(os.path.join(self.directory, HEADER), 'r', encoding='utf-8') as f:
+                header = json.load(f)
+            if header.get('version') != SNAPSHOT_VERSION:
+                logger.info("Ignoring warm-state snapshot from another version")
+                return {}
+            components = {}
+            for name, entry in header['components'].items():
+                arrays = {}
+                for key, (kind, filename, count) in entry['arrays'].items():
+                    path = os.path.join(self.directory, filename)
+                    if kind == 'strings':
+                        arrays[key] = _read_strings(path, count)
+                    else:
+                        arrays[key] = np.load(path, mmap_mode='r')
+                    if len(arrays[key]) != count:
+                        raise ValueError(f"{filename} holds {len(arrays[key])} entries, expected {count}")
+                components[name] = (entry['meta'], arrays)
+            self._saved = {name: entry['meta'] for name, entry in header['components'].items()}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable warm-state snapshot: {e}")
+            return {}
+        logger.info(f"Loaded warm-state snapshot ({', '.join(components)}) "
+                    f"in {1000 * (time.perf_counter() - start):.0f}ms")
+        return components
+
+    def save(self, components):
+        """Write {component: (meta, arrays)}; components given as None are left out
+
+        Returns False without writing if every component's metadata matches
+        the snapshot already on disk.
+        """
+        components = {name: c for name, c in components.items() if c is not None}
+        metas = {name: json.loads(json.dumps(meta)) for name, (meta, _) in components.items()}
+        if metas == self._saved:
+            return False
+        start = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        with self._file_lock:
+            self._write(components)
+        self._saved = metas
+        logger.info(f"Saved warm-state snapshot in {1000 * (time.perf_counter() - start):.0f}ms")
+        return True
+
+    def _write(self, components):
+        generation = time.time_ns()
+        header = {'version': SNAPSHOT_VERSION, 'created': time.time(), 'components': {}}
+        for name, (meta, arrays) in components.items():
+            entry = {'meta': meta, 'arrays': {}}
+            for key, values in arrays.items():
+                if isinstance(values, np.ndarray):
+                    filename = f"{generation}.{name}.{key}.npy"
+                    np.save(os.path.join(self.directory, filename), values)
+                    entry['arrays'][key] = ('array', filename, len(values))
+                else:
+                    filename = f"{generation}.{name}.{key}.txt"
+                    _write_strings(os.path.join(self.directory, filename), values)
+                    entry['arrays'][key] = ('strings', filename, len(values))
+            header['components'][name] = entry
+
+        tmp_path = os.path.join(self.directory, HEADER + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(header, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, HEADER))
+
+        # Files of older generations are no longer referenced
+        for path in glob.glob(os.path.join(self.directory, '*.*.*.*')):
+            if not os.path.basename(path).startswith(f"{generation}."):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Still mapped by a reader (Windows); removed by a later save
+                    pass
@@ -1,17 +1,34 @@
 #!/usr/bin/env python3
 """
 Worker script for synchronization between NAS and local cache.
-This script runs as a Windows scheduled task every 10 minutes.
+This script runs as a Windows scheduled task every 10 minutes, or stays
+resident with --daemon, pushing label and face changes as they happen.
+
+Photos and OCR text are pulled by sync_engine, which keeps manifests of both
+sides under cache/sync/ and only transfers the delta. Labels and faces are
+pushed by delta_sync as new records since the last acknowledged push, then
+merged with those of other labelling machines. The NAS root can be any
+mounted directory:
+
+    python worker.py --nas-root Z:
+    python worker.py --nas-root /tmp/fake_nas --any-network
 """
 
 import os
-import subprocess
-import logging
 import sys
+import json
 import time
-from pathlib import Path
-import socket
+import argparse
+import logging
 import platform
+import subprocess
+
+from sync_engine import Channel, SyncEngine
+from delta_sync import DeltaPusher
+from label_store import LabelStore
+from image_queue import queue_order
+from state import file_stamp
+from ocr_index import OcrIndex
 
 # Configure logging
 logging.basicConfig(
@@ -29,21 +46,44 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CACHE_DIR = os.path.join(BASE_DIR, 'cache')
 IMAGES_DIR = os.path.join(CACHE_DIR, 'images')
 OCR_DIR = os.path.join(CACHE_DIR, 'ocr')
+OCR_INDEX_DB = os.path.join(CACHE_DIR, 'ocr_index.sqlite')
 LABELS_CSV = os.path.join(CACHE_DIR, 'labels.csv')
-FACES_PKL = os.path.join(CACHE_DIR, 'faces.pkl')
+LABELS_JOURNAL = os.path.join(CACHE_DIR, 'labels.journal')
+FACES_DIR = os.path.join(CACHE_DIR, 'faces')
+SYNC_STATE_DIR = os.path.join(CACHE_DIR, 'sync')
+SYNC_STATUS_JSON = os.path.join(CACHE_DIR, 'sync_status.json')
+SYNC_METRICS_JSON = os.path.join(CACHE_DIR, 'sync_metrics.json')
+
+# NAS paths (Windows mapped drive by default; any mounted directory works)
+NAS_DRIVE = os.environ.get('SYNC_NAS_ROOT', "Z:")
+NAS_PHOTOS = "photos_preprocessed"
+NAS_OCR = "ocr_data"
+NAS_LABELS = "labels"
+NAS_FACES = "known_faces"
+REQUIRED_SSID = "Abayasekera"
 
-# NAS paths (using Windows mapped drive)
-NAS_DRIVE = "Z:"
-NAS_PHOTOS = os.path.join(NAS_DRIVE, "photos_preprocessed")
-NAS_OCR = os.path.join(NAS_DRIVE, "ocr_data")
-NAS_LABELS = os.path.join(NAS_DRIVE, "labels")
-NAS_FACES = os.path.join(NAS_DRIVE, "known_faces")
+# Concurrent file copies shared by all channels
+SYNC_WORKERS = int(os.environ.get('SYNC_WORKERS', '4'))
+# Photos/OCR files transferred per window; each window lands before the next starts
+SYNC_WINDOW = int(os.environ.get('SYNC_WINDOW', '25'))
 
-# Ensure directories exist
-os.makedirs(IMAGES_DIR, exist_ok=True)
-os.makedirs(OCR_DIR, exist_ok=True)
-os.makedirs(NAS_LABELS, exist_ok=True)
-os.makedirs(NAS_FACES, exist_ok=True)
+# Per-channel stats that add up across runs in sync_metrics.json (the rest are last-run values)
+CUMULATIVE_STATS = ('copied', 'appended', 'bytes', 'errors', 'records', 'rows', 'seconds')
+
+# Daemon mode timings (seconds)
+WATCH_INTERVAL = 1.0
+PUSH_DEBOUNCE = 2.0
+PUSH_MAX_DELAY = 15.0
+POLL_MIN = 60.0
+POLL_MAX = 600.0
+BACKOFF_MIN = 30.0
+BACKOFF_MAX = 900.0
+STATUS_HEARTBEAT = 30.0
+
+def ensure_dirs():
+    """Create the local cache directories the pulls write to (not on import, so callers can redirect them)"""
+    os.makedirs(IMAGES_DIR, exist_ok=True)
+    os.makedirs(OCR_DIR, exist_ok=True)
 
 def check_wifi_ssid():
     """Check if connected to the required SSID (Abayasekera)"""
@@ -55,7 +95,7 @@ def check_wifi_ssid():
                 if "SSID" in line and ":" in line and not "BSSID" in line:
                     ssid = line.split(":")[1].strip()
                     logger.info(f"Connected to SSID: {ssid}")
-                    return ssid == "Abayasekera"
+                    return ssid == REQUIRED_SSID
         else:
             logger.warning("Not running on Windows, can't check SSID")
             
@@ -64,16 +104,17 @@ def check_wifi_ssid():
         logger.error(f"Error checking SSID: {e}")
         return False
 
-def check_nas_connection():
+def check_nas_connection(nas_root=NAS_DRIVE):
     """Check if NAS is accessible"""
     try:
-        if not os.path.exists(NAS_DRIVE):
-            logger.error(f"NAS drive {NAS_DRIVE} not found")
+        if not os.path.exists(nas_root):
+            logger.error(f"NAS drive {nas_root} not found")
             return False
             
         # Try to access a directory on the NAS
-        if not os.path.exists(NAS_PHOTOS):
-            logger.error(f"NAS photos directory {NAS_PHOTOS} not accessible")
+        nas_photos = os.path.join(nas_root, NAS_PHOTOS)
+        if not os.path.exists(nas_photos):
+            logger.error(f"NAS photos directory {nas_photos} not accessible")
             return False
             
         logger.info("NAS connection verified")
@@ -82,66 +123,314 @@ def check_nas_connection():
         logger.error(f"Error checking NAS connection: {e}")
         return False
 
-def run_rsync(source, dest, flags="--ignore-existing"):
-    """Run rsync command with proper flags"""
+def _stem(rel):
+    return os.path.splitext(rel.rsplit('/', 1)[-1])[0]
+
+def labelling_order():
+    """Order pulls the way the app will show images: unlabelled ones in queue order, labelled ones last
+
+    OCR text files go with the image of the same name, so both arrive together.
+    """
     try:
-        if platform.system() == 'Windows':
-            # Using rsync for Windows (cwRsync or similar)
-            cmd = f"rsync -av {flags} \"{source}/\" \"{dest}/\""
-        else:
-            # Linux/Mac
-            cmd = f"rsync -av {flags} '{source}/' '{dest}/'"
-        
-        logger.info(f"Running: {cmd}")
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            logger.info(f"Rsync successful: {source} -> {dest}")
-            if result.stdout:
-                logger.info(f"Output: {result.stdout[:500]}")
-            return True
-        else:
-            logger.error(f"Rsync failed with code {result.returncode}: {result.stderr}")
-            return False
+        labels = LabelStore(LABELS_CSV, LABELS_JOURNAL, read_only=True)
+        labelled = {_stem(filename) for filename in labels.filenames()}
     except Exception as e:
-        logger.error(f"Error running rsync: {e}")
-        return False
+        logger.error(f"Error reading label state, pulling in name order: {e}")
+        labelled = set()
+    
+    def order(rels):
+        pending = [rel for rel in rels if _stem(rel) not in labelled]
+        backfill = [rel for rel in rels if _stem(rel) in labelled]
+        return queue_order(pending) + queue_order(backfill)
+    
+    logger.info(f"Prioritising pulls around {len(labelled)} labelled images")
+    return order
+
+_ocr_index = None
+
+def get_ocr_index():
+    """The OCR search index shared with the app, opened on first use"""
+    global _ocr_index
+    if _ocr_index is None:
+        _ocr_index = OcrIndex(OCR_INDEX_DB, OCR_DIR)
+    return _ocr_index
+
+def index_ocr(rels):
+    """Add freshly pulled OCR files to the search index"""
+    indexed = get_ocr_index().update(rel for rel in rels if rel.endswith('.txt'))
+    logger.info(f"Indexed {indexed} OCR files for search")
 
-def sync_files():
+def pull_channels(nas_root=NAS_DRIVE):
+    """Channels bringing new photos and OCR text from the NAS"""
+    order = labelling_order()
+    return [
+        # Photos and OCR text from NAS to local (only new files), next to be labelled first
+        Channel('images', os.path.join(nas_root, NAS_PHOTOS), IMAGES_DIR,
+                mode='ignore_existing', source_immutable=True, order=order, window=SYNC_WINDOW),
+        Channel('ocr', os.path.join(nas_root, NAS_OCR), OCR_DIR,
+                mode='ignore_existing', source_immutable=True, order=order, window=SYNC_WINDOW,
+                on_transfer=index_ocr),
+    ]
+
+def build_channels(nas_root=NAS_DRIVE):
+    """The sync channels between the NAS root and the local cache"""
+    return pull_channels(nas_root)
+
+def run_channels(channels, workers=SYNC_WORKERS, tasks=None):
+    """Run channels (and tasks alongside them) through the sync engine; returns (ok, results)"""
+    results = SyncEngine(channels, SYNC_STATE_DIR, workers=workers, tasks=tasks).run()
+    record_metrics(results)
+    return _check_results(results), results
+
+def delta_pusher(nas_root=NAS_DRIVE):
+    """Pushes new label records and face rows, then merges all machines on the NAS"""
+    return DeltaPusher(CACHE_DIR, os.path.join(nas_root, NAS_LABELS),
+                       os.path.join(nas_root, NAS_FACES), SYNC_STATE_DIR)
+
+def push_changes(nas_root=NAS_DRIVE):
+    """Push labels and faces to the NAS; returns (ok, results)"""
+    results = delta_pusher(nas_root).run()
+    record_metrics(results)
+    return _check_results(results), results
+
+def record_metrics(results):
+    """Add a run's per-channel stats to cache/sync_metrics.json, which the app serves at /metrics"""
+    try:
+        with open(SYNC_METRICS_JSON, 'r', encoding='utf-8') as f:
+            channels = json.load(f)
+    except (OSError, ValueError):
+        channels = {}
+
+    now = time.time()
+    for name, stats in results.items():
+        numeric = {key: value for key, value in stats.items()
+                   if isinstance(value, (int, float)) and not isinstance(value, bool)}
+        entry = channels.setdefault(name, {'runs': 0, 'totals': {}})
+        entry['runs'] += 1
+        entry['finished'] = now
+        entry['last'] = numeric
+        for key in CUMULATIVE_STATS:
+            if key in numeric:
+                entry['totals'][key] = entry['totals'].get(key, 0) + numeric[key]
+        entry['totals']['runs'] = entry['runs']
+        logger.info(f"[{name}] " + ', '.join(f"{key}={value:g}" for key, value in numeric.items()))
+
+    tmp_path = f"{SYNC_METRICS_JSON}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(channels, f, indent=2)
+        os.replace(tmp_path, SYNC_METRICS_JSON)
+    except OSError as e:
+        logger.error(f"Error writing sync metrics: {e}")
+
+def _check_results(results):
+    failed = [name for name, stats in results.items() if stats.get('error') or stats.get('errors')]
+    if failed:
+        logger.error(f"Synchronization finished with errors in: {', '.join(failed)}")
+    return not failed
+
+def sync_files(nas_root=NAS_DRIVE, workers=SYNC_WORKERS, check_network=True):
     """Synchronize files between NAS and local cache"""
     logger.info("Starting file synchronization...")
+    ensure_dirs()
     
     # Check if we're on the right network
-    if not check_wifi_ssid():
-        logger.warning("Not connected to Abayasekera WiFi, skipping sync")
+    if check_network and not check_wifi_ssid():
+        logger.warning(f"Not connected to {REQUIRED_SSID} WiFi, skipping sync")
         return False
     
     # Check NAS connection
-    if not check_nas_connection():
+    if not check_nas_connection(nas_root):
         logger.warning("NAS not accessible, skipping sync")
         return False
-        
-    # Sync photos from NAS to local (only new files)
-    run_rsync(NAS_PHOTOS, IMAGES_DIR)
-    
-    # Sync OCR data from NAS to local (only new files)
-    run_rsync(NAS_OCR, OCR_DIR)
-    
-    # Sync labels from local to NAS (always update)
-    if os.path.exists(LABELS_CSV):
-        run_rsync(os.path.dirname(LABELS_CSV), NAS_LABELS, "--update")
     
-    # Sync faces from local to NAS (always update)
-    if os.path.exists(FACES_PKL):
-        run_rsync(os.path.dirname(FACES_PKL), NAS_FACES, "--update")
-    
-    logger.info("Synchronization completed successfully")
-    return True
+    # The push touches other NAS folders than the pulls, so it runs alongside them
+    ok, _ = run_channels(build_channels(nas_root), workers, tasks={'push': delta_pusher(nas_root).run})
+    if ok:
+        logger.info("Synchronization completed successfully")
+    return ok
+
+class LocalChangeWatcher:
+    """Notices changes to the files pushed to the NAS by polling their stamps"""
+
+    def __init__(self, paths, dirs):
+        self.paths = paths
+        self.dirs = dirs
+        self._stamps = self._snapshot()
+
+    def _snapshot(self):
+        stamps = {path: file_stamp(path) for path in self.paths}
+        for directory in self.dirs:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith('.tmp'):
+                    path = os.path.join(directory, name)
+                    stamps[path] = file_stamp(path)
+        return stamps
+
+    def changed(self):
+        """True if anything changed since the last call"""
+        stamps = self._snapshot()
+        changed = stamps != self._stamps
+        self._stamps = stamps
+        return changed
+
+class SyncDaemon:
+    """Resident sync: pushes local changes as they happen and polls the NAS for new photos
+
+    Label and face changes are pushed once the files have been quiet for
+    PUSH_DEBOUNCE seconds (or after PUSH_MAX_DELAY of continuous changes).
+    The NAS is polled every POLL_MIN seconds, stretching to POLL_MAX while
+    polls find nothing new; while it is unreachable retries back off from
+    BACKOFF_MIN to BACKOFF_MAX. The last sync status is written to
+    cache/sync_status.json for the Flask app.
+    """
+
+    def __init__(self, nas_root=NAS_DRIVE, workers=SYNC_WORKERS, check_network=True,
+                 status_path=SYNC_STATUS_JSON):
+        self.nas_root = nas_root
+        self.workers = workers
+        self.check_network = check_network
+        self.status_path = status_path
+        self.watcher = LocalChangeWatcher([LABELS_CSV, LABELS_JOURNAL], [FACES_DIR])
+
+        self.poll_interval = POLL_MIN
+        self.failures = 0
+        self.network_verified = False
+        self.dirty_since = None
+        self.last_change = None
+        self.next_pull = time.time()
+        self.retry_at = 0
+        self.status = {
+            'pid': os.getpid(),
+            'nas_root': nas_root,
+            'state': 'starting',
+            'started': time.time(),
+            'last_push': None,
+            'last_pull': None,
+            'last_error': None,
+            'pending_push': False,
+        }
+        self._last_status_write = 0
+
+    def write_status(self, **changes):
+        self.status.update(changes)
+        self.status['updated'] = time.time()
+        self.status['next_pull'] = self.next_pull
+        self.status['consecutive_failures'] = self.failures
+        self.status['pending_push'] = self.dirty_since is not None
+        tmp_path = f"{self.status_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.status, f, indent=2)
+            os.replace(tmp_path, self.status_path)
+        except OSError as e:
+            logger.error(f"Error writing sync status: {e}")
+        self._last_status_write = time.time()
+
+    def reachable(self):
+        """NAS check, with the SSID check only when (re)connecting"""
+        if self.check_network and not self.network_verified and not check_wifi_ssid():
+            return self.offline(f"Not connected to {REQUIRED_SSID} WiFi")
+        if not check_nas_connection(self.nas_root):
+            self.network_verified = False
+            return self.offline("NAS not accessible")
+        self.network_verified = True
+        if self.failures:
+            logger.info("NAS reachable again")
+            self.failures = 0
+        return True
+
+    def offline(self, reason):
+        self.failures += 1
+        backoff = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (self.failures - 1))
+        self.retry_at = self.next_pull = time.time() + backoff
+        logger.warning(f"{reason}, retrying in {backoff:.0f}s")
+        self.write_status(state='offline', last_error=reason)
+        return False
+
+    def push(self):
+        if time.time() < self.retry_at or not self.reachable():
+            return
+        self.write_status(state='pushing')
+        self.dirty_since = None
+        ok, results = push_changes(self.nas_root)
+        self.write_status(state='idle', last_push={'time': time.time(), 'ok': ok, 'channels': results},
+                          last_error=None if ok else "Push finished with errors")
+
+    def pull(self):
+        if not self.reachable():
+            return
+        self.write_status(state='pulling')
+        ok, results = run_channels(pull_channels(self.nas_root), self.workers)
+        new_files = sum(stats.get('copied', 0) for stats in results.values())
+        # Poll eagerly while new photos keep arriving, lazily while the NAS is quiet
+        if new_files:
+            self.poll_interval = POLL_MIN
+        else:
+            self.poll_interval = min(POLL_MAX, self.poll_interval * 2)
+        self.next_pull = time.time() + self.poll_interval
+        self.write_status(state='idle', last_pull={'time': time.time(), 'ok': ok, 'new_files': new_files,
+                                                   'channels': results},
+                          last_error=None if ok else "Pull finished with errors")
+
+    def step(self):
+        now = time.time()
+        if self.watcher.changed():
+            self.last_change = now
+            if self.dirty_since is None:
+                self.dirty_since = now
+                logger.info("Local labels/faces changed, push scheduled")
+        if self.dirty_since is not None and (now - self.last_change >= PUSH_DEBOUNCE
+                                             or now - self.dirty_since >= PUSH_MAX_DELAY):
+            self.push()
+        if now >= self.next_pull:
+            self.pull()
+        if now - self._last_status_write >= STATUS_HEARTBEAT:
+            self.write_status()
+
+    def run(self):
+        logger.info(f"Sync daemon watching {CACHE_DIR}, NAS at {self.nas_root}")
+        # Push anything labelled while the daemon was not running
+        self.dirty_since = self.last_change = time.time() - PUSH_DEBOUNCE
+        self.write_status(state='idle')
+        try:
+            while True:
+                try:
+                    self.step()
+                except Exception as e:
+                    logger.error(f"Error in sync daemon: {e}", exc_info=True)
+                    self.write_status(state='error', last_error=str(e))
+                time.sleep(WATCH_INTERVAL)
+        except KeyboardInterrupt:
+            logger.info("Sync daemon stopping")
+        finally:
+            self.write_status(state='stopped')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sync the local cache with the NAS")
+    parser.add_argument('--nas-root', default=NAS_DRIVE,
+                        help="NAS mount point or any directory standing in for it (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=SYNC_WORKERS,
+                        help="Concurrent file copies (default: %(default)s)")
+    parser.add_argument('--any-network', action='store_true',
+                        help=f"Skip the {REQUIRED_SSID} WiFi check")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Stay resident: push local changes as they happen and poll the NAS")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
     logger.info("Sync worker starting...")
+    args = parse_args()
+    ensure_dirs()
     try:
-        sync_files()
+        if args.daemon:
+            SyncDaemon(args.nas_root, args.workers, check_network=not args.any_network).run()
+        else:
+            sync_files(args.nas_root, args.workers, check_network=not args.any_network)
     except Exception as e:
         logger.error(f"Unhandled exception in sync worker: {e}", exc_info=True)
         sys.exit(1)